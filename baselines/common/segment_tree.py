@@ -1,5 +1,7 @@
 import operator
 
+import numpy as np
+
 
 class SegmentTree(object):
     def __init__(self, capacity, operation, neutral_element):
@@ -30,7 +32,7 @@ class SegmentTree(object):
         """
         assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
         self._operation = operation
 
     def _reduce_helper(self, start, end, node, node_start, node_end):
@@ -74,20 +76,24 @@ class SegmentTree(object):
         return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
 
     def __setitem__(self, idx, val):
+        """Sets one item, or a batch of items when `idx` is an array of indices.
+        A batch is propagated to the root level by level, so it costs
+        O(lg capacity) vectorized operations instead of one tree walk per item.
+        """
         # index of the leaf
-        idx += self._capacity
+        idx = np.asarray(idx) + self._capacity
         self._value[idx] = val
-        idx //= 2
-        while idx >= 1:
+        idx = np.unique(idx // 2)
+        while idx[0] >= 1:
             self._value[idx] = self._operation(
                 self._value[2 * idx],
                 self._value[2 * idx + 1]
             )
-            idx //= 2
+            idx = np.unique(idx // 2)
 
     def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
-        return self._value[self._capacity + idx]
+        assert np.all(0 <= np.asarray(idx)) and np.all(np.asarray(idx) < self._capacity)
+        return self._value[self._capacity + np.asarray(idx)]
 
 
 class SumSegmentTree(SegmentTree):
@@ -112,30 +118,32 @@ class SumSegmentTree(SegmentTree):
 
         Parameters
         ----------
-        perfixsum: float
-            upperbound on the sum of array prefix
+        perfixsum: float or np.array
+            upperbound on the sum of array prefix; an array of upperbounds
+            is looked up in one vectorized descent
 
         Returns
         -------
-        idx: int
+        idx: int or np.array
             highest index satisfying the prefixsum constraint
         """
-        assert 0 <= prefixsum <= self.sum() + 1e-5
-        idx = 1
-        while idx < self._capacity:  # while non-leaf
-            if self._value[2 * idx] > prefixsum:
-                idx = 2 * idx
-            else:
-                prefixsum -= self._value[2 * idx]
-                idx = 2 * idx + 1
-        return idx - self._capacity
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        assert np.all(0 <= prefixsum) and np.all(prefixsum <= self.sum() + 1e-5)
+        idx = np.ones(prefixsum.shape, dtype=np.int64)
+        for _ in range(int(np.log2(self._capacity))):  # while non-leaf
+            left = self._value[2 * idx]
+            go_right = left <= prefixsum
+            prefixsum -= left * go_right
+            idx = 2 * idx + go_right
+        idx -= self._capacity
+        return int(idx) if idx.ndim == 0 else idx
 
 
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(MinSegmentTree, self).__init__(
             capacity=capacity,
-            operation=min,
+            operation=np.minimum,
             neutral_element=float('inf')
         )
 
@@ -95,9 +95,34 @@ def test_max_interval_tree():
     assert np.isclose(tree.min(3, 4), 3.0)
 
 
+def test_batch_set_and_prefixsum_idx():
+    tree = SumSegmentTree(8)
+    reference = SumSegmentTree(8)
+
+    values = np.array([0.5, 0.0, 1.0, 3.0, 0.0, 2.0, 0.25, 1.0])
+    tree[np.arange(8)] = values
+    for i, value in enumerate(values):
+        reference[i] = value
+
+    assert np.isclose(tree.sum(), values.sum())
+    assert np.allclose(tree[np.arange(8)], values)
+    for start, end in [(0, 3), (2, 6), (5, 8)]:
+        assert np.isclose(tree.sum(start, end), reference.sum(start, end))
+
+    prefixsums = np.linspace(0, values.sum(), 50)
+    idxs = tree.find_prefixsum_idx(prefixsums)
+    assert np.array_equal(idxs, [reference.find_prefixsum_idx(p) for p in prefixsums])
+
+    min_tree = MinSegmentTree(8)
+    min_tree[np.array([1, 4, 6])] = np.array([2.0, 0.5, 1.5])
+    assert np.isclose(min_tree.min(), 0.5)
+    assert np.isclose(min_tree.min(5, 8), 1.5)
+
+
 if __name__ == '__main__':
     test_tree_set()
     test_tree_set_overlap()
     test_prefixsum_idx()
     test_prefixsum_idx2()
     test_max_interval_tree()
+    test_batch_set_and_prefixsum_idx()
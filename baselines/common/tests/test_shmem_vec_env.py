@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from gym import spaces
+
+from baselines.common.vec_env.shmem_vec_env import ShmemVecEnv
+
+
+class _GoalEnv:
+    """A dict-observation environment whose observation accumulates the actions.
+    """
+    observation_space = spaces.Dict({
+        'observation': spaces.Box(-np.inf, np.inf, (3,)), 'achieved_goal': spaces.Box(-np.inf, np.inf, (2,)),
+        'desired_goal': spaces.Box(-np.inf, np.inf, (2,))})
+    action_space = spaces.Box(-1., 1., (2,))
+
+    def __init__(self):
+        self.env = self
+        self.goal = np.zeros(2)
+        self.t = 0
+
+    def seed(self, seed):
+        self.goal = np.full(2, float(seed))
+
+    def _obs(self):
+        return {'observation': np.array([self.t, *self.pos]), 'achieved_goal': self.pos.copy(),
+                'desired_goal': self.goal.copy()}
+
+    def reset(self):
+        self.t = 0
+        self.pos = np.zeros(2)
+        return self._obs()
+
+    def step(self, u):
+        if np.isnan(u).any():
+            raise ValueError('invalid action')
+        self.t += 1
+        self.pos += u
+        info = {'is_success': float(np.allclose(self.pos, self.goal)), 'dist': self.pos - self.goal}
+        if self.t == 2:
+            info['cur_step'] = self.t
+        return self._obs(), -np.abs(self.pos - self.goal).sum(), self.t >= 2, info
+
+
+def _make_vec_env(n_workers):
+    return ShmemVecEnv([_GoalEnv] * 4, {'observation': 3, 'achieved_goal': 2, 'desired_goal': 2}, 2,
+                       {'is_success': 1, 'cur_step': 1, 'dist': 2}, n_workers=n_workers)
+
+
+@pytest.mark.parametrize('n_workers', [1, 3])
+def test_matches_sequential_envs(n_workers):
+    vec_env = _make_vec_env(n_workers)
+    envs = [_GoalEnv() for _ in range(4)]
+    vec_env.seed([1, 2, 3, 4])
+    goals = np.arange(8.).reshape(4, 2)
+    obs = vec_env.reset(goals)
+    for i, env in enumerate(envs):
+        env.reset()
+        env.goal = goals[i]
+        np.testing.assert_allclose(obs['observation'][i], env._obs()['observation'])
+
+    rng = np.random.RandomState(0)
+    for t in range(3):
+        u = rng.uniform(-1, 1, (4, 2))
+        vec_env.step_async(u)
+        obs, rews, dones, infos = vec_env.step_wait()
+        for i, env in enumerate(envs):
+            ob, rew, done, info = env.step(u[i])
+            for key in ob:
+                np.testing.assert_allclose(obs[key][i], ob[key])
+            assert np.isclose(rews[i], rew) and dones[i] == done
+            assert sorted(infos[i]) == sorted(info)
+            np.testing.assert_allclose(infos[i]['dist'], info['dist'])
+            assert infos[i]['is_success'] == info['is_success']
+    vec_env.close()
+
+
+def test_reraises_env_errors():
+    vec_env = _make_vec_env(2)
+    vec_env.reset()
+    with pytest.raises(ValueError):
+        vec_env.step(np.full((4, 2), np.nan))
+    # the workers keep serving commands after an error
+    obs = vec_env.reset()
+    assert np.all(obs['observation'] == 0)
+    vec_env.close()
+
+
+def test_reports_env_errors_per_env():
+    vec_env = ShmemVecEnv([_GoalEnv] * 4, {'observation': 3, 'achieved_goal': 2, 'desired_goal': 2}, 2,
+                          {'is_success': 1, 'cur_step': 1, 'dist': 2}, n_workers=2, raise_env_errors=False)
+    vec_env.reset()
+    u = np.ones((4, 2))
+    u[0] = np.nan
+    vec_env.step_async(u)
+    obs, rews, dones, infos = vec_env.step_wait()
+    assert isinstance(infos[0]['error'], ValueError) and sorted(infos[0]) == ['error']
+    # the other environment of the failing worker is still stepped
+    np.testing.assert_allclose(obs['achieved_goal'][1:], 1.)
+    assert 'error' not in infos[1]
+
+    ob = vec_env.reset_env(0, goal=np.full(2, 5.))
+    np.testing.assert_allclose(ob['observation'], 0.)
+    obs, rews, dones, infos = vec_env.step(np.ones((4, 2)))
+    np.testing.assert_allclose(obs['achieved_goal'][0], 1.)
+    np.testing.assert_allclose(obs['desired_goal'][0], 5.)
+    np.testing.assert_allclose(obs['achieved_goal'][1:], 2.)
+    vec_env.close()
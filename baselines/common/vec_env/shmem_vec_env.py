@@ -0,0 +1,201 @@
+import numpy as np
+from multiprocessing import Process, Pipe, RawArray
+from baselines.common.vec_env import VecEnv, CloudpickleWrapper, AlreadySteppingError, NotSteppingError
+
+
+def _as_arrays(shared, shapes):
+    return {key: np.frombuffer(shared[key], np.float64).reshape(shapes[key]) for key in shapes}
+
+
+def worker(remote, parent_remote, env_fns_wrapper, env_idxs, shared, shapes, obs_keys, info_keys, raise_env_errors):
+    parent_remote.close()
+    envs = [env_fn() for env_fn in env_fns_wrapper.x]
+    arrays = _as_arrays(shared, shapes)
+
+    def write_obs(i, ob):
+        if isinstance(ob, dict):
+            for key in obs_keys:
+                arrays['obs_' + key][i] = ob[key]
+        else:
+            arrays['obs_' + obs_keys[0]][i] = ob
+
+    while True:
+        cmd, data = remote.recv()
+        try:
+            if cmd == 'step':
+                env_errors = {}
+                for env, i in zip(envs, env_idxs):
+                    try:
+                        ob, reward, done, info = env.step(arrays['actions'][i])
+                    except Exception as e:
+                        if raise_env_errors:
+                            raise
+                        env_errors[i] = e
+                        continue
+                    write_obs(i, ob)
+                    arrays['rews'][i] = reward
+                    arrays['dones'][i] = done
+                    for k, key in enumerate(info_keys):
+                        arrays['info_mask'][i, k] = key in info
+                        if key in info:
+                            arrays['info_' + key][i] = info[key]
+                remote.send(env_errors or None)
+            elif cmd == 'reset':
+                for env, i in zip(envs, env_idxs):
+                    write_obs(i, env.reset())
+                    if data is not None:
+                        # goal-conditioned robotics envs keep their goal on the unwrapped env
+                        env.env.goal = data[i].copy()
+                remote.send(None)
+            elif cmd == 'reset_env':
+                i, goal = data
+                env = envs[list(env_idxs).index(i)]
+                write_obs(i, env.reset())
+                if goal is not None:
+                    env.env.goal = goal.copy()
+                remote.send(None)
+            elif cmd == 'seed':
+                for env, i in zip(envs, env_idxs):
+                    env.seed(data[i])
+                remote.send(None)
+            elif cmd == 'close':
+                remote.close()
+                break
+            elif cmd == 'get_spaces':
+                remote.send((envs[0].observation_space, envs[0].action_space))
+            else:
+                raise NotImplementedError
+        except Exception as e:
+            # reported to the caller of the command, which re-raises it
+            remote.send(e)
+
+
+class ShmemVecEnv(VecEnv):
+    def __init__(self, env_fns, obs_dims, action_dim, info_dims, n_workers=None, raise_env_errors=True):
+        """Steps the environments in n_workers subprocesses, each of which owns a contiguous slice of
+        them. Actions, observations, rewards, dones and the numeric info entries are exchanged
+        through shared memory, so the pipes only carry the commands.
+
+        Unlike SubprocVecEnv, environments are not reset when they are done.
+
+        Args:
+            env_fns (list): the functions that create the environments, one per environment
+            obs_dims (dict of ints): the dimension of each entry of the dict observations, e.g.
+                'observation', 'achieved_goal' and 'desired_goal'. Environments with plain array
+                observations write them to the first entry.
+            action_dim (int): the dimension of the actions
+            info_dims (dict of ints): the dimension of the info entries to be returned, other entries
+                are dropped
+            n_workers (int): the number of subprocesses, one per environment by default
+            raise_env_errors (boolean): whether step_wait re-raises the errors of env.step. If False,
+                the other environments are still stepped and the error is returned in the info of
+                the failing environment, under 'error'.
+        """
+        self.waiting = False
+        self.closed = False
+        nenvs = len(env_fns)
+        n_workers = min(n_workers or nenvs, nenvs)
+        self.obs_keys = list(obs_dims.keys())
+        self.info_keys = list(info_dims.keys())
+        self.info_dims = info_dims
+
+        shapes = {'actions': (nenvs, action_dim), 'rews': (nenvs,), 'dones': (nenvs,),
+                  'info_mask': (nenvs, len(self.info_keys))}
+        shapes.update({'obs_' + key: (nenvs, dim) for key, dim in obs_dims.items()})
+        shapes.update({'info_' + key: (nenvs, dim) for key, dim in info_dims.items()})
+        shared = {key: RawArray('d', int(np.prod(shape))) for key, shape in shapes.items()}
+        self.arrays = _as_arrays(shared, shapes)
+
+        env_idxs = np.array_split(np.arange(nenvs), n_workers)
+        # the worker that owns each environment
+        self.env_workers = np.concatenate([np.full(len(idxs), w) for w, idxs in enumerate(env_idxs)])
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(n_workers)])
+        self.ps = [Process(target=worker, args=(work_remote, remote, CloudpickleWrapper([env_fns[i] for i in idxs]),
+                                                idxs, shared, shapes, self.obs_keys, self.info_keys, raise_env_errors))
+                   for (work_remote, remote, idxs) in zip(self.work_remotes, self.remotes, env_idxs)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+        for remote in self.work_remotes:
+            remote.close()
+
+        self.remotes[0].send(('get_spaces', None))
+        observation_space, action_space = self.remotes[0].recv()
+        self.dict_obs = hasattr(observation_space, 'spaces')
+        VecEnv.__init__(self, nenvs, observation_space, action_space)
+
+    def _command(self, cmd, data=None):
+        for remote in self.remotes:
+            remote.send((cmd, data))
+        self._wait()
+
+    def _wait(self, remotes=None):
+        # collect every reply before raising, so that the pipes stay in sync
+        replies = [remote.recv() for remote in (remotes or self.remotes)]
+        errors = [e for e in replies if isinstance(e, Exception)]
+        if errors:
+            raise errors[0]
+        return replies
+
+    def _obs(self, i=slice(None)):
+        if self.dict_obs:
+            return {key: self.arrays['obs_' + key][i].copy() for key in self.obs_keys}
+        return self.arrays['obs_' + self.obs_keys[0]][i].copy()
+
+    def step_async(self, actions):
+        if self.waiting:
+            raise AlreadySteppingError
+        self.arrays['actions'][...] = actions
+        for remote in self.remotes:
+            remote.send(('step', None))
+        self.waiting = True
+
+    def step_wait(self):
+        if not self.waiting:
+            raise NotSteppingError
+        self.waiting = False
+        env_errors = {}
+        for reply in self._wait():
+            env_errors.update(reply or {})
+        infos = [{} for _ in range(self.num_envs)]
+        for k, key in enumerate(self.info_keys):
+            values = self.arrays['info_' + key]
+            for i in np.flatnonzero(self.arrays['info_mask'][:, k]):
+                if i not in env_errors:
+                    infos[i][key] = values[i, 0] if self.info_dims[key] == 1 else values[i].copy()
+        for i, e in env_errors.items():
+            infos[i]['error'] = e
+        return self._obs(), self.arrays['rews'].copy(), self.arrays['dones'].astype(bool), infos
+
+    def reset(self, goals=None):
+        """Resets all environments and returns their observations. If goals is given, the goal of
+        the i-th environment is then replaced by goals[i].
+        """
+        self._command('reset', goals)
+        return self._obs()
+
+    def reset_env(self, i, goal=None):
+        """Resets the i-th environment only and returns its observation. If goal is given, the goal
+        of the environment is then replaced by it.
+        """
+        if self.waiting:
+            raise AlreadySteppingError
+        remote = self.remotes[self.env_workers[i]]
+        remote.send(('reset_env', (i, goal)))
+        self._wait([remote])
+        return self._obs(i)
+
+    def seed(self, seeds):
+        self._command('seed', seeds)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for p in self.ps:
+            p.join()
+        self.closed = True
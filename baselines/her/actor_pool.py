@@ -0,0 +1,243 @@
+import multiprocessing
+import pickle
+import queue
+import time
+import traceback
+from collections import deque
+
+import cloudpickle
+import numpy as np
+
+
+def _weight_arrays(weights):
+    """The arrays of an export_numpy_weights snapshot that the actors need, the normalizer
+    statistics and the layers of main/pi, in a fixed order.
+    """
+    arrays = list(weights['o_stats']) + list(weights['g_stats'])
+    for w, b in weights['pi']:
+        arrays += [w, b]
+    return [np.asarray(x, np.float32) for x in arrays]
+
+
+class SharedWeights:
+    def __init__(self, weights, version=0, ctx=multiprocessing):
+        """A versioned copy of the actor weights and normalizer statistics in shared memory,
+        written by the learner and read by the actor processes.
+
+        Args:
+            weights (dict): a snapshot returned by DDPG.export_numpy_weights, which fixes the layout
+            version (int): the version of the snapshot, e.g. the number of learner updates
+            ctx (multiprocessing context): the context of the processes that share the weights
+        """
+        self.shapes = [x.shape for x in _weight_arrays(weights)]
+        self.buffer = ctx.RawArray('f', sum(int(np.prod(shape)) for shape in self.shapes))
+        # even while the weights are consistent, odd while they are being written
+        self.sequence = ctx.RawValue('q', 0)
+        self.version = ctx.RawValue('q', version)
+        self.write(weights, version)
+
+    def write(self, weights, version):
+        flat = np.frombuffer(self.buffer, np.float32)
+        self.sequence.value += 1
+        offset = 0
+        for x in _weight_arrays(weights):
+            flat[offset:offset + x.size] = x.ravel()
+            offset += x.size
+        self.version.value = version
+        self.sequence.value += 1
+
+    def read(self, poll_interval=0.001):
+        """Returns the version and a copy of the weights, in the layout read by
+        NumpyPolicy.set_weights (without the critic).
+        """
+        flat = np.frombuffer(self.buffer, np.float32)
+        while True:
+            sequence = self.sequence.value
+            if sequence % 2 == 0:
+                version = self.version.value
+                data = flat.copy()
+                if self.sequence.value == sequence:
+                    break
+            time.sleep(poll_interval)
+
+        arrays, offset = [], 0
+        for shape in self.shapes:
+            size = int(np.prod(shape))
+            arrays.append(data[offset:offset + size].reshape(shape))
+            offset += size
+        pi = [(arrays[i], arrays[i + 1]) for i in range(4, len(arrays), 2)]
+        return version, dict(o_stats=arrays[0:2], g_stats=arrays[2:4], pi=pi, Q=[])
+
+
+def _put(episode_queue, item, stop_event, poll_interval):
+    """Puts item on the queue, waiting while it is full unless the pool is being closed."""
+    while not stop_event.is_set():
+        try:
+            episode_queue.put(item, timeout=poll_interval)
+            return
+        except queue.Full:
+            continue
+
+
+def actor(actor_id, make_worker_payload, rollout_kwargs_payload, shared_weights, episode_queue, stop_event,
+          random_action, counters_buffer, seed, poll_interval):
+    try:
+        counters = np.frombuffer(counters_buffer, np.float64).reshape(-1, 3)
+        np.random.seed(seed)
+        worker = pickle.loads(make_worker_payload)(actor_id)
+        worker.seed(seed)
+        rollout_kwargs = pickle.loads(rollout_kwargs_payload)
+        version = None
+        n = 0
+        while not stop_event.is_set():
+            if shared_weights.version.value != version:
+                version, weights = shared_weights.read()
+                worker.policy.set_weights(weights)
+            kwargs = dict(rollout_kwargs(n), random_action=bool(random_action.value))
+            episode = worker.generate_rollouts(**kwargs)
+            n += 1
+
+            # backpressure: wait while the learner has not taken the queued episodes
+            start = time.time()
+            _put(episode_queue, (actor_id, version, episode), stop_event, poll_interval)
+            counters[actor_id, 0] += 1
+            counters[actor_id, 1] += episode['u'].shape[0] * episode['u'].shape[1]
+            counters[actor_id, 2] += time.time() - start
+    except Exception:
+        _put(episode_queue, (actor_id, None, traceback.format_exc()), stop_event, poll_interval)
+
+
+class ActorPool:
+    def __init__(self, policy, make_worker, rollout_kwargs, n_actors, noise_eps, random_eps, queue_size=None,
+                 exploration_alpha=7., seed=0, history_len=100, poll_interval=0.01):
+        """Runs rollouts in n_actors processes that act with the latest actor weights published by
+        the learner, and streams their episodes back to it through a bounded queue. The actors run
+        NumpyPolicy, so they do not need TensorFlow. They are spawned rather than forked, so that they
+        inherit neither the learner's TensorFlow thread pools nor its MPI runtime.
+
+        As in Ape-X, the i-th actor explores with noise_eps ** (1 + exploration_alpha * i / (n_actors - 1))
+        and random_eps ** (1 + exploration_alpha * i / (n_actors - 1)).
+
+        Args:
+            policy (DDPG): the learner, which publishes its weights and stores the episodes
+            make_worker (function): creates the RolloutWorker of an actor from a NumpyPolicy, its noise_eps
+                and its random_eps
+            rollout_kwargs (function): returns the keyword arguments of generate_rollouts, except
+                random_action, for the n-th rollout of an actor
+            n_actors (int): the number of actor processes
+            noise_eps (float): the exploration noise of the most exploring actor
+            random_eps (float): the random action probability of the most exploring actor
+            queue_size (int): the number of rollouts queued before the actors block (2 * n_actors
+                by default)
+            exploration_alpha (float): how fast the exploration decreases across actors
+            seed (int): the actors use seed + 1000 * (their index + 1)
+            history_len (int): length of the policy lag and return histories
+            poll_interval (float): how often (in seconds) blocked waits check for shutdown or
+                errors of the other side
+        """
+        self.policy = policy
+        self.n_actors = n_actors
+        self.poll_interval = poll_interval
+        self.exploration = []
+        for i in range(n_actors):
+            exponent = 1. + exploration_alpha * i / (n_actors - 1) if n_actors > 1 else 1.
+            self.exploration.append((noise_eps ** exponent, random_eps ** exponent))
+
+        ctx = multiprocessing.get_context('spawn')
+        self.shared_weights = SharedWeights(policy.export_numpy_weights(), policy.n_train_steps, ctx)
+        self.episode_queue = ctx.Queue(queue_size or 2 * n_actors)
+        self.stop_event = ctx.Event()
+        self.random_action = ctx.RawValue('b', 0)
+        # per actor: rollouts, steps and seconds blocked on the full queue
+        self.counters_buffer = ctx.RawArray('d', 3 * n_actors)
+        self.counters = np.frombuffer(self.counters_buffer, np.float64).reshape(n_actors, 3)
+        self.last_counters = self.counters.copy()
+        self.last_logs_time = time.time()
+
+        # learner updates between the weights an episode was generated with and its storage
+        self.policy_lag_history = deque(maxlen=history_len)
+        self.return_history = deque(maxlen=history_len)
+
+        template, exploration = policy.export_numpy_policy(), self.exploration
+
+        def make_actor_worker(actor_id):
+            return make_worker(template, *exploration[actor_id])
+
+        # serialized with cloudpickle, as by CloudpickleWrapper, whose module would make the spawned
+        # actors import TensorFlow
+        make_worker_payload, rollout_kwargs_payload = cloudpickle.dumps(make_actor_worker), cloudpickle.dumps(rollout_kwargs)
+        self.ps = [ctx.Process(
+            target=actor, name='actor_{}'.format(i),
+            args=(i, make_worker_payload, rollout_kwargs_payload, self.shared_weights,
+                  self.episode_queue, self.stop_event, self.random_action, self.counters_buffer,
+                  seed + 1000 * (i + 1), poll_interval))
+            for i in range(n_actors)]
+        for p in self.ps:
+            p.daemon = True  # if the main process crashes, we should not cause things to hang
+            p.start()
+
+    def set_random_action(self, random_action):
+        """Makes the rollouts started from now on act randomly, e.g. during the warmup epochs."""
+        self.random_action.value = int(random_action)
+
+    def publish(self):
+        """Writes the current weights of the learner to shared memory for the next rollouts."""
+        self.shared_weights.write(self.policy.export_numpy_weights(), self.policy.n_train_steps)
+
+    def _get(self, block):
+        actor_id, version, episode = self.episode_queue.get(block=block, timeout=self.poll_interval if block else None)
+        if version is None:
+            raise RuntimeError('actor {} failed:\n{}'.format(actor_id, episode))
+        return version, episode
+
+    def store_episodes(self, min_rollouts=1):
+        """Stores the queued rollouts in the learner's replay buffer, waiting until there are at
+        least min_rollouts, and returns their episodes.
+        """
+        episodes = []
+        while True:
+            try:
+                version, episode = self._get(block=len(episodes) < min_rollouts)
+            except queue.Empty:
+                if len(episodes) >= min_rollouts:
+                    break
+                if not any(p.is_alive() for p in self.ps):
+                    raise RuntimeError('no actor is running')
+                continue
+            self.policy.store_episode(episode)
+            self.policy_lag_history.append(self.policy.n_train_steps - version)
+            self.return_history.append(np.mean(np.sum(episode['myr'] * episode['myv'], axis=1)))
+            episodes.append(episode)
+        return episodes
+
+    def logs(self, prefix='actors'):
+        """Returns the steps per second of each actor and in total, the seconds the actors were
+        blocked by backpressure, the mean policy lag in learner updates and the mean return,
+        since the last call.
+        """
+        now = time.time()
+        counters = self.counters.copy()
+        delta = counters - self.last_counters
+        elapsed = now - self.last_logs_time
+        self.last_counters, self.last_logs_time = counters, now
+
+        logs = [('steps_per_second', delta[:, 1].sum() / elapsed), ('blocked_time', delta[:, 2].sum()),
+                ('policy_lag', np.mean(self.policy_lag_history) if self.policy_lag_history else 0.),
+                ('return', np.mean(self.return_history) if self.return_history else 0.)]
+        for i in range(self.n_actors):
+            logs += [('actor_{}/steps_per_second'.format(i), delta[i, 1] / elapsed),
+                     ('actor_{}/blocked_time'.format(i), delta[i, 2])]
+        return [(prefix + '/' + key, val) for key, val in logs]
+
+    def close(self):
+        """Stops the actors. Episodes still queued are dropped."""
+        self.stop_event.set()
+        while any(p.is_alive() for p in self.ps):
+            # unblock the actors waiting on a full queue
+            try:
+                while True:
+                    self.episode_queue.get_nowait()
+            except queue.Empty:
+                pass
+            for p in self.ps:
+                p.join(timeout=self.poll_interval)
@@ -1,17 +1,22 @@
 from collections import OrderedDict, defaultdict
+import contextlib
 import numpy as np
 import tensorflow as tf
+from mpi4py import MPI
 # from tensorflow.contrib.staging import StagingArea
 from tensorflow.python.ops.data_flow_ops import StagingArea
 from baselines import logger
 from baselines.her.util import (
-    import_function, store_args, flatten_grads, transitions_in_episode_batch, save_weight, load_weight)
-from baselines.her.normalizer import Normalizer
-from baselines.her.replay_buffer import ReplayBuffer
+    import_function, store_args, flatten_grads, save_weight, load_weight)
+from baselines.her.normalizer import Normalizer, synchronize_normalizers
+from baselines.her.numpy_policy import NumpyPolicy
+from baselines.her.replay_buffer import ReplayBuffer, MemmapReplayBuffer, PackedReplayBuffer
+from baselines.her.prefetch import BatchPrefetcher
 from baselines.common.mpi_adam import MpiAdam
 from baselines.common.mpi_sgd import MpiSgd
 import baselines.common.tf_util as U
 import json
+import threading
 from collections import deque
 
 
@@ -19,6 +24,20 @@ def dims_to_shapes(input_dims):
     return {key: tuple([val]) if val > 0 else tuple() for key, val in input_dims.items()}
 
 
+def dims_to_dtypes(input_dims, skill_type):
+    """Storage dtypes for the replay buffer. Binary flags (success infos, dones, valids) and
+    one-hot discrete skills are kept as uint8, everything else as float32.
+    """
+    dtypes = {key: np.float32 for key in input_dims.keys()}
+    for key in input_dims.keys():
+        if key.startswith('info_') and key.lower().endswith('success'):
+            dtypes[key] = np.uint8
+    if skill_type == 'discrete':
+        dtypes['z'] = np.uint8
+    dtypes.update(ag=np.float32, myr=np.float32, myd=np.uint8, myv=np.uint8, s=np.float32)
+    return dtypes
+
+
 class DDPG(object):
     @store_args
     def __init__(
@@ -29,8 +48,10 @@ class DDPG(object):
             finetune_pi, sac, reuse=False, history_len=10000,
             skill_type='discrete', sk_clip=1, et_clip=1, done_ground=0, obj_prior=0, spectral_normalization=0,
             dual_reg=0, dual_init_lambda=1., dual_lam_opt='adam', dual_slack=0., dual_dist='l2',
-            inner=0, algo='csd', sk_lam_lr=0.001,
-            **kwargs
+            inner=0, algo='csd', sk_lam_lr=0.001, replay_buffer='memory', replay_buffer_dir=None,
+            prioritized_replay=0, prioritized_replay_alpha=0.6, prioritized_replay_beta=0.4,
+            sk_r_cache_staleness=None, prefetch_batches=0, replay_eviction='random', optimizer_mode='auto',
+            target_update_interval=0, jit_compile=0, normalizer_sync_interval=1, **kwargs
     ):
         if self.clip_return is None:
             self.clip_return = np.inf
@@ -60,6 +81,14 @@ class DDPG(object):
 
         self.env_name = env_name
 
+        # 'mpi' averages gradients across workers and runs Adam in NumPy, 'graph' applies the updates
+        # in the same session call that computes the gradients, which only works for one worker
+        if optimizer_mode == 'auto':
+            optimizer_mode = 'graph' if MPI.COMM_WORLD.Get_size() == 1 else 'mpi'
+        assert optimizer_mode == 'mpi' or MPI.COMM_WORLD.Get_size() == 1, \
+            "optimizer_mode='graph' does not average gradients across MPI workers"
+        self.optimizer_mode = optimizer_mode
+
         # Prepare staging area for feeding data to the model.
         stage_shapes = OrderedDict()
         for key in sorted(self.input_dims.keys()):
@@ -86,6 +115,7 @@ class DDPG(object):
             self.buffer_ph_tf = [
                 tf.compat.v1.placeholder(tf.float32, shape=shape) for shape in self.stage_shapes.values()]
             self.stage_op = self.staging_tf.put(self.buffer_ph_tf)
+            self.clear_staging_op = self.staging_tf.clear()
 
             self._create_network(pretrain_weights, reuse=reuse)
 
@@ -99,7 +129,45 @@ class DDPG(object):
         buffer_shapes['myv'] = (self.T,)
         buffer_size = (self.buffer_size // self.rollout_batch_size) * self.rollout_batch_size
 
-        self.buffer = ReplayBuffer(buffer_shapes, buffer_size, self.T, self.sample_transitions)
+        buffer_dtypes = dims_to_dtypes(self.input_dims, self.skill_type)
+        # the skill and the goal are fixed for the whole episode
+        constant_keys = ['z', 'g']
+        buffer_params = dict(prioritized=bool(prioritized_replay), alpha=prioritized_replay_alpha,
+                             beta=prioritized_replay_beta, sk_r_cache_staleness=sk_r_cache_staleness,
+                             eviction=replay_eviction)
+        # number of discriminator updates so far, used to tag cached intrinsic rewards
+        self.sk_version = 0
+
+        if replay_buffer == 'memmap':
+            self.buffer = MemmapReplayBuffer(buffer_shapes, buffer_size, self.T, self.sample_transitions, buffer_dtypes,
+                                             constant_keys, storage_dir=replay_buffer_dir, **buffer_params)
+            if self.buffer.resumed:
+                logger.info('Resumed replay buffer from {} with {} episodes'.format(
+                    replay_buffer_dir, self.buffer.get_current_episode_size()))
+                self._update_stats_from_buffer()
+        elif replay_buffer == 'packed':
+            # only the valid steps of each episode are stored, the oldest episodes are evicted first
+            self.buffer = PackedReplayBuffer(buffer_shapes, buffer_size, self.T, self.sample_transitions,
+                                             buffer_dtypes, constant_keys, **dict(buffer_params, eviction='fifo'))
+        else:
+            self.buffer = ReplayBuffer(buffer_shapes, buffer_size, self.T, self.sample_transitions, buffer_dtypes,
+                                       constant_keys, **buffer_params)
+        # buffer keys read by sample_batch: the staged inputs, the achieved goals used by
+        # _preprocess_og and the rewards
+        self.sample_keys = [key for key in self.stage_shapes.keys() if key in buffer_shapes or key in ('o_2', 's')]
+        self.sample_keys += ['ag', 'ag_2', 'myr']
+        # critic/actor updates so far, counted for target_update_interval
+        self.n_train_steps = 0
+        # episodes added to the normalizers since their last synchronization
+        self.n_unsynced_episodes = 0
+        # flat buffer indices and episode generations of the staged batches, consumed in order by train()
+        self.staged_idxs = deque()
+        # started by the first train() call if prefetch_batches > 0
+        self.prefetcher = None
+        # guards the reward histories, which the prefetch thread extends while sampling
+        self.history_lock = threading.Lock()
+        # while-loop graphs of train_cycle, built on first use
+        self.cycle_ops = {}
 
         self.gl_r_history = deque(maxlen=history_len)
         self.sk_r_history = deque(maxlen=history_len)
@@ -124,41 +192,42 @@ class DDPG(object):
         return o, g
 
     def get_actions(self, o, z, ag, g, noise_eps=0., random_eps=0., use_target_net=False, compute_Q=False, exploit=False):
-        o, g = self._preprocess_og(o, ag, g)
-        policy = self.target if use_target_net else self.main
-        # values to compute
-        if self.sac:
-            vals = [policy.mu_tf]
-        else:
-            vals = [policy.pi_tf]
-
-        if compute_Q:
-            vals += [policy.Q_pi_tf]
-
-        feed = {
-            policy.o_tf: o.reshape(-1, self.dimo),
-            policy.z_tf: z.reshape(-1, self.dimz),
-            policy.g_tf: g.reshape(-1, self.dimg),
-            policy.u_tf: np.zeros((o.size // self.dimo, self.dimu), dtype=np.float32)
-        }
-
-        ret = self.sess.run(vals, feed_dict=feed)
+        if self.relative_goals:
+            o, g = self._preprocess_og(o, ag, g)
+        act = self.act_callables[('target' if use_target_net else 'main', compute_Q)]
+        ret = act(o.reshape(-1, self.dimo), z.reshape(-1, self.dimz), g.reshape(-1, self.dimg), noise_eps, random_eps)
 
-        # action postprocessing
-        u = ret[0]
-        noise = noise_eps * self.max_u * np.random.randn(*u.shape)  # gaussian noise
-        u += noise
-        u = np.clip(u, -self.max_u, self.max_u)
-        u += np.random.binomial(1, random_eps, u.shape[0]).reshape(-1, 1) * (self._random_action(u.shape[0]) - u)  # eps-greedy
+        u = ret[0] if compute_Q else ret
         if u.shape[0] == 1:
             u = u[0]
-        u = u.copy()
-        ret[0] = u
 
-        if len(ret) == 1:
-            return ret[0]
+        if compute_Q:
+            return [u, ret[1]]
         else:
-            return ret
+            return u
+
+    def export_numpy_weights(self):
+        """Snapshots the main actor-critic and the normalizer statistics as NumPy arrays, in the
+        layout read by NumpyPolicy. Pass the result to NumpyPolicy.set_weights to refresh a
+        rollout process with the current weights of the learner.
+        """
+        weights = self.sess.run({
+            'o_stats': [self.o_stats.mean, self.o_stats.std],
+            'g_stats': [self.g_stats.mean, self.g_stats.std],
+            'pi': self._vars('main/pi'),
+            'Q': self._vars('main/Q'),
+        })
+        # dense layers are created as kernel, bias pairs
+        for key in ['pi', 'Q']:
+            weights[key] = list(zip(weights[key][::2], weights[key][1::2]))
+        return weights
+
+    def export_numpy_policy(self):
+        """Returns a NumpyPolicy acting like get_actions on the main network without TensorFlow.
+        """
+        return NumpyPolicy(self.export_numpy_weights(), dimo=self.dimo, dimz=self.dimz, dimg=self.dimg,
+                           dimu=self.dimu, max_u=self.max_u, clip_obs=self.clip_obs, norm_clip=self.norm_clip,
+                           sac=self.sac, relative_goals=self.relative_goals, subtract_goals=self.subtract_goals)
 
     def store_episode(self, episode_batch, update_stats=True):
         """
@@ -166,27 +235,41 @@ class DDPG(object):
                        'o' is of size T+1, others are of size T
         """
         
-        episode_batch['s'] = np.empty([episode_batch['o'].shape[0], 1])
+        episode_batch['s'] = np.empty([episode_batch['o'].shape[0], 1], np.float32)
         # #
 
         self.buffer.store_episode(episode_batch, self)
 
         if update_stats:
-            # add transitions to normalizer
-            episode_batch['o_2'] = episode_batch['o'][:, 1:, :]
-            episode_batch['ag_2'] = episode_batch['ag'][:, 1:, :]
-            num_normalizing_transitions = transitions_in_episode_batch(episode_batch)
-            
-            transitions = self.sample_transitions(self, False, episode_batch, num_normalizing_transitions, 0, 0)
-
-            o, o_2, g, ag = transitions['o'], transitions['o_2'], transitions['g'], transitions['ag']
-            transitions['o'], transitions['g'] = self._preprocess_og(o, ag, g)
-
-            self.o_stats.update(transitions['o'])
-            self.g_stats.update(transitions['g'])
+            # add the transitions of the episodes to the normalizers
+            self._update_stats(episode_batch)
+            self.n_unsynced_episodes += episode_batch['o'].shape[0]
+            if self.n_unsynced_episodes >= self.normalizer_sync_interval:
+                self.sync_normalizers()
+
+    def _update_stats(self, episodes):
+        # only the valid steps, as sampled for training, not the padding after done or the steps
+        # masked out by recover_envs
+        valid = episodes['myv'] > 0
+        o, g = self._preprocess_og(episodes['o'][:, :-1][valid], episodes['ag'][:, :-1][valid], episodes['g'][valid])
+        self.o_stats.update(o)
+        self.g_stats.update(g)
+
+    def sync_normalizers(self):
+        """Merges the episodes added since the last synchronization, on all MPI workers, into the
+        normalizer statistics used by the graph.
+        """
+        synchronize_normalizers([self.o_stats, self.g_stats], self.sess)
+        self.n_unsynced_episodes = 0
 
-            self.o_stats.recompute_stats()
-            self.g_stats.recompute_stats()
+    def _update_stats_from_buffer(self, chunk_episodes=1000):
+        """Rebuilds the normalizer statistics from the episodes already held by the replay buffer,
+        chunk_episodes episodes at a time so that a memory-mapped buffer is never loaded at once.
+        """
+        buffers = self.buffer.get_current_buffers()
+        for start in range(0, len(buffers['o']), chunk_episodes):
+            self._update_stats({key: buffers[key][start:start + chunk_episodes] for key in ['o', 'ag', 'g', 'myv']})
+        self.sync_normalizers()
 
     def get_current_buffer_size(self):
         return self.buffer.get_current_size()
@@ -204,6 +287,11 @@ class DDPG(object):
         run_list = [self.main_ir.sk_tf, self.sk_grad_tf]
         if self.dual_reg:
             run_list.extend([self.main_ir.sk_lambda_tf, self.sk_dual_grad_tf])
+        if self.optimizer_mode == 'graph':
+            # apply the updates in the same call instead of fetching the gradients
+            run_list[1] = self.sk_train_op
+            if self.dual_reg:
+                run_list[3] = self.sk_dual_train_op
         result = self.sess.run(run_list, feed_dict={
             self.main_ir.o_tf: o_s_batch, self.main_ir.z_tf: z_s_batch, self.main_ir.o2_tf: o2_s_batch,
             self.main_ir.u_tf: u_s_batch, self.main_ir.is_training: True,
@@ -214,15 +302,16 @@ class DDPG(object):
     def _grads_sk_dist(self, o_s_batch, z_s_batch, o2_s_batch, add_dict):
         feed_dict = {self.main_ir.o_tf: o_s_batch, self.main_ir.z_tf: z_s_batch, self.main_ir.o2_tf: o2_s_batch, self.main_ir.is_training: True}
 
+        sk_dist_grad_tf = self.sk_dist_train_op if self.optimizer_mode == 'graph' else self.sk_dist_grad_tf
         if self.dual_dist == 's2_from_s':
-            sk_dist, sk_dist_grad, sk_cst_dist = self.sess.run([self.main_ir.sk_dist_tf, self.sk_dist_grad_tf, self.main_ir.cst_dist], feed_dict=feed_dict)
+            sk_dist, sk_dist_grad, sk_cst_dist = self.sess.run([self.main_ir.sk_dist_tf, sk_dist_grad_tf, self.main_ir.cst_dist], feed_dict=feed_dict)
         self.info_history['sk_cst_dist'].extend(sk_cst_dist)
         self.info_history['sk_dist'].extend(sk_dist)
 
         return sk_dist, sk_dist_grad
 
     def _grads(self):
-        critic_loss, actor_loss, Q_grad, pi_grad, neg_logp_pi, e_w, log_et_r_scale = self.sess.run([
+        run_list = [
             self.Q_loss_tf,
             self.pi_loss_tf,
             self.Q_grad_tf,
@@ -230,8 +319,12 @@ class DDPG(object):
             self.main.neg_logp_pi_tf,
             self.e_w_tf,
             self.log_et_r_scale_tf,
-        ])
-        return critic_loss, actor_loss, Q_grad, pi_grad, neg_logp_pi, e_w, log_et_r_scale
+        ]
+        if self.optimizer_mode == 'graph':
+            run_list[2:4] = [self.Q_train_op, self.pi_train_op]
+        if self.buffer.prioritized:
+            run_list.append(self.td_priority_tf)
+        return self.sess.run(run_list)
 
     def _update(self, Q_grad, pi_grad):
         self.Q_adam.update(Q_grad, self.Q_lr)
@@ -239,8 +332,12 @@ class DDPG(object):
 
     def sample_batch(self, ir, t):
 
-        transitions = self.buffer.sample(self, ir, self.batch_size, self.sk_r_scale, t)
-        weights = np.ones_like(transitions['r']).copy()
+        transitions = self.buffer.sample(self, ir, self.batch_size, self.sk_r_scale, t, keys=self.sample_keys)
+        if self.buffer.prioritized:
+            weights = transitions['w']
+            self.staged_idxs.append((transitions['idxs'], transitions['generations']))
+        else:
+            weights = np.ones_like(transitions['r']).copy()
         if ir:
             if self.sk_clip:
                 self.sk_r_history.extend(((np.clip(self.sk_r_scale * transitions['s'], *(-1, 0)))*1.00).tolist())
@@ -264,9 +361,12 @@ class DDPG(object):
         assert len(self.buffer_ph_tf) == len(batch)
         self.sess.run(self.stage_op, feed_dict=dict(zip(self.buffer_ph_tf, batch)))
 
-    def run_sk(self, o, z, o2=None, u=None):
+    def run_sk(self, o, z, o2=None, u=None, record=True):
+        """Returns the intrinsic rewards of the given transitions. With dual_reg and record, their
+        constraint values are added to info_history.
+        """
         feed_dict = {self.main_ir.o_tf: o, self.main_ir.z_tf: z, self.main_ir.o2_tf: o2, self.main_ir.u_tf: u, self.main_ir.is_training: True}
-        if self.dual_reg:
+        if self.dual_reg and record:
             sk_r, cst_twoside, cst_oneside = self.sess.run([self.main_ir.sk_r_tf, self.main_ir.cst_twoside, self.main_ir.cst_oneside], feed_dict=feed_dict)
             self.info_history['cst_twoside'].extend(cst_twoside)
             self.info_history['cst_oneside'].extend(cst_oneside)
@@ -276,36 +376,174 @@ class DDPG(object):
 
     def train_sk(self, o_s_batch, z_s_batch, o2_s_batch, u_s_batch, stage=True):
         result = self._grads_sk(o_s_batch, z_s_batch, o2_s_batch, u_s_batch)
-        if self.dual_reg:
-            sk, sk_grad, sk_lambda, sk_dual_grad = result
-            self.sk_dual_opt.update(sk_dual_grad, self.sk_lam_lr)
-        else:
-            sk, sk_grad = result
-        self.sk_adam.update(sk_grad, self.sk_lr)
+        sk = result[0]
+        if self.optimizer_mode != 'graph':
+            if self.dual_reg:
+                sk, sk_grad, sk_lambda, sk_dual_grad = result
+                self.sk_dual_opt.update(sk_dual_grad, self.sk_lam_lr)
+            else:
+                sk, sk_grad = result
+            self.sk_adam.update(sk_grad, self.sk_lr)
+        self.sk_version += 1
         return -sk.mean()
 
     def train_sk_dist(self, o_s_batch, z_s_batch, o2_s_batch, add_dict, stage=True):
         sk_dist, sk_dist_grad = self._grads_sk_dist(o_s_batch, z_s_batch, o2_s_batch, add_dict)
-        self.sk_dist_adam.update(sk_dist_grad, self.sk_lr)
+        if self.optimizer_mode != 'graph':
+            self.sk_dist_adam.update(sk_dist_grad, self.sk_lr)
         return -sk_dist.mean()
 
+    def sample_discriminator_batch(self, batch_size, critic_batch=None):
+        """Returns an (o, z, o_2, u) minibatch for train_discriminators. It holds the transitions of
+        critic_batch, as returned by sample_batch, if given, and otherwise batch_size transitions
+        drawn uniformly by the replay buffer's sampler.
+        """
+        keys = ['o', 'z', 'o_2', 'u']
+        if critic_batch is not None:
+            stage_keys = list(self.stage_shapes.keys())
+            return tuple(critic_batch[stage_keys.index(key)] for key in keys)
+        transitions = self.buffer.sample(self, False, batch_size, 0, 0, keys=keys, uniform=True)
+        return tuple(transitions[key] for key in keys)
+
+    def train_discriminators(self, batch, train_sk=True):
+        """Applies the updates of train_sk and train_sk_dist to the (o, z, o_2, u) minibatch `batch`
+        in one session call. If train_sk is unset, only the distance model is updated.
+
+        Returns a dict with the losses returned by train_sk ('sk_loss') and train_sk_dist
+        ('sk_dist_loss'), the dual variable objective ('sk_lambda') and, per transition, the
+        distances recorded in info_history ('sk_dist', 'sk_cst_dist') and the constraint values
+        ('cst_twoside', 'cst_oneside'), for the updates that ran.
+        """
+        o, z, o_2, u = batch
+        graph = self.optimizer_mode == 'graph'
+        train_sk_dist = self.dual_reg and self.dual_dist != 'l2'
+        run_list = {}
+        if train_sk:
+            run_list['sk'] = self.main_ir.sk_tf
+            run_list['sk_grad'] = self.sk_train_op if graph else self.sk_grad_tf
+            if self.dual_reg:
+                run_list['sk_lambda'] = self.main_ir.sk_lambda_tf
+                run_list['sk_dual_grad'] = self.sk_dual_train_op if graph else self.sk_dual_grad_tf
+                run_list['cst_twoside'] = self.main_ir.cst_twoside
+                run_list['cst_oneside'] = self.main_ir.cst_oneside
+        if train_sk_dist:
+            run_list['sk_dist'] = self.main_ir.sk_dist_tf
+            run_list['sk_cst_dist'] = self.main_ir.cst_dist
+            if graph:
+                # the distance model is updated only after the discriminator loss has been computed
+                run_list['sk_dist_grad'] = self.sk_dist_after_sk_train_op if train_sk else self.sk_dist_train_op
+            else:
+                run_list['sk_dist_grad'] = self.sk_dist_grad_tf
+        if not run_list:
+            return {}
+
+        result = self.sess.run(run_list, feed_dict={
+            self.main_ir.o_tf: o, self.main_ir.z_tf: z, self.main_ir.o2_tf: o_2, self.main_ir.u_tf: u,
+            self.main_ir.is_training: True,
+        })
+
+        if not graph:
+            if train_sk:
+                if self.dual_reg:
+                    self.sk_dual_opt.update(result['sk_dual_grad'], self.sk_lam_lr)
+                self.sk_adam.update(result['sk_grad'], self.sk_lr)
+            if train_sk_dist:
+                self.sk_dist_adam.update(result['sk_dist_grad'], self.sk_lr)
+        stats = {key: result[key] for key in ['sk_lambda', 'cst_twoside', 'cst_oneside', 'sk_dist', 'sk_cst_dist']
+                 if key in result}
+        if train_sk:
+            stats['sk_loss'] = -result['sk'].mean()
+            self.sk_version += 1
+        if train_sk_dist:
+            stats['sk_dist_loss'] = -result['sk_dist'].mean()
+            self.info_history['sk_cst_dist'].extend(result['sk_cst_dist'])
+            self.info_history['sk_dist'].extend(result['sk_dist'])
+        return stats
+
+    def start_prefetch(self):
+        """Starts sampling and staging batches on a background thread, prefetch_batches ahead.
+        """
+        if self.prefetcher is None:
+            self.prefetcher = BatchPrefetcher(self, self.prefetch_batches)
+
+    def stop_prefetch(self):
+        """Stops the prefetch thread and drops the batches it staged but train() did not use.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+            self.sess.run(self.clear_staging_op)
+            self.staged_idxs.clear()
+
     def train(self, t, stage=True):
         if not self.buffer.current_size==0:
-            if stage:
+            if self.prefetch_batches > 0:
+                self.start_prefetch()
+                self.prefetcher.acquire(t)
+            elif stage:
                 self.stage_batch(ir=True, t=t)
-            critic_loss, actor_loss, Q_grad, pi_grad, neg_logp_pi, e_w, log_et_r_scale = self._grads()
-            self.info_history['critic_loss'].extend([critic_loss] * neg_logp_pi.shape[0])
-            self.info_history['actor_loss'].extend([actor_loss] * neg_logp_pi.shape[0])
-            self._update(Q_grad, pi_grad)
-            et_r_scale = np.exp(log_et_r_scale)
-            if self.et_clip:
-                self.et_r_history.extend((( np.clip((et_r_scale * neg_logp_pi), *(-1, 0))) * e_w ).tolist())
-            else:
-                self.et_r_history.extend((( et_r_scale * neg_logp_pi) * e_w ).tolist())
-            self.et_r_scale_current = et_r_scale
-            self.logp_current = -neg_logp_pi.mean()
+            result = self._grads()
+            if self.prefetcher is not None:
+                self.prefetcher.release()
+            critic_loss, actor_loss, Q_grad, pi_grad, neg_logp_pi, e_w, log_et_r_scale = result[:7]
+            if self.buffer.prioritized:
+                idxs, generations = self.staged_idxs.popleft()
+                self.buffer.update_priorities(idxs, result[7], generations)
+            if self.optimizer_mode != 'graph':
+                self._update(Q_grad, pi_grad)
+            self._record_train_step(critic_loss, actor_loss, neg_logp_pi, e_w, log_et_r_scale)
+            self.n_train_steps += 1
+            if self.target_update_interval and self.n_train_steps % self.target_update_interval == 0:
+                self.update_target_net()
             return critic_loss, actor_loss
 
+    def _record_train_step(self, critic_loss, actor_loss, neg_logp_pi, e_w, log_et_r_scale):
+        self.info_history['critic_loss'].extend([critic_loss] * neg_logp_pi.shape[0])
+        self.info_history['actor_loss'].extend([actor_loss] * neg_logp_pi.shape[0])
+        et_r_scale = np.exp(log_et_r_scale)
+        if self.et_clip:
+            self.et_r_history.extend((( np.clip((et_r_scale * neg_logp_pi), *(-1, 0))) * e_w ).tolist())
+        else:
+            self.et_r_history.extend((( et_r_scale * neg_logp_pi) * e_w ).tolist())
+        self.et_r_scale_current = et_r_scale
+        self.logp_current = -neg_logp_pi.mean()
+
+    def train_cycle(self, batches, sk_batches=None, update_target=True):
+        """Runs one critic/actor update per batch in `batches`, as returned by sample_batch, in a
+        single session call. sk_batches optionally holds one (o, z, o_2, u) discriminator batch per
+        critic batch; the discriminator and its distance model are then updated in the same steps.
+        If update_target is set, the target network is updated once after the last step; with
+        target_update_interval > 0 it is also updated after every target_update_interval-th step.
+
+        Only available with optimizer_mode='graph'. Returns the critic and actor losses of every step.
+        """
+        assert self.optimizer_mode == 'graph', "train_cycle requires optimizer_mode='graph'"
+        train_sk = sk_batches is not None
+        if (train_sk, update_target) not in self.cycle_ops:
+            self.cycle_ops[(train_sk, update_target)] = self._create_cycle(train_sk, update_target)
+        cycle = self.cycle_ops[(train_sk, update_target)]
+
+        feed_dict = {ph: np.stack(values) for ph, values in zip(cycle['batch_ph'], zip(*batches))}
+        feed_dict[cycle['n_train_steps_ph']] = self.n_train_steps
+        if train_sk:
+            assert len(sk_batches) == len(batches)
+            feed_dict.update({ph: np.stack(values) for ph, values in zip(cycle['sk_batch_ph'], zip(*sk_batches))})
+        result = self.sess.run(cycle['outputs'], feed_dict=feed_dict)
+
+        for k in range(len(batches)):
+            if self.buffer.prioritized:
+                idxs, generations = self.staged_idxs.popleft()
+                self.buffer.update_priorities(idxs, result['td_priority'][k], generations)
+            self._record_train_step(result['critic_loss'][k], result['actor_loss'][k], result['neg_logp_pi'][k],
+                                    result['e_w'][k], result['log_et_r_scale'][k])
+        if train_sk:
+            if 'sk_dist' in result:
+                self.info_history['sk_cst_dist'].extend(result['sk_cst_dist'].ravel())
+                self.info_history['sk_dist'].extend(result['sk_dist'].ravel())
+            self.sk_version += len(batches)
+        self.n_train_steps += len(batches)
+        return result['critic_loss'], result['actor_loss']
+
     def _init_target_net(self):
         self.sess.run(self.init_target_net_op)
 
@@ -324,42 +562,31 @@ class DDPG(object):
         res = tf.compat.v1.get_collection(tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope=self.scope + '/' + scope)
         return res
 
-    def _create_network(self, pretrain_weights, reuse=False):
-        if self.sac:
-            logger.info("Creating a SAC agent with action space %d x %s..." % (self.dimu, self.max_u))
-        else:
-            logger.info("Creating a DDPG agent with action space %d x %s..." % (self.dimu, self.max_u))
-
-        self.sess = tf.compat.v1.get_default_session()
-        if self.sess is None:
-            self.sess = tf.compat.v1.InteractiveSession()
-
-        # running averages
-        with tf.compat.v1.variable_scope('o_stats') as vs:
-            if reuse:
-                vs.reuse_variables()
-            self.o_stats = Normalizer(self.dimo, self.norm_eps, self.norm_clip, sess=self.sess)
-        with tf.compat.v1.variable_scope('g_stats') as vs:
-            if reuse:
-                vs.reuse_variables()
-            self.g_stats = Normalizer(self.dimg, self.norm_eps, self.norm_clip, sess=self.sess)
+    def _apply_op(self, optimizer, grads, var_list, fetches):
+        """Returns an op applying `grads` with `optimizer` once every tensor in `fetches` has been
+        computed, so that the other outputs of the same session call see the old parameters.
+        """
+        with tf.control_dependencies(fetches):
+            grads = [tf.identity(grad) for grad in grads]
+        return optimizer.apply_gradients(zip(grads, var_list))
 
-        # mini-batch sampling.
-        batch = self.staging_tf.get()
+    def _create_batch_tf(self, batch):
         batch_tf = OrderedDict([(key, batch[i])
                                 for i, key in enumerate(self.stage_shapes.keys())])
         batch_tf['r'] = tf.reshape(batch_tf['r'], [-1, 1])
         batch_tf['w'] = tf.reshape(batch_tf['w'], [-1, 1])
         batch_tf['s'] = tf.reshape(batch_tf['s'], [-1, 1])
         batch_tf['myd'] = tf.reshape(batch_tf['myd'], [-1, 1])
+        return batch_tf
 
-        self.o_tau_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, None, self.dimo))
-
-        # networks
+    def _create_networks(self, batch_tf, sk_inputs_tf=None, reuse=False, discriminator=True):
+        """Creates the main and target actor-critics on batch_tf and, if discriminator is set, the
+        discriminator, which reads sk_inputs_tf if given and its own placeholders otherwise.
+        """
         with tf.compat.v1.variable_scope('main') as vs:
             if reuse:
                 vs.reuse_variables()
-            self.main = self.create_actor_critic(batch_tf, net_type='main', **self.__dict__)
+            main = self.create_actor_critic(batch_tf, net_type='main', **self.__dict__)
             vs.reuse_variables()
         with tf.compat.v1.variable_scope('target') as vs:
             if reuse:
@@ -367,91 +594,301 @@ class DDPG(object):
             target_batch_tf = batch_tf.copy()
             target_batch_tf['o'] = batch_tf['o_2']
             target_batch_tf['g'] = batch_tf['g_2']
-            self.target = self.create_actor_critic(
+            target = self.create_actor_critic(
                 target_batch_tf, net_type='target', **self.__dict__)
             vs.reuse_variables()
-        assert len(self._vars("main")) == len(self._vars("target"))
 
         # intrinsic reward (ir) network for mutual information
-        with tf.compat.v1.variable_scope('ir') as vs:
-            if reuse:
+        main_ir = None
+        if discriminator:
+            with tf.compat.v1.variable_scope('ir') as vs:
+                if reuse:
+                    vs.reuse_variables()
+                main_ir = self.create_discriminator(batch_tf, net_type='ir', sk_inputs_tf=sk_inputs_tf, **self.__dict__)
                 vs.reuse_variables()
-            self.main_ir = self.create_discriminator(batch_tf, net_type='ir', **self.__dict__)
-            vs.reuse_variables()
-
-        # loss functions
-        sk_grads_tf = tf.gradients(ys=tf.reduce_mean(input_tensor=self.main_ir.sk_tf), xs=self._vars('ir/skill_ds'))
-        assert len(self._vars('ir/skill_ds')) == len(sk_grads_tf)
-        self.sk_grads_vars_tf = zip(sk_grads_tf, self._vars('ir/skill_ds'))  # Seems not used
-        self.sk_grad_tf = flatten_grads(grads=sk_grads_tf, var_list=self._vars('ir/skill_ds'))
-        self.sk_adam = MpiAdam(self._vars('ir/skill_ds'), scale_grad_by_procs=False)
+        return main, target, main_ir
 
-        if self.dual_reg:
-            sk_dual_grads_tf = tf.gradients(ys=tf.reduce_mean(input_tensor=self.main_ir.sk_lambda_tf), xs=self._vars('ir/skill_dual'))
-            assert len(self._vars('ir/skill_dual')) == len(sk_dual_grads_tf)
-            self.sk_dual_grad_tf = flatten_grads(grads=sk_dual_grads_tf, var_list=self._vars('ir/skill_dual'))
-            if self.dual_lam_opt == 'adam':
-                self.sk_dual_opt = MpiAdam(self._vars('ir/skill_dual'), scale_grad_by_procs=False)
-            else:
-                self.sk_dual_opt = MpiSgd(self._vars('ir/skill_dual'), scale_grad_by_procs=False)
-
-            if self.dual_dist != 'l2':
-                sk_dist_grads_tf = tf.gradients(ys=tf.reduce_mean(input_tensor=self.main_ir.sk_dist_tf), xs=self._vars('ir/skill_dist'))
-                assert len(self._vars('ir/skill_dist')) == len(sk_dist_grads_tf)
-                self.sk_dist_grad_tf = flatten_grads(grads=sk_dist_grads_tf, var_list=self._vars('ir/skill_dist'))
-                self.sk_dist_adam = MpiAdam(self._vars('ir/skill_dist'), scale_grad_by_procs=False)
+    def _create_losses(self, batch_tf, main, target, main_ir):
+        """Returns a dict with the critic and actor losses on batch_tf, the TD errors and the
+        gradients of all losses. The discriminator gradients are left out if main_ir is None.
+        """
+        losses = {}
+        if main_ir is not None:
+            losses['sk_grads'] = tf.gradients(ys=tf.reduce_mean(input_tensor=main_ir.sk_tf), xs=self._vars('ir/skill_ds'))
+            assert len(self._vars('ir/skill_ds')) == len(losses['sk_grads'])
+            if self.dual_reg:
+                losses['sk_dual_grads'] = tf.gradients(ys=tf.reduce_mean(input_tensor=main_ir.sk_lambda_tf), xs=self._vars('ir/skill_dual'))
+                assert len(self._vars('ir/skill_dual')) == len(losses['sk_dual_grads'])
+                if self.dual_dist != 'l2':
+                    losses['sk_dist_grads'] = tf.gradients(ys=tf.reduce_mean(input_tensor=main_ir.sk_dist_tf), xs=self._vars('ir/skill_dist'))
+                    assert len(self._vars('ir/skill_dist')) == len(losses['sk_dist_grads'])
 
-        target_Q_pi_tf = self.target.Q_pi_tf
+        target_Q_pi_tf = target.Q_pi_tf
         clip_range = (-self.clip_return, self.clip_return if self.clip_pos_returns else np.inf)
 
-        self.e_w_tf = batch_tf['e_w']
+        e_w_tf = losses['e_w'] = batch_tf['e_w']
 
         if not self.sac:
-            self.main.neg_logp_pi_tf = tf.zeros(1)
+            main.neg_logp_pi_tf = tf.zeros(1)
 
         et_r_scale_init = tf.constant_initializer(np.log(self.et_r_scale))
         self.log_et_r_scale_tf = tf.compat.v1.get_variable('alpha/log_et_r_scale', (), tf.float32, initializer=et_r_scale_init)
         et_r_scale = tf.exp(self.log_et_r_scale_tf)
         target_tf = tf.clip_by_value(self.r_scale * batch_tf['r'] * batch_tf['r_w']
                                      + (tf.clip_by_value( self.sk_r_scale * batch_tf['s'], *(-1, 0)) if self.sk_clip else self.sk_r_scale * batch_tf['s']) * batch_tf['s_w']
-                                     + (tf.clip_by_value( et_r_scale * self.main.neg_logp_pi_tf, *(-1, 0)) if self.et_clip else et_r_scale * self.main.neg_logp_pi_tf) * self.e_w_tf
+                                     + (tf.clip_by_value( et_r_scale * main.neg_logp_pi_tf, *(-1, 0)) if self.et_clip else et_r_scale * main.neg_logp_pi_tf) * e_w_tf
                                      + (self.gamma * target_Q_pi_tf * (1 - batch_tf['myd']) if self.done_ground else self.gamma * target_Q_pi_tf), *clip_range)
 
-        self.td_error_tf = tf.stop_gradient(target_tf) - self.main.Q_tf
-        self.errors_tf = tf.square(self.td_error_tf)
-        self.errors_tf = tf.reduce_mean(input_tensor=batch_tf['w'] * self.errors_tf)
-        self.Q_loss_tf = tf.reduce_mean(input_tensor=self.errors_tf)
+        td_error_tf = losses['td_error'] = tf.stop_gradient(target_tf) - main.Q_tf
+        # per-transition priority; the SAC entropy term broadcasts the target to batch x batch, so
+        # average the absolute error over every axis but the first
+        losses['td_priority'] = tf.reduce_mean(input_tensor=tf.abs(td_error_tf), axis=1)
+        errors_tf = tf.square(td_error_tf)
+        errors_tf = tf.reduce_mean(input_tensor=batch_tf['w'] * errors_tf)
+        Q_loss_tf = losses['Q_loss'] = tf.reduce_mean(input_tensor=errors_tf)
+
+        pi_loss_tf = -tf.reduce_mean(input_tensor=main.Q_pi_tf)
+        pi_loss_tf += self.action_l2 * tf.reduce_mean(input_tensor=tf.square(main.pi_tf / self.max_u))
+        losses['pi_loss'] = pi_loss_tf
+
+        losses['Q_grads'] = tf.gradients(ys=Q_loss_tf, xs=self._vars('main/Q'))
+        losses['pi_grads'] = tf.gradients(ys=pi_loss_tf, xs=self._vars('main/pi'))
+        assert len(self._vars('main/Q')) == len(losses['Q_grads'])
+        assert len(self._vars('main/pi')) == len(losses['pi_grads'])
+        return losses
+
+    def _create_train_ops(self, losses, main_ir, main=None, sk_dist_deps=()):
+        """Returns a dict with the ops applying the gradients in `losses` with the in-graph
+        optimizers. Every op waits for all the tensors fetched by the train method it belongs to;
+        the distance model update also waits for sk_dist_deps.
+        """
+        main = main or self.main
+        train_ops = {}
+        fetches_tf = losses['Q_grads'] + losses['pi_grads'] + [
+            losses['Q_loss'], losses['pi_loss'], main.neg_logp_pi_tf, losses['e_w'], losses['td_priority']]
+        train_ops['Q'] = self._apply_op(self.graph_optimizers['Q'], losses['Q_grads'], self._vars('main/Q'), fetches_tf)
+        train_ops['pi'] = self._apply_op(self.graph_optimizers['pi'], losses['pi_grads'], self._vars('main/pi'), fetches_tf)
+        if main_ir is None:
+            return train_ops
+
+        sk_fetches_tf = losses['sk_grads'] + [main_ir.sk_tf]
+        if self.dual_reg:
+            sk_fetches_tf += losses['sk_dual_grads'] + [main_ir.sk_lambda_tf]
+        train_ops['sk'] = self._apply_op(self.graph_optimizers['sk'], losses['sk_grads'], self._vars('ir/skill_ds'), sk_fetches_tf)
+        if self.dual_reg:
+            train_ops['sk_dual'] = self._apply_op(
+                self.graph_optimizers['sk_dual'], losses['sk_dual_grads'], self._vars('ir/skill_dual'), sk_fetches_tf)
+            if self.dual_dist != 'l2':
+                train_ops['sk_dist'] = self._apply_op(
+                    self.graph_optimizers['sk_dist'], losses['sk_dist_grads'], self._vars('ir/skill_dist'),
+                    losses['sk_dist_grads'] + [main_ir.sk_dist_tf, main_ir.cst_dist] + list(sk_dist_deps))
+        return train_ops
+
+    def _create_cycle(self, train_sk, update_target):
+        """Builds the graph run by train_cycle: a while loop that gathers the i-th batch from
+        stacked placeholders and applies the same updates as train, train_sk and train_sk_dist.
+        Each step reads the variables only after the updates of the previous step.
+        """
+        train_sk_dist = train_sk and self.dual_reg and self.dual_dist != 'l2'
+        names = ['critic_loss', 'actor_loss', 'neg_logp_pi', 'e_w', 'log_et_r_scale', 'td_priority']
+        if train_sk_dist:
+            names += ['sk_dist', 'sk_cst_dist']
+
+        with tf.compat.v1.variable_scope(self.scope, reuse=True):
+            batch_ph = [tf.compat.v1.placeholder(tf.float32, shape=(None,) + tuple(shape))
+                        for shape in self.stage_shapes.values()]
+            sk_batch_ph = [tf.compat.v1.placeholder(tf.float32, shape=(None, None, dim))
+                           for dim in (self.dimo, self.dimz, self.dimo, self.dimu)]
+            n_steps_tf = tf.shape(input=batch_ph[0])[0]
+            n_train_steps_ph = tf.compat.v1.placeholder(tf.int32, shape=())
+
+            def body(i, *arrays):
+                with tf.control_dependencies([i]):
+                    batch_tf = self._create_batch_tf([ph[i] for ph in batch_ph])
+                    sk_inputs_tf = None
+                    if train_sk:
+                        sk_inputs_tf = dict(zip(['o', 'z', 'o_2', 'u'], [ph[i] for ph in sk_batch_ph]))
+                        sk_inputs_tf['is_training'] = tf.constant(True)
+                    main, target, main_ir = self._create_networks(batch_tf, sk_inputs_tf, reuse=True, discriminator=train_sk)
+                    losses = self._create_losses(batch_tf, main, target, main_ir)
+                    # as in train_sk followed by train_sk_dist, the distance model changes only after
+                    # the discriminator loss has been computed
+                    sk_fetches_tf = []
+                    if train_sk:
+                        sk_fetches_tf = [main_ir.sk_tf] + ([main_ir.sk_lambda_tf] if self.dual_reg else [])
+                    train_ops = self._create_train_ops(losses, main_ir, main, sk_dist_deps=sk_fetches_tf)
+                    applies = list(train_ops.values())
+                    values = [losses['Q_loss'], losses['pi_loss'], main.neg_logp_pi_tf, losses['e_w'],
+                              self.log_et_r_scale_tf, losses['td_priority']]
+                    if train_sk_dist:
+                        values += [main_ir.sk_dist_tf, main_ir.cst_dist]
+                    arrays = [array.write(i, value) for array, value in zip(arrays, values)]
+                if self.target_update_interval:
+                    with tf.control_dependencies(applies):
+                        is_update_step = tf.equal((n_train_steps_ph + i + 1) % self.target_update_interval, 0)
+                        applies = [tf.cond(pred=is_update_step, true_fn=self._create_target_update, false_fn=tf.no_op)]
+                with tf.control_dependencies(applies):
+                    return [i + 1] + arrays
+
+            arrays = [tf.TensorArray(tf.float32, size=n_steps_tf) for _ in names]
+            loop_vars = tf.while_loop(
+                cond=lambda i, *arrays: i < n_steps_tf, body=body, loop_vars=[tf.constant(0)] + arrays,
+                parallel_iterations=1)
+            outputs = {name: array.stack() for name, array in zip(names, loop_vars[1:])}
+            if update_target:
+                with tf.control_dependencies([loop_vars[0]] + list(outputs.values())):
+                    outputs['update_target'] = self._create_target_update()
+        return dict(batch_ph=batch_ph, sk_batch_ph=sk_batch_ph, n_train_steps_ph=n_train_steps_ph, outputs=outputs)
+
+    def _create_actor(self, net_type, inputs_tf):
+        """Builds the policy of get_actions on the o, z and g placeholders in inputs_tf, followed by
+        the observation clipping of _preprocess_og and the exploration noise scaled by the
+        noise_eps and random_eps placeholders. Returns the action and the Q value of the policy.
+        """
+        o_tf, z_tf, g_tf, noise_eps_tf, random_eps_tf = inputs_tf
+        act_inputs_tf = {
+            'o': tf.clip_by_value(o_tf, -self.clip_obs, self.clip_obs), 'z': z_tf,
+            'g': tf.clip_by_value(g_tf, -self.clip_obs, self.clip_obs),
+            # only read by Q_tf, which is not evaluated
+            'u': tf.zeros([tf.shape(input=o_tf)[0], self.dimu]),
+        }
+        with tf.compat.v1.variable_scope(net_type, reuse=True):
+            policy = self.create_actor_critic(act_inputs_tf, net_type=net_type, **self.__dict__)
+
+        u_tf = policy.mu_tf if self.sac else policy.pi_tf
+        u_tf += noise_eps_tf * self.max_u * tf.random.normal(tf.shape(input=u_tf))  # gaussian noise
+        u_tf = tf.clip_by_value(u_tf, -self.max_u, self.max_u)
+        random_u_tf = tf.random.uniform(tf.shape(input=u_tf), -self.max_u, self.max_u)
+        is_random_tf = tf.cast(tf.random.uniform([tf.shape(input=u_tf)[0], 1]) < random_eps_tf, tf.float32)
+        u_tf += is_random_tf * (random_u_tf - u_tf)  # eps-greedy
+        return u_tf, policy.Q_pi_tf
+
+    def _jit_scope(self):
+        """Marks the ops created in this scope for XLA compilation if jit_compile is set. The
+        marked ops of one session call are compiled into clusters the first time it is run.
+        Variable initializers are left to TF, so that XLA's random number generator does not
+        change the initial weights. The loop of train_cycle is not compiled.
+        """
+        if self.jit_compile:
+            return tf.xla.experimental.jit_scope(compile_ops=lambda node_def: '/Initializer/' not in node_def.name)
+        return contextlib.nullcontext()
 
-        self.pi_loss_tf = -tf.reduce_mean(input_tensor=self.main.Q_pi_tf)
-        self.pi_loss_tf += self.action_l2 * tf.reduce_mean(input_tensor=tf.square(self.main.pi_tf / self.max_u))
+    def _create_target_update(self):
+        """Returns one op moving every target variable towards its main counterpart in place.
+        """
+        return tf.group(*[v[0].assign_add((1. - self.polyak) * (v[1] - v[0]))
+                          for v in zip(self.target_vars, self.main_vars)])
 
-        Q_grads_tf = tf.gradients(ys=self.Q_loss_tf, xs=self._vars('main/Q'))
-        pi_grads_tf = tf.gradients(ys=self.pi_loss_tf, xs=self._vars('main/pi'))
-        assert len(self._vars('main/Q')) == len(Q_grads_tf)
-        assert len(self._vars('main/pi')) == len(pi_grads_tf)
-        self.Q_grads_vars_tf = zip(Q_grads_tf, self._vars('main/Q'))
-        self.pi_grads_vars_tf = zip(pi_grads_tf, self._vars('main/pi'))
-        self.Q_grad_tf = flatten_grads(grads=Q_grads_tf, var_list=self._vars('main/Q'))
-        self.pi_grad_tf = flatten_grads(grads=pi_grads_tf, var_list=self._vars('main/pi'))
+    def _create_network(self, pretrain_weights, reuse=False):
+        if self.sac:
+            logger.info("Creating a SAC agent with action space %d x %s..." % (self.dimu, self.max_u))
+        else:
+            logger.info("Creating a DDPG agent with action space %d x %s..." % (self.dimu, self.max_u))
+
+        self.sess = tf.compat.v1.get_default_session()
+        if self.sess is None:
+            self.sess = tf.compat.v1.InteractiveSession()
+
+        # running averages
+        with tf.compat.v1.variable_scope('o_stats') as vs:
+            if reuse:
+                vs.reuse_variables()
+            self.o_stats = Normalizer(self.dimo, self.norm_eps, self.norm_clip, sess=self.sess)
+        with tf.compat.v1.variable_scope('g_stats') as vs:
+            if reuse:
+                vs.reuse_variables()
+            self.g_stats = Normalizer(self.dimg, self.norm_eps, self.norm_clip, sess=self.sess)
+
+        # mini-batch sampling.
+        batch_tf = self._create_batch_tf(self.staging_tf.get())
+
+        self.o_tau_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, None, self.dimo))
+
+        # networks
+        with self._jit_scope():
+            self.main, self.target, self.main_ir = self._create_networks(batch_tf, reuse=reuse)
+        assert len(self._vars("main")) == len(self._vars("target"))
+
+        # loss functions
+        with self._jit_scope():
+            losses = self._create_losses(batch_tf, self.main, self.target, self.main_ir)
+        self.sk_grads_vars_tf = zip(losses['sk_grads'], self._vars('ir/skill_ds'))  # Seems not used
+        self.sk_grad_tf = flatten_grads(grads=losses['sk_grads'], var_list=self._vars('ir/skill_ds'))
+        self.sk_adam = MpiAdam(self._vars('ir/skill_ds'), scale_grad_by_procs=False)
+        if self.dual_reg:
+            self.sk_dual_grad_tf = flatten_grads(grads=losses['sk_dual_grads'], var_list=self._vars('ir/skill_dual'))
+            if self.dual_lam_opt == 'adam':
+                self.sk_dual_opt = MpiAdam(self._vars('ir/skill_dual'), scale_grad_by_procs=False)
+            else:
+                self.sk_dual_opt = MpiSgd(self._vars('ir/skill_dual'), scale_grad_by_procs=False)
+            if self.dual_dist != 'l2':
+                self.sk_dist_grad_tf = flatten_grads(grads=losses['sk_dist_grads'], var_list=self._vars('ir/skill_dist'))
+                self.sk_dist_adam = MpiAdam(self._vars('ir/skill_dist'), scale_grad_by_procs=False)
+
+        self.e_w_tf = losses['e_w']
+        self.td_error_tf = losses['td_error']
+        self.td_priority_tf = losses['td_priority']
+        self.Q_loss_tf = losses['Q_loss']
+        self.pi_loss_tf = losses['pi_loss']
+        self.Q_grads_vars_tf = zip(losses['Q_grads'], self._vars('main/Q'))
+        self.pi_grads_vars_tf = zip(losses['pi_grads'], self._vars('main/pi'))
+        self.Q_grad_tf = flatten_grads(grads=losses['Q_grads'], var_list=self._vars('main/Q'))
+        self.pi_grad_tf = flatten_grads(grads=losses['pi_grads'], var_list=self._vars('main/pi'))
 
         # optimizers
         self.Q_adam = MpiAdam(self._vars('main/Q'), scale_grad_by_procs=False)
         self.pi_adam = MpiAdam(self._vars('main/pi'), scale_grad_by_procs=False)
+        if self.optimizer_mode == 'graph':
+            self.graph_optimizers = {
+                'Q': tf.compat.v1.train.AdamOptimizer(self.Q_lr),
+                'pi': tf.compat.v1.train.AdamOptimizer(self.pi_lr),
+                'sk': tf.compat.v1.train.AdamOptimizer(self.sk_lr),
+                'sk_dual': (tf.compat.v1.train.AdamOptimizer(self.sk_lam_lr) if self.dual_lam_opt == 'adam'
+                            else tf.compat.v1.train.GradientDescentOptimizer(self.sk_lam_lr)),
+                'sk_dist': tf.compat.v1.train.AdamOptimizer(self.sk_lr),
+            }
+            with self._jit_scope():
+                train_ops = self._create_train_ops(losses, self.main_ir)
+            self.Q_train_op = train_ops['Q']
+            self.pi_train_op = train_ops['pi']
+            self.sk_train_op = train_ops['sk']
+            if self.dual_reg:
+                self.sk_dual_train_op = train_ops['sk_dual']
+                if self.dual_dist != 'l2':
+                    self.sk_dist_train_op = train_ops['sk_dist']
+                    # for train_discriminators, which also updates the discriminator in the same call
+                    sk_fetches_tf = losses['sk_grads'] + losses['sk_dual_grads'] + [
+                        self.main_ir.sk_tf, self.main_ir.sk_lambda_tf]
+                    with self._jit_scope():
+                        self.sk_dist_after_sk_train_op = self._apply_op(
+                            self.graph_optimizers['sk_dist'], losses['sk_dist_grads'], self._vars('ir/skill_dist'),
+                            losses['sk_dist_grads'] + [self.main_ir.sk_dist_tf, self.main_ir.cst_dist] + sk_fetches_tf)
 
         self.main_vars = self._vars('main/Q') + self._vars('main/pi')
         self.target_vars = self._vars('target/Q') + self._vars('target/pi')
 
-        # polyak averaging
+        # polyak averaging, grouped so that a call neither fetches the new values nor launches one op
+        # per variable from Python
         self.stats_vars = self._global_vars('o_stats') + self._global_vars('g_stats')
-        self.init_target_net_op = list(
-            map(lambda v: v[0].assign(v[1]), zip(self.target_vars, self.main_vars)))
-        self.update_target_net_op = list(
-            map(lambda v: v[0].assign(self.polyak * v[0] + (1. - self.polyak) * v[1]), zip(self.target_vars, self.main_vars)))
+        self.init_target_net_op = tf.group(*[v[0].assign(v[1]) for v in zip(self.target_vars, self.main_vars)])
+        self.update_target_net_op = self._create_target_update()
+
+        # inference graph of get_actions, which feeds only o, z, g and the noise scales
+        self.act_inputs_tf = [tf.compat.v1.placeholder(tf.float32, shape=(None, dim))
+                              for dim in (self.dimo, self.dimz, self.dimg)]
+        self.act_inputs_tf += [tf.compat.v1.placeholder(tf.float32, shape=()) for _ in range(2)]
+        self.act_callables = {}
+        for net_type in ['main', 'target']:
+            u_tf, Q_pi_tf = self._create_actor(net_type, self.act_inputs_tf)
+            self.act_callables[(net_type, False)] = self.sess.make_callable(u_tf, feed_list=self.act_inputs_tf)
+            self.act_callables[(net_type, True)] = self.sess.make_callable([u_tf, Q_pi_tf], feed_list=self.act_inputs_tf)
 
         # initialize all variables
         tf.compat.v1.variables_initializer(self._global_vars('')).run()
         if pretrain_weights:
             load_weight(self.sess, pretrain_weights, [''])
+            self.o_stats.load_stats()
+            self.g_stats.load_stats()
 
         self._sync_optimizers()
         # if pretrain_weights and self.finetune_pi:
@@ -460,6 +897,10 @@ class DDPG(object):
         #     self._init_target_net()
 
     def logs(self, prefix='', is_policy_training=True):
+        with self.history_lock:
+            return self._logs(prefix, is_policy_training)
+
+    def _logs(self, prefix='', is_policy_training=True):
         logs = []
         logs += [('stats_o/mean', np.mean(self.sess.run([self.o_stats.mean])))]
         logs += [('stats_o/std', np.mean(self.sess.run([self.o_stats.std])))]
@@ -500,7 +941,8 @@ class DDPG(object):
         """
         excluded_subnames = ['_tf', '_op', '_vars', '_adam', '_sgd', 'buffer', 'sess', '_stats',
                              'main', 'target', 'lock', 'sample_transitions',
-                             'stage_shapes', 'create_actor_critic', 'create_discriminator', '_history']
+                             'stage_shapes', 'create_actor_critic', 'create_discriminator', '_history',
+                             'prefetcher', 'act_callables']
 
         state = {k: v for k, v in self.__dict__.items() if all([not subname in k for subname in excluded_subnames])}
         state['buffer_size'] = self.buffer_size
@@ -529,6 +971,8 @@ class DDPG(object):
             state['pretrain_weights'] = None
         if 'sac' not in state:
             state['sac'] = None
+        if 'optimizer_mode' not in state:
+            state['optimizer_mode'] = 'mpi'
 
         self.__init__(**state)
         # set up stats (they are overwritten in __init__)
@@ -540,3 +984,5 @@ class DDPG(object):
         assert(len(vars) == len(state["tf"]))
         node = [tf.compat.v1.assign(var, val) for var, val in zip(vars, state["tf"])]
         self.sess.run(node)
+        self.o_stats.load_stats()
+        self.g_stats.load_stats()
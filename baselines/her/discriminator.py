@@ -1,13 +1,13 @@
 import tensorflow as tf
 
 from baselines.her.normalizer import Normalizer
-from baselines.her.util import store_args, nn, snn
+from baselines.her.util import store_args, nn, snn, snn_heads
 import numpy as np
 
 
 class Discriminator:
     @store_args
-    def __init__(self, inputs_tf, dimo, dimz, dimg, dimu, max_u, o_stats, g_stats, hidden, layers, env_name, **kwargs):
+    def __init__(self, inputs_tf, dimo, dimz, dimg, dimu, max_u, o_stats, g_stats, hidden, layers, env_name, sk_inputs_tf=None, **kwargs):
         """The discriminator network and related training code.
 
         Args:
@@ -22,14 +22,25 @@ class Discriminator:
             g_stats (baselines.her.Normalizer): normalizer for goals
             hidden (int): number of hidden units that should be used in hidden layers
             layers (int): number of hidden layers
+            sk_inputs_tf (dict of tensors): the observation (o), the next observation (o_2), the
+                skill (z), the action (u) and the training flag (is_training) to read instead of
+                creating placeholders for them
         """
 
-        self.o_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimo))
-        self.o2_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimo))
-        self.z_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimz))
-        self.g_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimg))
-        self.u_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimu))
-        self.is_training = tf.compat.v1.placeholder(tf.bool, shape=())
+        if sk_inputs_tf is None:
+            self.o_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimo))
+            self.o2_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimo))
+            self.z_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimz))
+            self.u_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimu))
+            self.g_tf = tf.compat.v1.placeholder(tf.float32, shape=(None, self.dimg))
+            self.is_training = tf.compat.v1.placeholder(tf.bool, shape=())
+        else:
+            self.o_tf = sk_inputs_tf['o']
+            self.o2_tf = sk_inputs_tf['o_2']
+            self.z_tf = sk_inputs_tf['z']
+            self.u_tf = sk_inputs_tf['u']
+            self.g_tf = sk_inputs_tf.get('g')
+            self.is_training = sk_inputs_tf['is_training']
 
         o_tau_tf = self.o_tau_tf
 
@@ -47,27 +58,27 @@ class Discriminator:
                     pass
                 elif self.dual_dist == 's2_from_s':
                     dims2 = obs2_focus.shape[1]
-                    self.s2_mean_tf = snn(obs_focus, [int(self.hidden / 2)] * self.layers + [dims2], name='s2_mean', is_training=self.is_training)
-                    self.s2_log_std_tf = snn(obs_focus, [int(self.hidden / 2)] * self.layers + [dims2], name='s2_log_std', is_training=self.is_training)
+                    self.s2_mean_tf, self.s2_log_std_tf = snn_heads(obs_focus, [int(self.hidden / 2)] * self.layers + [dims2], names=['s2_mean', 's2_log_std'])
                     self.s2_clamped_log_std_tf = tf.clip_by_value(self.s2_log_std_tf, -13.8155, 1000)
                     self.s2_clamped_std_tf = tf.exp(self.s2_clamped_log_std_tf)
                     # Predict delta_s
                     self.sk_dist_tf = tf.math.reduce_sum(input_tensor=(tf.abs(self.s2_mean_tf - (obs2_focus - obs_focus)) / self.s2_clamped_std_tf) ** 2 + self.s2_clamped_std_tf, axis=1)
 
         with tf.compat.v1.variable_scope('skill_ds', reuse=tf.compat.v1.AUTO_REUSE):
+            # phi(s) and phi(s') in one pass, so that the spectral norm is estimated once per layer
+            obs_pair = tf.concat([obs_focus, obs2_focus], axis=0)
+            mean_pair_tf = snn(obs_pair, [int(self.hidden / 2)] * self.layers + [self.dimz], name='mean', sn=self.spectral_normalization, is_training=self.is_training)
+            self.mean_tf, self.mean2_tf = tf.split(mean_pair_tf, 2, axis=0)
             if self.skill_type == 'discrete':
-                eye_z = tf.tile(tf.expand_dims(tf.eye(self.dimz), 0), [tf.shape(input=obs_focus)[0], 1, 1])
-                self.mean_tf = snn(obs_focus, [int(self.hidden / 2)] * self.layers + [self.dimz], name='mean', sn=self.spectral_normalization, is_training=self.is_training)
-                self.mean2_tf = snn(obs2_focus, [int(self.hidden / 2)] * self.layers + [self.dimz], name='mean', sn=self.spectral_normalization, is_training=self.is_training)
+                # the logits are mean_diff_tf; the reward is the logit of the skill minus the mean of
+                # the other logits, gathered at the skill index in O(batch x dimz)
+                self.z_idx_tf = tf.argmax(input=self.z_tf, axis=1, output_type=tf.int32)
                 self.mean_diff_tf = self.mean2_tf - self.mean_tf
-                mean_diff_tf = tf.expand_dims(self.mean_diff_tf, 1)
-                logits = tf.math.reduce_sum(input_tensor=eye_z * mean_diff_tf, axis=2)
-                masks = self.z_tf * self.dimz / (self.dimz - 1) - 1 / (self.dimz - 1)
-                self.sk_tf = -tf.reduce_sum(input_tensor=logits * masks, axis=1)
+                logit_z = tf.gather(self.mean_diff_tf, self.z_idx_tf[:, None], batch_dims=1)[:, 0]
+                logits_sum = tf.reduce_sum(input_tensor=self.mean_diff_tf, axis=1)
+                self.sk_tf = -(self.dimz * logit_z - logits_sum) / (self.dimz - 1)
                 self.sk_r_tf = -1 * self.sk_tf
             else:
-                self.mean_tf = snn(obs_focus, [int(self.hidden / 2)] * self.layers + [self.dimz], name='mean', sn=self.spectral_normalization, is_training=self.is_training)
-                self.mean2_tf = snn(obs2_focus, [int(self.hidden / 2)] * self.layers + [self.dimz], name='mean', sn=self.spectral_normalization, is_training=self.is_training)
                 self.mean_diff_tf = self.mean2_tf - self.mean_tf
                 self.sk_tf = -tf.math.reduce_sum(input_tensor=self.mean_diff_tf * self.z_tf, axis=1)
                 self.sk_r_tf = -1 * self.sk_tf
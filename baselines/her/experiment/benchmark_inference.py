@@ -0,0 +1,48 @@
+import click
+import numpy as np
+import tensorflow as tf
+
+from baselines.her.experiment.benchmark_training import make_policy, steps_per_second
+
+
+def feed_dict_actions(policy, o, z, g, noise_eps, random_eps):
+    """get_actions as it was before the inference graph: a generic sess.run on the training graph
+    with a feed_dict, followed by the exploration noise in NumPy.
+    """
+    o, g = policy._preprocess_og(o, None, g)
+    feed = {
+        policy.main.o_tf: o, policy.main.z_tf: z, policy.main.g_tf: g,
+        policy.main.u_tf: np.zeros((o.shape[0], policy.dimu), dtype=np.float32),
+    }
+    u = policy.sess.run([policy.main.mu_tf if policy.sac else policy.main.pi_tf], feed_dict=feed)[0]
+    u += noise_eps * policy.max_u * np.random.randn(*u.shape)
+    u = np.clip(u, -policy.max_u, policy.max_u)
+    u += np.random.binomial(1, random_eps, u.shape[0]).reshape(-1, 1) * (policy._random_action(u.shape[0]) - u)
+    return u.copy()
+
+
+@click.command()
+@click.option('--hidden', type=int, default=256)
+@click.option('--n_calls', type=int, default=1000)
+def main(hidden, n_calls):
+    """Measures the latency of one get_actions call, with exploration noise, for several numbers of
+    parallel environments, in TensorFlow and in the exported NumpyPolicy.
+    """
+    tf.compat.v1.disable_eager_execution()
+    with tf.compat.v1.Session().as_default():
+        policy = make_policy(hidden=hidden)
+        numpy_policy = policy.export_numpy_policy()
+        print('{:>6} {:>16} {:>16} {:>16}'.format('batch', 'feed_dict (us)', 'get_actions (us)', 'numpy (us)'))
+        for batch_size in [1, 4, 16, 64, 256]:
+            o = np.random.randn(batch_size, policy.dimo)
+            z = np.random.randn(batch_size, policy.dimz)
+            g = np.random.randn(batch_size, policy.dimg)
+            legacy = steps_per_second(lambda: feed_dict_actions(policy, o, z, g, 0.2, 0.3), n_calls)
+            fast = steps_per_second(lambda: policy.get_actions(o, z, None, g, noise_eps=0.2, random_eps=0.3), n_calls)
+            numpy = steps_per_second(
+                lambda: numpy_policy.get_actions(o, z, None, g, noise_eps=0.2, random_eps=0.3), n_calls)
+            print('{:>6} {:>16.1f} {:>16.1f} {:>16.1f}'.format(batch_size, 1e6 / legacy, 1e6 / fast, 1e6 / numpy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+import time
+
+import click
+import numpy as np
+
+from baselines.her.replay_buffer import ReplayBuffer
+
+
+def legacy_sample_idxs(myv, current_size, batch_size):
+    """The per-sample loop that `_sample_her_transitions` used before the valid-length index.
+    """
+    episode_idxs = np.random.randint(0, current_size, batch_size)
+    t_samples = []
+    for i in range(batch_size):
+        max_t = myv[episode_idxs[i]].sum().astype(int)
+        t_sample = np.random.randint(max_t)
+        t_samples.append(t_sample)
+    return episode_idxs, np.array(t_samples)
+
+
+def samples_per_second(sample_idxs, batch_size, n_batches):
+    start = time.time()
+    for _ in range(n_batches):
+        sample_idxs(batch_size)
+    return batch_size * n_batches / (time.time() - start)
+
+
+@click.command()
+@click.option('--T', 'T', type=int, default=50, help='episode length')
+@click.option('--batch_size', type=int, default=256)
+@click.option('--n_batches', type=int, default=200)
+@click.option('--max_episodes', type=int, default=int(1e6), help='largest buffer size, in episodes')
+def main(T, batch_size, n_batches, max_episodes):
+    """Measures how fast (episode, t) pairs are drawn from a full buffer, with the legacy per-sample
+    loop and with the buffer's valid-length index, for buffer sizes from 1e3 episodes upwards.
+    """
+    print('{:>10} {:>18} {:>18} {:>8}'.format('episodes', 'legacy samples/s', 'indexed samples/s', 'speedup'))
+    n_episodes = 1000
+    while n_episodes <= max_episodes:
+        buffer = ReplayBuffer({'myv': (T,)}, n_episodes * T, T, None, {'myv': np.uint8})
+        # episodes that terminated early have a shorter valid prefix
+        lengths = np.random.randint(1, T + 1, n_episodes)
+        myv = (np.arange(T) < lengths[:, np.newaxis]).astype(np.uint8)
+        for start in range(0, n_episodes, 10000):
+            end = min(start + 10000, n_episodes)
+            buffer.store_episode({'myv': myv[start:end], 's': np.zeros((end - start, 1))}, None)
+
+        legacy = samples_per_second(
+            lambda n: legacy_sample_idxs(buffer.buffers['myv'], buffer.current_size, n), batch_size, n_batches)
+        indexed = samples_per_second(buffer._sample_uniform_idxs, batch_size, n_batches)
+        print('{:>10} {:>18.0f} {:>18.0f} {:>7.1f}x'.format(n_episodes, legacy, indexed, indexed / legacy))
+        n_episodes *= 10
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import click
+import numpy as np
+import tensorflow as tf
+
+from baselines.her.experiment.benchmark_training import make_policy, steps_per_second
+
+
+def legacy_sk_tf(discriminator):
+    """The discrete-skill loss as the Discriminator built it before the gathered logits: an identity
+    matrix per sample, multiplied with the logits.
+    """
+    dimz = discriminator.dimz
+    eye_z = tf.tile(tf.expand_dims(tf.eye(dimz), 0), [tf.shape(input=discriminator.mean_diff_tf)[0], 1, 1])
+    logits = tf.math.reduce_sum(input_tensor=eye_z * tf.expand_dims(discriminator.mean_diff_tf, 1), axis=2)
+    masks = discriminator.z_tf * dimz / (dimz - 1) - 1 / (dimz - 1)
+    return -tf.reduce_sum(input_tensor=logits * masks, axis=1)
+
+
+@click.command()
+@click.option('--hidden', type=int, default=256)
+@click.option('--batch_size', type=int, default=256)
+@click.option('--n_steps', type=int, default=100)
+@click.option('--max_legacy_skills', type=int, default=1000, help='largest num_skills for the legacy loss, whose memory grows quadratically')
+def main(hidden, batch_size, n_steps, max_legacy_skills):
+    """Measures the discrete-skill discriminator for 10 to 10k skills: evaluations of the reward per
+    second with the legacy identity-matrix loss and with the gathered logits, and discriminator
+    updates per second.
+    """
+    tf.compat.v1.disable_eager_execution()
+    print('{:>7} {:>16} {:>16} {:>12}'.format('skills', 'legacy reward/s', 'gather reward/s', 'train_sk/s'))
+    for num_skills in [10, 100, 1000, 10000]:
+        tf.compat.v1.reset_default_graph()
+        with tf.compat.v1.Session().as_default() as sess:
+            policy = make_policy(dimz=num_skills, hidden=hidden, batch_size=batch_size, skill_type='discrete',
+                                 dual_reg=0, dual_dist='l2')
+            discriminator = policy.main_ir
+            z = np.eye(num_skills, dtype=np.float32)[np.random.randint(0, num_skills, batch_size)]
+            o, o_2 = np.random.randn(2, batch_size, policy.dimo)
+            u = np.random.randn(batch_size, policy.dimu)
+            feed_dict = {discriminator.o_tf: o, discriminator.o2_tf: o_2, discriminator.z_tf: z,
+                         discriminator.u_tf: u, discriminator.is_training: False}
+
+            legacy = '-'
+            if num_skills <= max_legacy_skills:
+                legacy_tf = legacy_sk_tf(discriminator)
+                np.testing.assert_allclose(*sess.run([legacy_tf, discriminator.sk_tf], feed_dict), rtol=1e-4, atol=1e-4)
+                legacy = '{:.1f}'.format(steps_per_second(lambda: sess.run(legacy_tf, feed_dict), n_steps))
+            gather = steps_per_second(lambda: sess.run(discriminator.sk_r_tf, feed_dict), n_steps)
+            train = steps_per_second(lambda: policy.train_sk(o, z, o_2, u), n_steps)
+            print('{:>7} {:>16} {:>16.1f} {:>12.1f}'.format(num_skills, legacy, gather, train))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+import time
+
+import click
+import numpy as np
+import tensorflow as tf
+
+from baselines.her.ddpg import DDPG
+from baselines.her.experiment.config import DEFAULT_PARAMS
+from baselines.her.her import make_sample_her_transitions
+
+
+def make_policy(dimo=30, dimz=2, dimg=3, dimu=8, T=50, hidden=256, layers=3, batch_size=256, **kwargs):
+    """Builds a CSD agent on synthetic dimensions, with a replay buffer filled with random
+    episodes, so that training can be timed without an environment.
+    """
+    params = dict(
+        input_dims={'o': dimo, 'z': dimz, 'g': dimg, 'u': dimu}, T=T, hidden=hidden, layers=layers,
+        batch_size=batch_size, buffer_size=100 * T, rollout_batch_size=2,
+        network_class_actor_critic=DEFAULT_PARAMS['network_class_actor_critic'],
+        network_class_discriminator=DEFAULT_PARAMS['network_class_discriminator'],
+        polyak=DEFAULT_PARAMS['polyak'], Q_lr=1e-3, pi_lr=1e-3, sk_lr=1e-3, r_scale=0., sk_r_scale=1.,
+        et_r_scale=0.02, norm_eps=DEFAULT_PARAMS['norm_eps'], norm_clip=DEFAULT_PARAMS['norm_clip'], max_u=1.,
+        action_l2=DEFAULT_PARAMS['action_l2'], clip_obs=DEFAULT_PARAMS['clip_obs'], scope='ddpg',
+        subtract_goals=lambda a, b: a - b, relative_goals=False, clip_pos_returns=True, clip_return=np.inf,
+        sample_transitions=make_sample_her_transitions('future', 4, None, [(0, 0.02), (1, 0.02)]),
+        gamma=1. - 1. / T, env_name='Synthetic', max_timesteps=None, pretrain_weights=None, finetune_pi=False,
+        sac=True, skill_type='continuous', sk_clip=0, et_clip=1, spectral_normalization=1, dual_reg=1,
+        dual_init_lambda=3000., dual_lam_opt='adam', dual_slack=1e-6, dual_dist='s2_from_s', algo='csd',
+    )
+    params.update(kwargs)
+    policy = DDPG(**params)
+
+    for _ in range(50):
+        episode = {
+            'o': np.random.randn(2, T + 1, dimo), 'z': np.repeat(np.random.randn(2, 1, dimz), T, axis=1),
+            'u': np.random.uniform(-1, 1, (2, T, dimu)), 'g': np.zeros((2, T, dimg)),
+            'ag': np.random.randn(2, T + 1, dimg), 'myr': np.zeros((2, T)), 'myd': np.zeros((2, T)),
+            'myv': np.ones((2, T)),
+        }
+        policy.store_episode(episode)
+    return policy
+
+
+def steps_per_second(step, n_steps, n_warmup=10):
+    for _ in range(n_warmup):
+        step()
+    start = time.time()
+    for _ in range(n_steps):
+        step()
+    return n_steps / (time.time() - start)
+
+
+@click.command()
+@click.option('--hidden', type=int, default=256)
+@click.option('--batch_size', type=int, default=256)
+@click.option('--n_steps', type=int, default=200)
+@click.option('--cycle_batches', type=int, default=40)
+def main(hidden, batch_size, n_steps, cycle_batches):
+    """Measures training steps per second on synthetic data with the optimizer updates applied in
+    NumPy (the MPI path), inside the TF graph and inside the TF graph compiled with XLA, and with
+    cycle_batches graph steps fused into one train_cycle call. A step is one critic/actor update on
+    a pre-sampled batch, plus one discriminator and one distance-model update, made in separate
+    calls (train_sk, train_sk_dist) or in one (train_discriminators), which the total uses. Also
+    reports the cost of one target network update.
+    """
+    tf.compat.v1.disable_eager_execution()
+    print('{:>8} {:>14} {:>16} {:>16} {:>14}'.format(
+        'mode', 'critic steps/s', 'discrim. steps/s', 'one-call discr/s', 'total steps/s'))
+    for mode in ['mpi', 'graph', 'xla']:
+        tf.compat.v1.reset_default_graph()
+        with tf.compat.v1.Session().as_default():
+            optimizer_mode = 'mpi' if mode == 'mpi' else 'graph'
+            policy = make_policy(hidden=hidden, batch_size=batch_size, optimizer_mode=optimizer_mode,
+                                 jit_compile=int(mode == 'xla'))
+            batch = policy.sample_batch(True, 0)
+            sk_batch = policy.sample_discriminator_batch(batch_size)
+
+            def critic_step():
+                policy.stage_batch(True, 0, batch)
+                policy.train(0, stage=False)
+
+            def discriminator_step():
+                policy.train_sk(*sk_batch)
+                policy.train_sk_dist(*sk_batch[:3], {})
+
+            def one_call_discriminator_step():
+                policy.train_discriminators(sk_batch)
+
+            def step():
+                critic_step()
+                one_call_discriminator_step()
+
+            print('{:>8} {:>14.1f} {:>16.1f} {:>16.1f} {:>14.1f}'.format(
+                mode, steps_per_second(critic_step, n_steps), steps_per_second(discriminator_step, n_steps),
+                steps_per_second(one_call_discriminator_step, n_steps), steps_per_second(step, n_steps)))
+
+            if mode == 'graph':
+                def cycle():
+                    policy.train_cycle([batch] * cycle_batches, [sk_batch] * cycle_batches, update_target=False)
+
+                cycles_per_second = steps_per_second(cycle, max(n_steps // cycle_batches, 1), n_warmup=1)
+                print('{:>8} {:>14} {:>16} {:>16} {:>14.1f}'.format('fused', '-', '-', '-', cycle_batches * cycles_per_second))
+
+                # target network update as one assign per variable pair, fetched as a list, and as
+                # the grouped in-place op of update_target_net
+                per_variable_op = [v[0].assign(policy.polyak * v[0] + (1. - policy.polyak) * v[1])
+                                   for v in zip(policy.target_vars, policy.main_vars)]
+                for name, op in [('per-variable', per_variable_op), ('grouped', policy.update_target_net_op)]:
+                    calls_per_second = steps_per_second(lambda: policy.sess.run(op), n_steps)
+                    print('target update ({}): {:.1f} us/call'.format(name, 1e6 / calls_per_second))
+
+
+if __name__ == '__main__':
+    main()
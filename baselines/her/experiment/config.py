@@ -28,7 +28,19 @@ DEFAULT_PARAMS = {
     'pi_lr': 0.001,  # actor learning rate
     'sk_lr': 0.001,  # skill discriminator learning rate
     'buffer_size': int(1E6), 
+    'replay_buffer': 'memory',  # 'memory', 'memmap' (disk-backed, resumable) or 'packed' (valid steps only)
+    'replay_buffer_dir': None,  # storage directory of the memmap replay buffer
+    'prioritized_replay': 0,  # sample critic batches proportionally to their TD error
+    'prioritized_replay_alpha': 0.6,  # amount of prioritization (0 - uniform)
+    'prioritized_replay_beta': 0.4,  # importance-sampling correction exponent
+    'sk_r_cache_staleness': None,  # if set, reuse cached intrinsic rewards for this many discriminator updates
+    'replay_eviction': 'random',  # which episodes a full buffer replaces: 'random', 'fifo' or 'reservoir'
+    'optimizer_mode': 'auto',  # 'graph' (updates applied in TF, one worker only), 'mpi' or 'auto'
+    'jit_compile': 0,  # compile the networks, losses and in-graph updates with XLA
+    'prefetch_batches': 0,  # if > 0, sample this many batches ahead of training on a background thread
     'polyak': 0.95,  # polyak averaging coefficient
+    'target_update_interval': 0,  # if > 0, update the target network every this many critic steps instead of once per cycle
+    'normalizer_sync_interval': 1,  # synchronize the observation/goal normalizers every this many stored episodes
     'action_l2': 1.0,  # quadratic penalty on actions (before rescaling by max_u)
     'clip_obs': 200.,
     'scope': 'ddpg',  # can be tweaked for testing
@@ -214,6 +226,18 @@ def configure_ddpg(dims, params, pretrain_weights, reuse=False, use_mpi=True, cl
                         'sk_lam_lr': params['sk_lam_lr'],
                         'algo_name': params['algo_name'],
                         'train_start_epoch': params['train_start_epoch'],
+                        'replay_buffer': params['replay_buffer'],
+                        'replay_buffer_dir': params['replay_buffer_dir'],
+                        'prioritized_replay': params['prioritized_replay'],
+                        'prioritized_replay_alpha': params['prioritized_replay_alpha'],
+                        'prioritized_replay_beta': params['prioritized_replay_beta'],
+                        'sk_r_cache_staleness': params['sk_r_cache_staleness'],
+                        'prefetch_batches': params['prefetch_batches'],
+                        'replay_eviction': params['replay_eviction'],
+                        'optimizer_mode': params['optimizer_mode'],
+                        'target_update_interval': params['target_update_interval'],
+                        'jit_compile': params['jit_compile'],
+                        'normalizer_sync_interval': params['normalizer_sync_interval'],
                         })
     ddpg_params['info'] = {
         'env_name': params['env_name'],
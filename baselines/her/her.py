@@ -12,47 +12,52 @@ def make_sample_her_transitions(replay_strategy, replay_k, reward_fun, et_w_sche
         future_p = 0
     et_w_scheduler = PiecewiseSchedule(endpoints=et_w_schedule)
 
-    def _sample_her_transitions(ddpg, ir, episode_batch, batch_size_in_transitions, sk_r_scale, t):
+    def _sample_her_transitions(ddpg, ir, episode_batch, batch_size_in_transitions, sk_r_scale, t, idxs=None,
+                                keys=None):
         """episode_batch is {key: array(buffer_size x T x dim_key)}
+        idxs is an optional (episode_idxs, t_samples) pair chosen by the caller, e.g. by the replay
+        buffer from its valid-length index or its priorities; otherwise it is drawn here.
+        keys optionally restricts the gathered keys to the ones the caller reads; by default
+        every key of episode_batch is returned.
         """
         T = episode_batch['u'].shape[1]
         rollout_batch_size = episode_batch['u'].shape[0]
         batch_size = batch_size_in_transitions
 
         # Select which episodes and time steps to use.
-        episode_idxs = np.random.randint(0, rollout_batch_size, batch_size)
-        # t_samples = np.random.randint(T, size=batch_size)
-        t_samples = []
-        for i in range(batch_size):
-            max_t = episode_batch['myv'][episode_idxs[i]].sum().astype(int)
-            t_sample = np.random.randint(max_t)
-            t_samples.append(t_sample)
-        t_samples = np.array(t_samples)
-
-        # calculate intrinsic rewards
-        sk_trans = np.zeros([episode_idxs.shape[0], 1])
+        if idxs is not None:
+            episode_idxs, t_samples = idxs
+        else:
+            episode_idxs = np.random.randint(0, rollout_batch_size, batch_size)
+            max_t = episode_batch['myv'][episode_idxs].sum(axis=1)
+            t_samples = (np.random.uniform(size=batch_size) * max_t).astype(int)
+
+        # Gather only the keys the consumer asked for, plus the ones needed here, with one
+        # fancy-index per key; the results are fresh arrays that can be modified in place.
+        keys = set(episode_batch.keys() if keys is None else keys) | {'g', 'u', 'myr'}
         if ir:
-            o_curr = episode_batch['o'][episode_idxs, t_samples].copy()
-            o_curr = np.reshape(o_curr, (o_curr.shape[0], 1, o_curr.shape[-1]))
-            o_next = episode_batch['o'][episode_idxs, t_samples+1].copy()
-            o_next = np.reshape(o_next, (o_next.shape[0], 1, o_next.shape[-1]))
-
-            o = episode_batch['o'][episode_idxs, t_samples].copy()
-            o2 = episode_batch['o_2'][episode_idxs, t_samples].copy()
-            z = episode_batch['z'][episode_idxs, t_samples].copy()
-            u = episode_batch['u'][episode_idxs, t_samples].copy()
-            if sk_r_scale > 0:
-                sk_r = ddpg.run_sk(o, z, o2, u)
-                sk_trans = sk_r.copy()
-        # #
-
+            keys.discard('s')
+            keys.discard('sk_r')
+            if sk_r_scale > 0 and 'sk_r' not in episode_batch:
+                keys |= {'o', 'o_2', 'z'}
         transitions = {}
-        for key in episode_batch.keys():
+        for key in keys:
             if not (key == 's' or key == 'p'):
-                transitions[key] = episode_batch[key][episode_idxs, t_samples].copy()
+                transitions[key] = episode_batch[key][episode_idxs, t_samples]
             else:
-                transitions[key] = episode_batch[key][episode_idxs].copy()
-        transitions['s'] = transitions['s'].flatten().copy()
+                transitions[key] = episode_batch[key][episode_idxs]
+        if 's' in transitions:
+            transitions['s'] = transitions['s'].flatten()
+
+        # calculate intrinsic rewards
+        sk_trans = np.zeros([episode_idxs.shape[0], 1], np.float32)
+        if ir:
+            if 'sk_r' in episode_batch:
+                # intrinsic rewards cached by the replay buffer
+                sk_trans = episode_batch['sk_r'][episode_idxs, t_samples]
+            elif sk_r_scale > 0:
+                sk_trans = ddpg.run_sk(transitions['o'], transitions['z'], transitions['o_2'], transitions['u'])
+        # #
 
         her_indexes = np.where(np.random.uniform(size=batch_size) < future_p)
         future_offset = np.random.uniform(size=batch_size) * (T - t_samples)
@@ -65,21 +70,13 @@ def make_sample_her_transitions(replay_strategy, replay_k, reward_fun, et_w_sche
         future_ag = episode_batch['ag'][episode_idxs[her_indexes], future_t]
         transitions['g'][her_indexes] = future_ag
 
-        info = {}
-        for key, value in transitions.items():
-            if key.startswith('info_'):
-                info[key.replace('info_', '')] = value
-
-        reward_params = {k: transitions[k] for k in ['ag_2', 'g']}
-        reward_params['info'] = info
-        # transitions['r'] = reward_fun(**reward_params)
         transitions['r'] = transitions['myr']
 
         transitions = {k: transitions[k].reshape(batch_size, *transitions[k].shape[1:])
                        for k in transitions.keys()}
 
         if ir:
-            transitions['s'] = sk_trans.flatten().copy()
+            transitions['s'] = sk_trans.flatten()
 
         transitions['s_w'] = 1.0
         transitions['r_w'] = 1.0
@@ -7,11 +7,28 @@ import tensorflow as tf
 from baselines.her.util import reshape_for_broadcasting
 
 
+def _merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    """Merges the (count, mean, sum of squared deviations) moments of two sets of samples, as in
+    the parallel variance algorithm of Chan et al.
+    """
+    count = count_a + count_b
+    if count == 0:
+        return count, mean_a, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + np.square(delta) * (count_a * count_b / count)
+    return count, mean, m2
+
+
 class Normalizer:
     def __init__(self, size, eps=1e-2, default_clip_range=np.inf, sess=None):
         """A normalizer that ensures that observations are approximately distributed according to
         a standard Normal distribution (i.e. have mean zero and variance one).
 
+        The moments of the samples passed to update are accumulated in NumPy and only reach the
+        graph when the normalizer is synchronized with synchronize_normalizers (or
+        recompute_stats).
+
         Args:
             size (int): the size of the observation to be normalized
             eps (float): a small constant that avoids underflows
@@ -24,18 +41,23 @@ class Normalizer:
         self.default_clip_range = default_clip_range
         self.sess = sess if sess is not None else tf.compat.v1.get_default_session()
 
-        self.local_sum = np.zeros(self.size, np.float32)
-        self.local_sumsq = np.zeros(self.size, np.float32)
-        self.local_count = np.zeros(1, np.float32)
+        # moments of the samples added since the last synchronization
+        self.local_count = 0.
+        self.local_mean = np.zeros(self.size, np.float64)
+        self.local_m2 = np.zeros(self.size, np.float64)
+        # moments of all synchronized samples, as initialized in the graph (count starts at one)
+        self.global_count = 1.
+        self.global_mean = np.zeros(self.size, np.float64)
+        self.global_m2 = np.zeros(self.size, np.float64)
 
         self.sum_tf = tf.compat.v1.get_variable(
-            initializer=tf.compat.v1.zeros_initializer(), shape=self.local_sum.shape, name='sum',
+            initializer=tf.compat.v1.zeros_initializer(), shape=(self.size,), name='sum',
             trainable=False, dtype=tf.float32)
         self.sumsq_tf = tf.compat.v1.get_variable(
-            initializer=tf.compat.v1.zeros_initializer(), shape=self.local_sumsq.shape, name='sumsq',
+            initializer=tf.compat.v1.zeros_initializer(), shape=(self.size,), name='sumsq',
             trainable=False, dtype=tf.float32)
         self.count_tf = tf.compat.v1.get_variable(
-            initializer=tf.compat.v1.ones_initializer(), shape=self.local_count.shape, name='count',
+            initializer=tf.compat.v1.ones_initializer(), shape=(1,), name='count',
             trainable=False, dtype=tf.float32)
         self.mean = tf.compat.v1.get_variable(
             initializer=tf.compat.v1.zeros_initializer(), shape=(self.size,), name='mean',
@@ -43,31 +65,30 @@ class Normalizer:
         self.std = tf.compat.v1.get_variable(
             initializer=tf.compat.v1.ones_initializer(), shape=(self.size,), name='std',
             trainable=False, dtype=tf.float32)
-        self.count_pl = tf.compat.v1.placeholder(name='count_pl', shape=(1,), dtype=tf.float32)
-        self.sum_pl = tf.compat.v1.placeholder(name='sum_pl', shape=(self.size,), dtype=tf.float32)
-        self.sumsq_pl = tf.compat.v1.placeholder(name='sumsq_pl', shape=(self.size,), dtype=tf.float32)
-
-        self.update_op = tf.group(
-            self.count_tf.assign_add(self.count_pl),
-            self.sum_tf.assign_add(self.sum_pl),
-            self.sumsq_tf.assign_add(self.sumsq_pl)
-        )
-        self.recompute_op = tf.group(
-            tf.compat.v1.assign(self.mean, self.sum_tf / self.count_tf),
-            tf.compat.v1.assign(self.std, tf.sqrt(tf.maximum(
-                tf.square(self.eps),
-                self.sumsq_tf / self.count_tf - tf.square(self.sum_tf / self.count_tf)
-            ))),
+        # count, sum, sumsq, mean and std, in this order
+        self.stats_pl = tf.compat.v1.placeholder(name='stats_pl', shape=(4 * self.size + 1,), dtype=tf.float32)
+
+        count_pl, sum_pl, sumsq_pl, mean_pl, std_pl = tf.split(self.stats_pl, [1] + [self.size] * 4)
+        self.assign_op = tf.group(
+            self.count_tf.assign(count_pl),
+            self.sum_tf.assign(sum_pl),
+            self.sumsq_tf.assign(sumsq_pl),
+            self.mean.assign(mean_pl),
+            self.std.assign(std_pl),
         )
         self.lock = threading.Lock()
 
     def update(self, v):
         v = v.reshape(-1, self.size)
+        if v.shape[0] == 0:
+            return
+        count = v.shape[0]
+        mean = v.mean(axis=0, dtype=np.float64)
+        m2 = np.square(v - mean).sum(axis=0)
 
         with self.lock:
-            self.local_sum += v.sum(axis=0)
-            self.local_sumsq += (np.square(v)).sum(axis=0)
-            self.local_count[0] += v.shape[0]
+            self.local_count, self.local_mean, self.local_m2 = _merge_moments(
+                self.local_count, self.local_mean, self.local_m2, count, mean, m2)
 
     def normalize(self, v, clip_range=None, zero_mean=True):
         if clip_range is None:
@@ -84,41 +105,62 @@ class Normalizer:
         std = reshape_for_broadcasting(self.std,  v)
         return mean + v * std
 
-    def _mpi_average(self, x):
-        buf = np.zeros_like(x)
-        MPI.COMM_WORLD.Allreduce(x, buf, op=MPI.SUM)
-        buf /= MPI.COMM_WORLD.Get_size()
-        return buf
+    def load_stats(self):
+        """Reads the synchronized moments back from the graph, e.g. after its variables were
+        restored from saved weights.
+        """
+        count, sum_, sumsq = self.sess.run([self.count_tf, self.sum_tf, self.sumsq_tf])
+        self.global_count = float(count[0])
+        self.global_mean = sum_.astype(np.float64) / self.global_count
+        self.global_m2 = np.maximum(sumsq.astype(np.float64) - self.global_count * np.square(self.global_mean), 0.)
 
-    def synchronize(self, local_sum, local_sumsq, local_count, root=None):
-        local_sum[...] = self._mpi_average(local_sum)
-        local_sumsq[...] = self._mpi_average(local_sumsq)
-        local_count[...] = self._mpi_average(local_count)
-        return local_sum, local_sumsq, local_count
+    def _pop_local_moments(self):
+        with self.lock:
+            moments = np.concatenate([[self.local_count], self.local_mean, self.local_m2])
+            self.local_count = 0.
+            self.local_mean = np.zeros(self.size, np.float64)
+            self.local_m2 = np.zeros(self.size, np.float64)
+        return moments
+
+    def _add_moments(self, moments):
+        count, mean, m2 = moments[0], moments[1:self.size + 1], moments[self.size + 1:]
+        self.global_count, self.global_mean, self.global_m2 = _merge_moments(
+            self.global_count, self.global_mean, self.global_m2, count, mean, m2)
+
+    def _stats_feed(self):
+        std = np.sqrt(np.maximum(np.square(self.eps), self.global_m2 / self.global_count))
+        sum_ = self.global_count * self.global_mean
+        sumsq = self.global_m2 + sum_ * self.global_mean
+        return np.concatenate([[self.global_count], sum_, sumsq, self.global_mean, std])
 
     def recompute_stats(self):
-        with self.lock:
-            # Copy over results.
-            local_count = self.local_count.copy()
-            local_sum = self.local_sum.copy()
-            local_sumsq = self.local_sumsq.copy()
-
-            # Reset.
-            self.local_count[...] = 0
-            self.local_sum[...] = 0
-            self.local_sumsq[...] = 0
-
-        # We perform the synchronization outside of the lock to keep the critical section as short
-        # as possible.
-        synced_sum, synced_sumsq, synced_count = self.synchronize(
-            local_sum=local_sum, local_sumsq=local_sumsq, local_count=local_count)
-
-        self.sess.run(self.update_op, feed_dict={
-            self.count_pl: synced_count,
-            self.sum_pl: synced_sum,
-            self.sumsq_pl: synced_sumsq,
-        })
-        self.sess.run(self.recompute_op)
+        synchronize_normalizers([self], self.sess)
+
+
+def synchronize_normalizers(normalizers, sess):
+    """Merges the samples added to the normalizers since their last synchronization, on all MPI
+    workers, into their statistics: one Allgather for all normalizers, then one session call that
+    assigns the new statistics to the graph.
+    """
+    # We perform the synchronization outside of the locks to keep the critical sections as short
+    # as possible.
+    local = np.concatenate([normalizer._pop_local_moments() for normalizer in normalizers])
+    comm = MPI.COMM_WORLD
+    if comm.Get_size() > 1:
+        gathered = np.empty((comm.Get_size(), local.size), np.float64)
+        comm.Allgather(local, gathered)
+    else:
+        gathered = local[None]
+
+    feed_dict = {}
+    offset = 0
+    for normalizer in normalizers:
+        n_moments = 2 * normalizer.size + 1
+        for moments in gathered[:, offset:offset + n_moments]:
+            normalizer._add_moments(moments)
+        offset += n_moments
+        feed_dict[normalizer.stats_pl] = normalizer._stats_feed()
+    sess.run([normalizer.assign_op for normalizer in normalizers], feed_dict=feed_dict)
 
 
 class IdentityNormalizer:
@@ -0,0 +1,133 @@
+import numpy as np
+
+# bounds of the log std of SAC's Gaussian actor, as in actor_critic
+LOG_STD_MAX = 2
+LOG_STD_MIN = -5
+
+
+class NumpyPolicy:
+    def __init__(self, weights, dimo, dimz, dimg, dimu, max_u, clip_obs, norm_clip, sac,
+                 relative_goals=False, subtract_goals=None):
+        """An actor-critic evaluator that acts like DDPG.get_actions without TensorFlow, so that
+        rollout processes only need NumPy. It holds a snapshot of the weights exported by
+        DDPG.export_numpy_weights and is refreshed with set_weights.
+
+        Args:
+            weights (dict): the snapshot returned by DDPG.export_numpy_weights
+            dimo (int): the dimension of the observations
+            dimz (int): the dimension of the skills
+            dimg (int): the dimension of the goals
+            dimu (int): the dimension of the actions
+            max_u (float): the maximum magnitude of actions
+            clip_obs (float): clip observations and goals before normalizing
+            norm_clip (float): normalized inputs are clipped to be in [-norm_clip, norm_clip]
+            sac (bool): whether the actor is the squashed Gaussian of SAC or the tanh actor of DDPG
+            relative_goals (boolean): whether or not relative goals should be fed into the network
+            subtract_goals (function): function that subtracts goals from each other
+        """
+        self.dimo = dimo
+        self.dimz = dimz
+        self.dimg = dimg
+        self.dimu = dimu
+        self.max_u = max_u
+        self.clip_obs = clip_obs
+        self.norm_clip = norm_clip
+        self.sac = sac
+        self.relative_goals = relative_goals
+        self.subtract_goals = subtract_goals
+        # per batch size, the activations of every layer, reused across calls
+        self._buffers = {}
+        self.set_weights(weights)
+
+    def set_weights(self, weights):
+        """Replaces the weights with a new snapshot of the learner's, e.g. after every epoch.
+        """
+        self.o_mean, self.o_std = [np.asarray(x, np.float32) for x in weights['o_stats']]
+        self.g_mean, self.g_std = [np.asarray(x, np.float32) for x in weights['g_stats']]
+        self.pi_layers = [(np.asarray(w, np.float32), np.asarray(b, np.float32)) for w, b in weights['pi']]
+        self.Q_layers = [(np.asarray(w, np.float32), np.asarray(b, np.float32)) for w, b in weights['Q']]
+        # SAC keeps the mean and log std heads as the two last layers of pi
+        self.n_pi_trunk = len(self.pi_layers) - 2 if self.sac else len(self.pi_layers)
+        self._buffers = {}
+
+    def _get_buffers(self, n):
+        if n not in self._buffers:
+            dim_input = self.dimo + self.dimz + self.dimg
+            self._buffers[n] = dict(
+                input_pi=np.empty((n, dim_input), np.float32),
+                input_Q=np.empty((n, dim_input + self.dimu), np.float32),
+                pi=[np.empty((n, w.shape[1]), np.float32) for w, _ in self.pi_layers],
+                Q=[np.empty((n, w.shape[1]), np.float32) for w, _ in self.Q_layers],
+            )
+        return self._buffers[n]
+
+    def _mlp(self, x, layers, outs):
+        """Dense layers with a ReLU after all but the last one, written into outs.
+        """
+        for i, ((w, b), out) in enumerate(zip(layers, outs)):
+            np.dot(x, w, out=out)
+            out += b
+            if i < len(layers) - 1:
+                np.maximum(out, 0., out=out)
+            x = out
+        return x
+
+    def _normalize(self, v, mean, std, out):
+        np.subtract(v, mean, out=out)
+        out /= std
+        np.clip(out, -self.norm_clip, self.norm_clip, out=out)
+
+    def get_actions(self, o, z, ag, g, noise_eps=0., random_eps=0., use_target_net=False, compute_Q=False, exploit=False):
+        assert not use_target_net, 'only the main network is exported'
+        if self.relative_goals:
+            g_shape = g.shape
+            g = self.subtract_goals(g.reshape(-1, self.dimg), ag.reshape(-1, self.dimg)).reshape(*g_shape)
+        o = np.clip(o.reshape(-1, self.dimo), -self.clip_obs, self.clip_obs)
+        g = np.clip(g.reshape(-1, self.dimg), -self.clip_obs, self.clip_obs)
+        n = o.shape[0]
+        buffers = self._get_buffers(n)
+
+        input_pi = buffers['input_pi']
+        self._normalize(o, self.o_mean, self.o_std, input_pi[:, :self.dimo])
+        input_pi[:, self.dimo:self.dimo + self.dimz] = z.reshape(-1, self.dimz)
+        self._normalize(g, self.g_mean, self.g_std, input_pi[:, self.dimo + self.dimz:])
+
+        net = self._mlp(input_pi, self.pi_layers[:self.n_pi_trunk], buffers['pi'][:self.n_pi_trunk])
+        if self.sac:
+            # mu head of mlp_gaussian_policy, squashed by apply_squashing_func
+            (w, b), mu = self.pi_layers[-2], buffers['pi'][-2]
+            np.dot(net, w, out=mu)
+            mu += b
+        else:
+            mu = buffers['pi'][-1]
+        u = np.tanh(mu) * self.max_u
+
+        if compute_Q:
+            if self.sac:
+                # Q_pi of SAC is evaluated at a sampled action, as in ActorCritic
+                (w, b), log_std = self.pi_layers[-1], buffers['pi'][-1]
+                np.dot(net, w, out=log_std)
+                log_std += b
+                np.tanh(log_std, out=log_std)
+                log_std = LOG_STD_MIN + 0.5 * (LOG_STD_MAX - LOG_STD_MIN) * (log_std + 1)
+                pi = np.tanh(mu + np.random.randn(*mu.shape) * np.exp(log_std))
+            else:
+                pi = u / self.max_u
+            input_Q = buffers['input_Q']
+            input_Q[:, :-self.dimu] = input_pi
+            input_Q[:, -self.dimu:] = pi
+            Q = self._mlp(input_Q, self.Q_layers, buffers['Q']).copy()
+
+        # action postprocessing, as in DDPG._create_actor
+        u += noise_eps * self.max_u * np.random.randn(*u.shape)  # gaussian noise
+        np.clip(u, -self.max_u, self.max_u, out=u)
+        u += np.random.binomial(1, random_eps, n).reshape(-1, 1) * (
+            np.random.uniform(-self.max_u, self.max_u, u.shape) - u)  # eps-greedy
+        u = u.astype(np.float32)
+        if n == 1:
+            u = u[0]
+
+        if compute_Q:
+            return [u, Q]
+        else:
+            return u
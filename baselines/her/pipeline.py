@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class RolloutPipeline:
+    def __init__(self, policy, rollout_worker, rollout_kwargs, rollouts_ahead=1, history_len=100,
+                 poll_interval=0.01):
+        """Generates rollouts on a background thread and stores them in the policy's replay buffer
+        while the learner trains, keeping at most rollouts_ahead rollouts stored but not yet
+        acquired by the learner.
+
+        The rollouts act with a NumPy snapshot of the policy (NumpyPolicy), which the learner
+        refreshes with publish, so that they neither wait for nor see half-applied updates.
+
+        Args:
+            policy (DDPG): the learner, whose replay buffer receives the episodes
+            rollout_worker (RolloutWorker): the worker that generates the episodes, whose policy is
+                replaced by the snapshot until close
+            rollout_kwargs (function): returns the keyword arguments of generate_rollouts for the
+                n-th rollout, e.g. its skills and whether its actions are random
+            rollouts_ahead (int): the maximum number of stored rollouts not yet acquired
+            history_len (int): length of the policy lag history
+            poll_interval (float): how often (in seconds) blocked waits check for shutdown or
+                errors of the other side
+        """
+        self.policy = policy
+        self.rollout_worker = rollout_worker
+        self.rollout_kwargs = rollout_kwargs
+        self.poll_interval = poll_interval
+
+        self.actor_policy = policy.export_numpy_policy()
+        self.learner_policy = rollout_worker.policy
+        rollout_worker.policy = self.actor_policy
+        # the number of updates the learner had made when taking the latest snapshot, and its
+        # weights, replaced in one assignment
+        self.snapshot = self.actor_snapshot = (policy.n_train_steps, None)
+
+        self.free_slots = threading.Semaphore(rollouts_ahead)
+        self.stored_rollouts = threading.Semaphore(0)
+        self.episodes = deque()
+        # held while the rollout worker generates, guards its histories
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.error = None
+        self.n_rollouts = 0
+
+        # learner updates between the snapshot a rollout acted with and its storage
+        self.policy_lag_history = deque(maxlen=history_len)
+        self.actor_wait_time = 0.
+        self.learner_wait_time = 0.
+
+        self.thread = threading.Thread(target=self._run, name='RolloutPipeline', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                start = time.time()
+                acquired = self.free_slots.acquire(timeout=self.poll_interval)
+                self.actor_wait_time += time.time() - start
+                if not acquired:
+                    continue
+                snapshot = self.snapshot
+                if snapshot is not self.actor_snapshot:
+                    self.actor_policy.set_weights(snapshot[1])
+                    self.actor_snapshot = snapshot
+                with self.lock:
+                    episode = self.rollout_worker.generate_rollouts(**self.rollout_kwargs(self.n_rollouts))
+                self.policy.store_episode(episode)
+                self.policy_lag_history.append(self.policy.n_train_steps - self.actor_snapshot[0])
+                self.n_rollouts += 1
+                self.episodes.append(episode)
+                self.stored_rollouts.release()
+        except Exception as e:
+            self.error = e
+
+    def acquire(self):
+        """Blocks until the next rollout has been stored, frees its slot so that the following
+        rollout can be generated during training, and returns its episode.
+        """
+        start = time.time()
+        while not self.stored_rollouts.acquire(timeout=self.poll_interval):
+            if self.error is not None:
+                raise RuntimeError('rollout pipeline thread failed') from self.error
+            if not self.thread.is_alive():
+                raise RuntimeError('rollout pipeline thread is not running')
+        self.learner_wait_time += time.time() - start
+        self.free_slots.release()
+        return self.episodes.popleft()
+
+    def publish(self):
+        """Snapshots the current weights of the learner for the next rollouts."""
+        self.snapshot = (self.policy.n_train_steps, self.policy.export_numpy_weights())
+
+    def logs(self, prefix='pipeline'):
+        """Returns the mean policy lag, in learner updates, and the seconds each side spent
+        waiting for the other since the last call.
+        """
+        policy_lags = list(self.policy_lag_history)
+        logs = [('policy_lag', np.mean(policy_lags) if policy_lags else 0.),
+                ('actor_wait_time', self.actor_wait_time), ('learner_wait_time', self.learner_wait_time)]
+        self.actor_wait_time = self.learner_wait_time = 0.
+        return [(prefix + '/' + key, val) for key, val in logs]
+
+    def close(self):
+        """Stops the rollout thread after its current rollout and gives the rollout worker its
+        policy back. Rollouts not yet acquired stay in the replay buffer.
+        """
+        self.stop_event.set()
+        self.thread.join()
+        self.rollout_worker.policy = self.learner_policy
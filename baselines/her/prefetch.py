@@ -0,0 +1,64 @@
+import threading
+
+
+class BatchPrefetcher:
+    def __init__(self, policy, num_batches, poll_interval=0.01):
+        """Samples minibatches on a background thread and puts them into the policy's staging
+        area, keeping at most num_batches staged ahead of training.
+
+        Args:
+            policy (DDPG): the policy whose buffer is sampled and whose staging area is filled
+            num_batches (int): the maximum number of batches staged but not yet trained on
+            poll_interval (float): how often (in seconds) blocked waits check for shutdown or
+                errors of the other side
+        """
+        self.policy = policy
+        self.num_batches = num_batches
+        self.poll_interval = poll_interval
+
+        self.free_slots = threading.Semaphore(num_batches)
+        self.staged_batches = threading.Semaphore(0)
+        self.stop_event = threading.Event()
+        self.error = None
+        # schedule time passed to the sampler, updated by the consumer
+        self.t = 0
+        self.batches_staged = 0
+
+        self.thread = threading.Thread(target=self._run, name='BatchPrefetcher', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                if not self.free_slots.acquire(timeout=self.poll_interval):
+                    continue
+                while self.policy.buffer.current_size == 0 and not self.stop_event.is_set():
+                    self.stop_event.wait(self.poll_interval)
+                if self.stop_event.is_set():
+                    break
+                with self.policy.history_lock:
+                    self.policy.stage_batch(ir=True, t=self.t)
+                self.batches_staged += 1
+                self.staged_batches.release()
+        except Exception as e:
+            self.error = e
+
+    def acquire(self, t):
+        """Blocks until a batch is staged. t is the schedule time used for the batches sampled
+        from now on.
+        """
+        self.t = t
+        while not self.staged_batches.acquire(timeout=self.poll_interval):
+            if self.error is not None:
+                raise RuntimeError('batch prefetch thread failed') from self.error
+            if not self.thread.is_alive():
+                raise RuntimeError('batch prefetch thread is not running')
+
+    def release(self):
+        """Frees the slot of a batch that has been taken out of the staging area."""
+        self.free_slots.release()
+
+    def close(self):
+        """Stops the producer thread. Batches still in the staging area are left to the caller."""
+        self.stop_event.set()
+        self.thread.join()
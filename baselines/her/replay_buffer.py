@@ -1,8 +1,14 @@
+import json
+import os
 import threading
 import numpy as np
 
+from baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
+
 class ReplayBuffer:
-    def __init__(self, buffer_shapes, size_in_transitions, T, sample_transitions):
+    def __init__(self, buffer_shapes, size_in_transitions, T, sample_transitions, buffer_dtypes=None,
+                 constant_keys=(), prioritized=False, alpha=0.6, beta=0.4, priority_eps=1e-6,
+                 sk_r_cache_staleness=None, sk_r_cache_chunk=8192, eviction='random', max_sample_retries=100):
         """Creates a replay buffer.
 
         Args:
@@ -11,69 +17,316 @@ class ReplayBuffer:
             size_in_transitions (int): the size of the buffer, measured in transitions
             T (int): the time horizon for episodes
             sample_transitions (function): a function that samples from the replay buffer
+            buffer_dtypes (dict of dtypes): the storage dtype for each buffer; keys that are
+                not listed are stored as float32
+            constant_keys (list of strs): keys whose value does not change within an episode;
+                they are stored once per episode and broadcast along the time axis on sampling
+            prioritized (boolean): whether to sample transitions proportionally to their priority
+                instead of uniformly
+            alpha (float): how much prioritization is used (0 - uniform, 1 - full prioritization)
+            beta (float): the importance-sampling correction exponent of the sampled weights
+            priority_eps (float): a small constant added to every priority
+            sk_r_cache_staleness (int): if not None, the intrinsic rewards are cached per transition
+                and only recomputed once the discriminator has been updated more than this many
+                times since they were computed
+            sk_r_cache_chunk (int): the number of transitions per discriminator call when the
+                cached intrinsic rewards are recomputed
+            eviction (str): which episodes are replaced once the buffer is full: 'random' slots,
+                the oldest ones ('fifo'), or 'reservoir' to keep a uniform sample of all episodes
+                ever stored
+            max_sample_retries (int): how often `sample` redraws transitions whose episode was
+                overwritten while it was being gathered before giving up
         """
+        assert eviction in ['random', 'fifo', 'reservoir'], "unknown eviction policy {}".format(eviction)
         self.buffer_shapes = buffer_shapes
         self.size = size_in_transitions // T
         self.T = T
         self.sample_transitions = sample_transitions
+        self.buffer_dtypes = {key: np.float32 for key in buffer_shapes.keys()}
+        self.buffer_dtypes['s'] = np.float32
+        self.buffer_dtypes.update(buffer_dtypes or {})
+        self.constant_keys = set(constant_keys)
 
-        self.buffers = {key: np.empty([self.size, *shape])
-                        for key, shape in buffer_shapes.items()}
+        self.buffers = {key: self._allocate(key, [self.size, *self._storage_shape(key)], self.buffer_dtypes[key])
+                        for key in buffer_shapes.keys()}
         # add key for intrinsic rewards
-        self.buffers['s'] = np.empty([self.size, 1])
+        self.buffers['s'] = self._allocate('s', [self.size, 1], self.buffer_dtypes['s'])
+
+        # number of valid steps of each stored episode, i.e. the sum of its 'myv' mask
+        self.valid_lengths = np.zeros(self.size, np.int64)
 
         # memory management
         self.current_size = 0
         self.n_transitions_stored = 0
+        self.eviction = eviction
+        # next slot to overwrite in fifo mode and number of episodes offered to the buffer
+        self.next_idx = 0
+        self.n_episodes_seen = 0
+
+        # Per-episode generation counters, odd while the episode is being written. Samplers
+        # gather without taking the lock and redraw the transitions whose generation changed.
+        self.generations = np.zeros(self.size, np.int64)
+        self.max_sample_retries = max_sample_retries
+
+        self.sk_r_cache_staleness = sk_r_cache_staleness
+        self.sk_r_cache_chunk = sk_r_cache_chunk
+        if self.sk_r_cache_staleness is not None:
+            self.sk_r_cache = np.zeros([self.size, self.T], np.float32)
+            # discriminator version each episode's rewards were computed with, -1 if never
+            self.sk_r_version = np.full(self.size, -1, np.int64)
+            self.sk_r_lock = threading.Lock()
 
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        self.priority_eps = priority_eps
+        if self.prioritized:
+            self._init_priorities()
+
+        # serializes writers and guards the priorities; samplers only take it to draw prioritized
+        # indices, never while gathering
         self.lock = threading.Lock()
 
+    def _storage_shape(self, key):
+        shape = self.buffer_shapes[key]
+        return shape[1:] if key in self.constant_keys else shape
+
+    def _allocate(self, key, shape, dtype):
+        return np.empty(shape, dtype)
+
+    def _sample_uniform_idxs(self, batch_size):
+        """Draws episodes uniformly and a valid time step within each of them, all at once.
+        """
+        episode_idxs = np.random.randint(0, self.current_size, batch_size)
+        t_samples = (np.random.uniform(size=batch_size) * self.valid_lengths[episode_idxs]).astype(np.int64)
+        return episode_idxs, t_samples
+
+    def sample_idxs(self, batch_size):
+        """Returns the episode indices and time steps of `batch_size` uniformly drawn valid
+        transitions, for callers that gather from `get_current_buffers` themselves.
+        """
+        return self._sample_uniform_idxs(batch_size)
+
+    def _refresh_sk_r_cache(self, ddpg):
+        """Recomputes the cached intrinsic rewards of the valid steps of all episodes that are new
+        or older than the allowed staleness, a few large discriminator calls at a time.
+        """
+        version = ddpg.sk_version
+        versions = self.sk_r_version[:self.current_size]
+        stale = np.flatnonzero((versions < 0) | (versions + self.sk_r_cache_staleness < version))
+        if len(stale) == 0:
+            return
+
+        chunk = max(1, self.sk_r_cache_chunk // self.T)
+        for start in range(0, len(stale), chunk):
+            episode_idxs = stale[start:start + chunk]
+            generations = self.generations[episode_idxs]
+            # padding steps are never sampled, they keep a zero reward
+            valid = np.arange(self.T) < self.valid_lengths[episode_idxs][:, np.newaxis]
+            o = self.buffers['o'][episode_idxs]
+            z = self.buffers['z'][episode_idxs]
+            if 'z' in self.constant_keys:
+                z = np.broadcast_to(z[:, np.newaxis], (len(episode_idxs), *self.buffer_shapes['z']))
+            u = self.buffers['u'][episode_idxs]
+            sk_r = np.zeros((len(episode_idxs), self.T), np.float32)
+            # the constraint values of the recomputed episodes are not logged as training statistics
+            sk_r[valid] = np.reshape(ddpg.run_sk(o[:, :-1][valid], z[valid], o[:, 1:][valid], u[valid], record=False), -1)
+            with self.lock:
+                # episodes that were overwritten meanwhile stay stale
+                unchanged = (self.generations[episode_idxs] == generations) & (generations % 2 == 0)
+                self.sk_r_cache[episode_idxs[unchanged]] = sk_r[unchanged]
+                self.sk_r_version[episode_idxs[unchanged]] = version
+
+    def _init_priorities(self):
+        # one leaf per (episode, t) slot, indexed by episode * T + t
+        capacity = 1
+        while capacity < self.size * self.T:
+            capacity *= 2
+        self.sum_tree = SumSegmentTree(capacity)
+        self.min_tree = MinSegmentTree(capacity)
+        self.max_priority = 1.0
+
+    def _reset_priorities(self, episode_idxs, valids):
+        """Gives the valid steps of the given episodes the maximum priority seen so far, so that
+        new transitions are sampled at least once, and excludes the padded steps from sampling.
+        """
+        episode_idxs = np.atleast_1d(episode_idxs)
+        idxs = (episode_idxs[:, np.newaxis] * self.T + np.arange(self.T)).flatten()
+        valid = np.asarray(valids).reshape(-1) > 0
+        priority = self.max_priority ** self.alpha
+        self.sum_tree[idxs] = np.where(valid, priority, 0.)
+        self.min_tree[idxs] = np.where(valid, priority, np.inf)
+
+    def _sample_prioritized_idxs(self, batch_size):
+        """Draws one transition from each of `batch_size` equal slices of the total priority mass
+        and returns their flat indices together with normalized importance-sampling weights.
+        """
+        total = self.sum_tree.sum()
+        mass = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * (total / batch_size)
+        idxs = self.sum_tree.find_prefixsum_idx(np.minimum(mass, np.nextafter(total, 0)))
+        # (p_i / p_min) ** -beta is the usual (N * P(i)) ** -beta weight divided by its maximum
+        weights = (self.sum_tree[idxs] / self.min_tree.min()) ** (-self.beta)
+        return idxs, weights.astype(np.float32)
+
+    def update_priorities(self, idxs, td_errors, generations):
+        """Sets the priorities of the transitions at the flat indices `idxs` from their TD errors.
+        Transitions whose episode was overwritten since it was sampled at `generations`, or that
+        lie past its valid steps, are skipped.
+        """
+        idxs = np.asarray(idxs)
+        priorities = np.abs(np.asarray(td_errors).reshape(-1)) + self.priority_eps
+        with self.lock:
+            episode_idxs = idxs // self.T
+            kept = ((self.generations[episode_idxs] == generations)
+                    & (idxs % self.T < self.valid_lengths[episode_idxs]))
+            if not kept.any():
+                return
+            idxs, priorities = idxs[kept], priorities[kept]
+            self.sum_tree[idxs] = priorities ** self.alpha
+            self.min_tree[idxs] = priorities ** self.alpha
+            self.max_priority = max(self.max_priority, priorities.max())
+
     @property
     def full(self):
         with self.lock:
             return self.current_size == self.size
 
-    def sample(self, ddpg, ir, batch_size, sk_r_scale, t):
-        """Returns a dict {key: array(batch_size x shapes[key])}
+    def get_current_buffers(self):
+        """Returns a dict {key: array(current_size x (T or T+1) x dim_key)} of views into the
+        stored episodes. Episode-constant keys are broadcast along the time axis without copying.
+        The views are not locked; episodes may be overwritten while they are read.
         """
         buffers = {}
 
-        with self.lock:
-            assert self.current_size > 0
-            for key in self.buffers.keys():
-                buffers[key] = self.buffers[key][:self.current_size]
+        current_size = self.current_size
+        assert current_size > 0
+        for key in self.buffers.keys():
+            buffers[key] = self.buffers[key][:current_size]
+            if key in self.constant_keys:
+                buffers[key] = np.broadcast_to(buffers[key][:, np.newaxis],
+                                               (current_size, *self.buffer_shapes[key]))
 
         buffers['o_2'] = buffers['o'][:, 1:, :]
         buffers['ag_2'] = buffers['ag'][:, 1:, :]
 
-        transitions = self.sample_transitions(ddpg, ir, buffers, batch_size, sk_r_scale, t)
+        return buffers
+
+    def sample(self, ddpg, ir, batch_size, sk_r_scale, t, keys=None, uniform=False):
+        """Returns a dict {key: array(batch_size x shapes[key])}, restricted to `keys` if given.
+        A prioritized buffer also returns the importance-sampling weights 'w', the flat indices
+        'idxs' of the sampled transitions and the 'generations' of their episodes, to be passed
+        back to update_priorities, unless uniform is set to ignore the priorities.
+        """
+        use_sk_r_cache = ir and sk_r_scale > 0 and self.sk_r_cache_staleness is not None
+        if use_sk_r_cache:
+            with self.sk_r_lock:
+                self._refresh_sk_r_cache(ddpg)
+
+        transitions = self._sample_consistent(ddpg, ir, batch_size, sk_r_scale, t, keys, use_sk_r_cache, uniform)
+        rows = np.arange(batch_size)
+        stale = transitions.pop('stale')
+        retries = 0
+        while stale.any():
+            retries += 1
+            if retries > self.max_sample_retries:
+                raise RuntimeError('replay buffer kept being overwritten while sampling')
+            # redraw the rows whose episode was written to while they were gathered
+            rows = rows[stale]
+            redrawn = self._sample_consistent(ddpg, ir, len(rows), sk_r_scale, t, keys, use_sk_r_cache, uniform)
+            stale = redrawn.pop('stale')
+            for key, value in redrawn.items():
+                if np.ndim(value) > 0:
+                    transitions[key][rows] = value
 
-        for key in (['r', 'o_2', 'ag_2'] + list(self.buffers.keys())):
+        if keys is None:
+            keys = ['o_2', 'ag_2'] + list(self.buffers.keys())
+        for key in ['r'] + list(keys):
             if not (key == 's' or key == 'p'):
                 assert key in transitions, "key %s missing from transitions" % key
 
         return transitions
 
+    def _sample_consistent(self, ddpg, ir, batch_size, sk_r_scale, t, keys, use_sk_r_cache, uniform=False):
+        """Draws and gathers one batch of transitions without holding the lock. The 'stale'
+        entry flags the transitions whose episode was (being) overwritten in the meantime.
+        """
+        prioritized = self.prioritized and not uniform
+        if prioritized:
+            with self.lock:
+                idxs, weights = self._sample_prioritized_idxs(batch_size)
+            episode_idxs, t_samples = idxs // self.T, idxs % self.T
+        else:
+            episode_idxs, t_samples = self._sample_uniform_idxs(batch_size)
+        generations = self.generations[episode_idxs]
+
+        buffers = self.get_current_buffers()
+        if use_sk_r_cache:
+            buffers['sk_r'] = self.sk_r_cache[:len(buffers['u'])]
+
+        transitions = self.sample_transitions(ddpg, ir, buffers, batch_size, sk_r_scale, t,
+                                              idxs=(episode_idxs, t_samples), keys=keys)
+        if prioritized:
+            transitions['w'] = weights
+            transitions['idxs'] = idxs
+            transitions['generations'] = generations
+
+        transitions['stale'] = ((self.generations[episode_idxs] != generations) | (generations % 2 == 1)
+                                | (t_samples >= self.valid_lengths[episode_idxs]))
+        return transitions
+
     def store_episode(self, episode_batch, ddpg):
         """episode_batch: array(batch_size x (T or T+1) x dim_key)
         """
         batch_sizes = [len(episode_batch[key]) for key in episode_batch.keys()]
         assert np.all(np.array(batch_sizes) == batch_sizes[0])
-        batch_size = batch_sizes[0]
+
+        # episodes without valid steps (e.g. an environment that failed on its first step) would
+        # only ever be drawn as stale transitions
+        nonempty = np.sum(episode_batch['myv'], axis=1) > 0
+        if not nonempty.all():
+            episode_batch = {key: value[nonempty] for key, value in episode_batch.items()}
+        batch_size = int(nonempty.sum())
+        if batch_size == 0:
+            return
 
         with self.lock:
             idxs = self._get_storage_idx(batch_size)
+            # episodes dropped by reservoir sampling are not stored
+            kept = idxs >= 0
+            idxs = idxs[kept]
+            # mark the slots as being written and take them out of prioritized sampling
+            self.generations[idxs] += 1
+            if self.prioritized:
+                self._reset_priorities(idxs, np.zeros((len(idxs), self.T)))
 
-            # load inputs into buffers
-            for key in self.buffers.keys():
-                self.buffers[key][idxs] = episode_batch[key]
+        # load inputs into buffers; samplers detect a concurrent read through the generations
+        for key in self.buffers.keys():
+            if key in self.constant_keys:
+                self.buffers[key][idxs] = episode_batch[key][kept, 0]
+            else:
+                self.buffers[key][idxs] = episode_batch[key][kept]
 
-            self.n_transitions_stored += batch_size * self.T
+        with self.lock:
+            self.valid_lengths[idxs] = np.sum(episode_batch['myv'][kept], axis=1)
+            if self.sk_r_cache_staleness is not None:
+                self.sk_r_version[idxs] = -1
+            if self.prioritized:
+                self._reset_priorities(idxs, episode_batch['myv'][kept])
+            if len(idxs) > 0:
+                self.current_size = max(self.current_size, int(idxs.max()) + 1)
+            self.generations[idxs] += 1
+
+            self.n_transitions_stored += len(idxs) * self.T
 
     def get_current_episode_size(self):
         with self.lock:
             return self.current_size
 
+    def flush(self):
+        """Writes the stored episodes to persistent storage. In-memory buffers have none.
+        """
+        pass
+
     def get_current_size(self):
         with self.lock:
             return self.current_size * self.T
@@ -85,12 +338,27 @@ class ReplayBuffer:
     def clear_buffer(self):
         with self.lock:
             self.current_size = 0
+            self.next_idx = 0
+            self.n_episodes_seen = 0
+            if self.prioritized:
+                self._init_priorities()
 
     def _get_storage_idx(self, inc=None):
+        """Returns the slots for the next `inc` episodes, -1 for episodes that reservoir sampling
+        drops. The replay size is updated by the caller once the episodes are written.
+        """
         inc = inc or 1   # size increment
         assert inc <= self.size, "Batch committed to replay is too large!"
+        if self.eviction == 'fifo':
+            idx = (self.next_idx + np.arange(inc)) % self.size
+            self.next_idx = (self.next_idx + inc) % self.size
+        elif self.eviction == 'reservoir':
+            # episode n replaces a random slot with probability size / (n + 1)
+            n = self.n_episodes_seen + np.arange(inc)
+            idx = np.where(n < self.size, n, np.random.randint(0, n + 1))
+            idx[idx >= self.size] = -1
         # go consecutively until you hit the end, and then go randomly.
-        if self.current_size+inc <= self.size:
+        elif self.current_size+inc <= self.size:
             idx = np.arange(self.current_size, self.current_size+inc)
         elif self.current_size < self.size:
             overflow = inc - (self.size - self.current_size)
@@ -99,10 +367,259 @@ class ReplayBuffer:
             idx = np.concatenate([idx_a, idx_b])
         else:
             idx = np.random.randint(0, self.size, inc)
+        self.n_episodes_seen += inc
 
-        # update replay size
-        self.current_size = min(self.size, self.current_size+inc)
-
-        if inc == 1:
-            idx = idx[0]
         return idx
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    def __init__(self, buffer_shapes, size_in_transitions, T, sample_transitions, buffer_dtypes=None,
+                 constant_keys=(), storage_dir=None, flush_interval=None, **kwargs):
+        """Creates a replay buffer whose storage lives in memory-mapped .npy files, one per key.
+        Reopening a directory that was written with the same buffer layout resumes from the
+        header saved by the last `store_episode` call, without reading the stored episodes.
+
+        Only the header is written on every `store_episode`; the stored episodes reach the files
+        through the page cache, which survives the process being killed. They are synced to disk
+        by `flush` and every flush_interval calls of `store_episode`.
+
+        Args:
+            storage_dir (str): the directory holding the per-key files and `header.json`
+            flush_interval (int): the number of `store_episode` calls between syncs of the
+                stored episodes to disk (None: only on `flush`)
+            (the remaining arguments are the same as for ReplayBuffer; priorities are kept in
+            memory only and start from scratch when the buffer is resumed)
+        """
+        assert storage_dir is not None, "MemmapReplayBuffer requires a storage directory"
+        self.storage_dir = storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
+
+        header = self._read_header()
+        self.resumed = (header is not None and header['size'] == size_in_transitions // T
+                        and header['T'] == T)
+
+        super().__init__(buffer_shapes, size_in_transitions, T, sample_transitions, buffer_dtypes, constant_keys,
+                         **kwargs)
+
+        if self.resumed:
+            self.current_size = header['current_size']
+            self.n_transitions_stored = header['n_transitions_stored']
+            self.next_idx = header.get('next_idx', self.current_size % self.size)
+            self.n_episodes_seen = header.get('n_episodes_seen', self.current_size)
+            self.valid_lengths[:self.current_size] = np.sum(self.buffers['myv'][:self.current_size], axis=1)
+            if self.prioritized:
+                self._reset_priorities(np.arange(self.current_size), self.buffers['myv'][:self.current_size])
+        self.flush_interval = flush_interval
+        self.n_unflushed_stores = 0
+        self._write_header()
+
+    @property
+    def header_path(self):
+        return os.path.join(self.storage_dir, 'header.json')
+
+    def _allocate(self, key, shape, dtype):
+        path = os.path.join(self.storage_dir, '{}.npy'.format(key))
+        if self.resumed and os.path.exists(path):
+            array = np.lib.format.open_memmap(path, mode='r+')
+            if array.shape == tuple(shape) and array.dtype == np.dtype(dtype):
+                return array
+            del array
+        # a key whose file is missing or has a different layout invalidates the stored episodes
+        self.resumed = False
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def _read_header(self):
+        if not os.path.exists(self.header_path):
+            return None
+        with open(self.header_path, 'r') as f:
+            return json.load(f)
+
+    def _flush_arrays(self):
+        for array in self.buffers.values():
+            array.flush()
+        self.n_unflushed_stores = 0
+
+    def _write_header(self):
+        header = dict(
+            size=self.size,
+            T=self.T,
+            current_size=self.current_size,
+            n_transitions_stored=self.n_transitions_stored,
+            next_idx=self.next_idx,
+            n_episodes_seen=self.n_episodes_seen,
+        )
+        # write-then-rename so that a job killed mid-write never leaves a truncated header
+        tmp_path = self.header_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(header, f)
+        os.replace(tmp_path, self.header_path)
+
+    def store_episode(self, episode_batch, ddpg):
+        super().store_episode(episode_batch, ddpg)
+        with self.lock:
+            self.n_unflushed_stores += 1
+            if self.flush_interval and self.n_unflushed_stores >= self.flush_interval:
+                self._flush_arrays()
+            self._write_header()
+
+    def flush(self):
+        with self.lock:
+            self._flush_arrays()
+            self._write_header()
+
+    def clear_buffer(self):
+        super().clear_buffer()
+        with self.lock:
+            self._write_header()
+
+
+class PackedEpisodes:
+    def __init__(self, data, offsets, lengths, T, shift=0):
+        """A read-only (episode, t) view of a key that is stored as one flat array of steps.
+        Episode i occupies the rows offsets[i] ... offsets[i] + lengths[i]; time steps past the
+        end of an episode are clamped to its last row, which holds the final observation.
+        """
+        self.data = data
+        self.offsets = offsets
+        self.lengths = lengths
+        self.shift = shift
+        self.shape = (len(offsets), T, *data.shape[1:])
+
+    def __getitem__(self, idx):
+        episode_idxs, t = idx
+        t = np.minimum(np.asarray(t) + self.shift, self.lengths[episode_idxs])
+        return self.data[self.offsets[episode_idxs] + t]
+
+
+class PackedReplayBuffer(ReplayBuffer):
+    def __init__(self, buffer_shapes, size_in_transitions, T, sample_transitions, buffer_dtypes=None,
+                 constant_keys=(), max_episodes=None, max_sample_retries=100, **kwargs):
+        """Creates a replay buffer that only stores the valid steps of each episode (as given by
+        its 'myv' mask) in flat per-key arrays, together with an index of episode offsets and
+        lengths. Episodes are evicted oldest first. Sampling draws episodes uniformly and a valid
+        step within each of them, like ReplayBuffer.
+
+        Args:
+            max_episodes (int): the number of episodes that can be indexed, by default enough for
+                episodes of two steps
+            (the remaining arguments are the same as for ReplayBuffer; prioritized replay and
+            the intrinsic-reward cache are not supported)
+        """
+        assert not kwargs.get('prioritized'), "PackedReplayBuffer does not support prioritized replay"
+        assert kwargs.get('sk_r_cache_staleness') is None, "PackedReplayBuffer does not cache intrinsic rewards"
+        assert kwargs.get('eviction', 'fifo') == 'fifo', "PackedReplayBuffer only evicts the oldest episodes"
+        self.buffer_shapes = buffer_shapes
+        self.T = T
+        self.sample_transitions = sample_transitions
+        self.buffer_dtypes = {key: np.float32 for key in buffer_shapes.keys()}
+        self.buffer_dtypes['s'] = np.float32
+        self.buffer_dtypes.update(buffer_dtypes or {})
+        self.constant_keys = set(constant_keys)
+
+        # every episode of length L takes L + 1 rows, the last one for the final observation
+        self.n_rows = size_in_transitions + size_in_transitions // T
+        self.size = max_episodes or self.n_rows // 2
+        self.buffers = {}
+        for key, shape in buffer_shapes.items():
+            if key in self.constant_keys:
+                self.buffers[key] = np.empty([self.size, *shape[1:]], self.buffer_dtypes[key])
+            else:
+                self.buffers[key] = np.empty([self.n_rows, *shape[1:]], self.buffer_dtypes[key])
+        self.buffers['s'] = np.empty([self.size, 1], self.buffer_dtypes['s'])
+
+        # episode index, a ring of self.size slots of which current_size, starting at oldest, are live
+        self.offsets = np.zeros(self.size, np.int64)
+        self.valid_lengths = np.zeros(self.size, np.int64)
+        self.oldest = 0
+        self.current_size = 0
+        # first free row
+        self.head = 0
+        self.n_transitions_stored = 0
+        self.eviction = 'fifo'
+        self.prioritized = False
+        self.sk_r_cache_staleness = None
+
+        # odd while an episode slot is unused, evicted or being written, see ReplayBuffer.sample
+        self.generations = np.ones(self.size, np.int64)
+        self.max_sample_retries = max_sample_retries
+
+        self.lock = threading.Lock()
+
+    def _sample_uniform_idxs(self, batch_size):
+        oldest, current_size = self.oldest, self.current_size
+        episode_idxs = (oldest + np.random.randint(0, current_size, batch_size)) % self.size
+        t_samples = (np.random.uniform(size=batch_size) * self.valid_lengths[episode_idxs]).astype(np.int64)
+        return episode_idxs, t_samples
+
+    def get_current_buffers(self):
+        """Returns a dict {key: (episode, t)-indexable view} over all episode slots; only the
+        slots returned by the sampler hold live episodes.
+        """
+        assert self.current_size > 0
+        buffers = {}
+        for key, shape in self.buffer_shapes.items():
+            if key in self.constant_keys:
+                buffers[key] = np.broadcast_to(self.buffers[key][:, np.newaxis], (self.size, *shape))
+            else:
+                buffers[key] = PackedEpisodes(self.buffers[key], self.offsets, self.valid_lengths, self.T)
+        buffers['s'] = self.buffers['s']
+        buffers['o_2'] = PackedEpisodes(self.buffers['o'], self.offsets, self.valid_lengths, self.T, shift=1)
+        buffers['ag_2'] = PackedEpisodes(self.buffers['ag'], self.offsets, self.valid_lengths, self.T, shift=1)
+        return buffers
+
+    def _evict_oldest(self):
+        self.generations[self.oldest] += 1
+        self.oldest = (self.oldest + 1) % self.size
+        self.current_size -= 1
+
+    def _allocate_rows(self, n):
+        """Returns the first of n contiguous free rows, evicting the oldest episodes in their way."""
+        if self.head + n > self.n_rows:
+            # the rows at the end are too few, evict the episodes there and wrap around
+            while self.current_size > 0 and self.offsets[self.oldest] >= self.head:
+                self._evict_oldest()
+            self.head = 0
+        while self.current_size > 0 and self.head <= self.offsets[self.oldest] < self.head + n:
+            self._evict_oldest()
+        start = self.head
+        self.head += n
+        return start
+
+    def store_episode(self, episode_batch, ddpg):
+        """episode_batch: array(batch_size x (T or T+1) x dim_key)
+        """
+        lengths = np.sum(episode_batch['myv'], axis=1).astype(np.int64)
+        for i in np.flatnonzero(lengths > 0):
+            length = lengths[i]
+            with self.lock:
+                if self.current_size == self.size:
+                    self._evict_oldest()
+                start = self._allocate_rows(length + 1)
+                idx = (self.oldest + self.current_size) % self.size
+
+            for key in self.buffers.keys():
+                if key == 's':
+                    self.buffers[key][idx] = episode_batch[key][i]
+                elif key in self.constant_keys:
+                    self.buffers[key][idx] = episode_batch[key][i, 0]
+                else:
+                    # keys with T + 1 steps keep their final observation in the last row
+                    steps = min(length + 1, len(episode_batch[key][i]))
+                    self.buffers[key][start:start + steps] = episode_batch[key][i, :steps]
+
+            with self.lock:
+                self.offsets[idx] = start
+                self.valid_lengths[idx] = length
+                self.current_size += 1
+                self.generations[idx] += 1
+                self.n_transitions_stored += length
+
+    def get_current_size(self):
+        with self.lock:
+            return int(np.sum(self.valid_lengths[(self.oldest + np.arange(self.current_size)) % self.size]))
+
+    def clear_buffer(self):
+        with self.lock:
+            for _ in range(self.current_size):
+                self._evict_oldest()
+            self.head = 0
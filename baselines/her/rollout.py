@@ -4,14 +4,16 @@ import numpy as np
 import pickle
 from mujoco_py import MujocoException
 
-from baselines.her.util import convert_episode_to_batch_major, store_args
+from baselines.common.vec_env.shmem_vec_env import ShmemVecEnv
+from baselines.her.util import store_args
 
 class RolloutWorker:
 
     @store_args
     def __init__(self, make_env, policy, dims, logger, T, rollout_batch_size=1,
                  exploit=False, use_target_net=False, compute_Q=False, noise_eps=0,
-                 random_eps=0, history_len=100, render=False, **kwargs):
+                 random_eps=0, history_len=100, render=False, parallel_envs=0, recover_envs=False,
+                 max_rollout_attempts=10, **kwargs):
         """Rollout worker generates experience by interacting with one or many environments.
 
         Args:
@@ -29,12 +31,30 @@ class RolloutWorker:
             random_eps (float): probability of selecting a completely random action
             history_len (int): length of history for statistics smoothing
             render (boolean): whether or not to render the rollouts
+            parallel_envs (int): if > 0, the environments are stepped in this many subprocesses
+                (not with render)
+            recover_envs (boolean): whether an environment that raises a MujocoException or returns
+                a NaN observation is reset on its own, with its remaining steps masked out of the
+                episode, instead of restarting the rollouts of all environments
+            max_rollout_attempts (int): the number of times the rollouts of all environments are
+                restarted after a failure before generate_rollouts raises
         """
-        self.envs = [make_env() for _ in range(rollout_batch_size)]
         assert self.T > 0
 
         self.info_keys = [key.replace('info_', '') for key in dims.keys() if key.startswith('info_')]
 
+        self.vec_env = None
+        if parallel_envs:
+            assert not render, 'rendering needs the environments in this process'
+            info_dims = {'is_success': 1, 'cur_step': 1}
+            info_dims.update({key: dims['info_' + key] for key in self.info_keys})
+            obs_dims = {'observation': dims['o'], 'achieved_goal': dims['g'], 'desired_goal': dims['g']}
+            self.vec_env = ShmemVecEnv([make_env] * rollout_batch_size, obs_dims, dims['u'], info_dims,
+                                       n_workers=parallel_envs, raise_env_errors=not recover_envs)
+            self.envs = []
+        else:
+            self.envs = [make_env() for _ in range(rollout_batch_size)]
+
         self.success_history = deque(maxlen=history_len)
         self.Q_history = deque(maxlen=history_len)
         self.episode_length_history = deque(maxlen=history_len)
@@ -42,6 +62,8 @@ class RolloutWorker:
         self.return_history = deque(maxlen=history_len)
 
         self.n_episodes = 0
+        # environments that raised a MujocoException or returned a NaN observation
+        self.n_env_failures = 0
         self.g = np.empty((self.rollout_batch_size, self.dims['g']), np.float32)  # goals
         self.initial_o = np.empty((self.rollout_batch_size, self.dims['o']), np.float32)  # observations
         self.initial_ag = np.empty((self.rollout_batch_size, self.dims['g']), np.float32)  # achieved goals
@@ -52,11 +74,17 @@ class RolloutWorker:
         """Resets the `i`-th rollout environment, re-samples a new goal, and updates the `initial_o`
         and `g` arrays accordingly.
         """
-        obs = self.envs[i].reset()
+        goal = generated_goal[i].copy() if isinstance(generated_goal, np.ndarray) else None
+        if self.vec_env is not None:
+            obs = self.vec_env.reset_env(i, goal)
+        else:
+            obs = self.envs[i].reset()
         if isinstance(obs, dict):
             self.g[i] = obs['desired_goal']
-            if isinstance(generated_goal, np.ndarray):
-                self.g[i] = self.envs[i].env.goal = generated_goal[i].copy()
+            if goal is not None:
+                self.g[i] = goal
+                if self.vec_env is None:
+                    self.envs[i].env.goal = goal
             self.initial_o[i] = obs['observation']
             self.initial_ag[i] = obs['achieved_goal']
         else:
@@ -67,37 +95,77 @@ class RolloutWorker:
     def reset_all_rollouts(self, generated_goal=False):
         """Resets all `rollout_batch_size` rollout workers.
         """
-        for i in range(self.rollout_batch_size):
-            self.reset_rollout(i, generated_goal)
+        if self.vec_env is None:
+            for i in range(self.rollout_batch_size):
+                self.reset_rollout(i, generated_goal)
+            return
+
+        obs = self.vec_env.reset(generated_goal if isinstance(generated_goal, np.ndarray) else None)
+        if isinstance(obs, dict):
+            self.g[:] = generated_goal if isinstance(generated_goal, np.ndarray) else obs['desired_goal']
+            self.initial_o[:] = obs['observation']
+            self.initial_ag[:] = obs['achieved_goal']
+        else:
+            self.g[:] = 0
+            self.initial_o[:] = obs
+            self.initial_ag[:] = 0
 
     def generate_rollouts(self, generated_goal=False, z_s_onehot=False, random_action=False):
         """Performs `rollout_batch_size` rollouts in parallel for time horizon `T` with the current
         policy acting on it accordingly.
+
+        With recover_envs, an environment that fails at step t is reset and keeps acting, but its
+        episode only keeps its t steps before the failure (an environment that fails on its first
+        step keeps none). Otherwise, a failure restarts the rollouts of all environments, at most
+        max_rollout_attempts times.
+        """
+        for attempt in range(self.max_rollout_attempts):
+            result = self._generate_rollouts(generated_goal, z_s_onehot, random_action)
+            if result is not None:
+                return result
+            self.logger.warn('Rollout generation failed (attempt {}/{}).'.format(attempt + 1, self.max_rollout_attempts))
+        raise RuntimeError('rollout generation failed {} times in a row'.format(self.max_rollout_attempts))
+
+    def _generate_rollouts(self, generated_goal, z_s_onehot, random_action):
+        """Performs one attempt of generate_rollouts, returns None if the rollouts of all
+        environments have to be restarted.
         """
         self.reset_all_rollouts(generated_goal)
 
-        # compute observations
-        o = np.empty((self.rollout_batch_size, self.dims['o']), np.float32)  # observations
-        ag = np.empty((self.rollout_batch_size, self.dims['g']), np.float32)  # achieved goals
-        o[:] = self.initial_o
-        ag[:] = self.initial_ag
-        z = z_s_onehot.copy()  # selected skills
+        # generate episodes, written step by step into batch-major arrays
+        B, T = self.rollout_batch_size, self.T
+        episode = dict(
+            o=np.empty((B, T + 1, self.dims['o']), np.float32),  # observations
+            z=np.empty((B, T, z_s_onehot.shape[1]), np.float32),  # selected skills
+            u=np.empty((B, T, self.dims['u']), np.float32),
+            g=np.empty((B, T, self.dims['g']), np.float32),
+            ag=np.empty((B, T + 1, self.dims['g']), np.float32),  # achieved goals
+            myr=np.zeros((B, T), np.float32),
+            myd=np.zeros((B, T), np.float32),
+            myv=np.empty((B, T), np.float32),
+        )
+        info_values = [np.empty((B, T, self.dims['info_' + key]), np.float32) for key in self.info_keys]
+        for key, value in zip(self.info_keys, info_values):
+            episode['info_{}'.format(key)] = value
+        episode['o'][:, 0] = self.initial_o
+        episode['ag'][:, 0] = self.initial_ag
+        episode['z'][:] = z_s_onehot[:, None]
+        episode['g'][:] = self.g[:, None]
+        z = episode['z'][:, 0]
 
-        # generate episodes
-        obs, zs, achieved_goals, acts, goals, successes = [], [], [], [], [], []
-        rewards, dones, valids = [], [], []
         HW = 200
         if self.render == 'rgb_array':
             imgs = np.empty([self.rollout_batch_size, self.T, HW, HW, 3])
         elif self.render == 'human':
             imgs = np.empty([self.rollout_batch_size, self.T, 992, 1648, 3])
-        info_values = [np.empty((self.T, self.rollout_batch_size, self.dims['info_' + key]), np.float32) for key in self.info_keys]
         Qs = []
         cur_valid = np.ones(self.rollout_batch_size)
+        recovered = np.zeros(self.rollout_batch_size, bool)
         lengths = np.full(self.rollout_batch_size, -1)
         once_successes = np.full(self.rollout_batch_size, 0)
         returns = np.zeros(self.rollout_batch_size)
         for t in range(self.T):
+            o, ag = episode['o'][:, t], episode['ag'][:, t]
             policy_output = self.policy.get_actions(
                 o, z, ag, self.g,
                 compute_Q=self.compute_Q,
@@ -117,61 +185,91 @@ class RolloutWorker:
                 # The non-batched case should still have a reasonable shape.
                 u = u.reshape(1, -1)
 
-            o_new = np.empty((self.rollout_batch_size, self.dims['o']))
-            ag_new = np.empty((self.rollout_batch_size, self.dims['g']))
+            if self.vec_env is not None:
+                # the subprocesses step the environments while this process records the step
+                self.vec_env.step_async(u)
+            episode['u'][:, t] = u
+            episode['myv'][:, t] = cur_valid
+
+            o_new, ag_new = episode['o'][:, t + 1], episode['ag'][:, t + 1]
             success = np.zeros(self.rollout_batch_size)
-            cur_reward = np.zeros(self.rollout_batch_size)
-            cur_done = np.zeros(self.rollout_batch_size)
+            cur_reward, cur_done = episode['myr'][:, t], episode['myd'][:, t]
+            if self.vec_env is not None:
+                try:
+                    vec_o_new, vec_reward, vec_done, vec_info = self.vec_env.step_wait()
+                except MujocoException as e:
+                    self.n_env_failures += 1
+                    return None
             # compute new states and observations
+            failed = []
             for i in range(self.rollout_batch_size):
                 try:
-                    curr_o_new, reward, done, info = self.envs[i].step(u[i])
-                    if 'is_success' in info:
-                        success[i] = info['is_success']
-                    cur_reward[i] = reward
-                    cur_done[i] = done
-                    if (done or t == self.T - 1) and lengths[i] == -1:
-                        if 'cur_step' in info:
-                            lengths[i] = info['cur_step']
-                        else:
-                            lengths[i] = t + 1
-                    if success[i] > 0:
-                        once_successes[i] = 1
-                    if cur_valid[i]:
-                        returns[i] += reward
-                    if isinstance(curr_o_new, dict):
-                        o_new[i] = curr_o_new['observation']
-                        ag_new[i] = curr_o_new['achieved_goal']
-                        for idx, key in enumerate(self.info_keys):
-                            info_values[idx][t, i] = info[key]
+                    if self.vec_env is not None:
+                        if 'error' in vec_info[i]:
+                            raise vec_info[i]['error']
+                        curr_o_new = ({key: value[i] for key, value in vec_o_new.items()}
+                                      if isinstance(vec_o_new, dict) else vec_o_new[i])
+                        reward, done, info = vec_reward[i], vec_done[i], vec_info[i]
                     else:
-                        o_new[i] = curr_o_new
-                        ag_new[i] = np.zeros_like(ag_new[i])
-                    if self.render:
-                        if self.render == 'rgb_array':
-                            imgs[i][t] = self.envs[i].render(mode='rgb_array', width=HW, height=HW)
-                        elif self.render == 'human':
-                            imgs[i][t] = self.envs[i].render()
-
+                        curr_o_new, reward, done, info = self.envs[i].step(u[i])
                 except MujocoException as e:
-                    return self.generate_rollouts()
-
-            if np.isnan(o_new).any():
-                self.logger.warning('NaN caught during rollout generation. Trying again...')
-                self.reset_all_rollouts()
-                return self.generate_rollouts()
-
-            obs.append(o.copy())
-            rewards.append(cur_reward.copy())
-            dones.append(cur_done.copy())
-            valids.append(cur_valid.copy())
-            zs.append(z.copy())
-            achieved_goals.append(ag.copy())
-            successes.append(success.copy())
-            acts.append(u.copy())
-            goals.append(self.g.copy())
-            o[...] = o_new
-            ag[...] = ag_new
+                    self.n_env_failures += 1
+                    if not self.recover_envs:
+                        return None
+                    failed.append(i)
+                    continue
+                if self.recover_envs and np.isnan(curr_o_new['observation'] if isinstance(curr_o_new, dict)
+                                                  else curr_o_new).any():
+                    self.n_env_failures += 1
+                    failed.append(i)
+                    continue
+
+                if 'is_success' in info:
+                    success[i] = info['is_success']
+                cur_reward[i] = reward
+                cur_done[i] = done
+                if (done or t == self.T - 1) and lengths[i] == -1:
+                    if 'cur_step' in info:
+                        lengths[i] = info['cur_step']
+                    else:
+                        lengths[i] = t + 1
+                if success[i] > 0 and not recovered[i]:
+                    once_successes[i] = 1
+                if cur_valid[i]:
+                    returns[i] += reward
+                if isinstance(curr_o_new, dict):
+                    o_new[i] = curr_o_new['observation']
+                    ag_new[i] = curr_o_new['achieved_goal']
+                    for idx, key in enumerate(self.info_keys):
+                        info_values[idx][i, t] = info[key]
+                else:
+                    o_new[i] = curr_o_new
+                    ag_new[i] = np.zeros_like(ag_new[i])
+                if self.render:
+                    if self.render == 'rgb_array':
+                        imgs[i][t] = self.envs[i].render(mode='rgb_array', width=HW, height=HW)
+                    elif self.render == 'human':
+                        imgs[i][t] = self.envs[i].render()
+
+            if failed:
+                self.logger.warn('{} environment(s) failed during rollout generation, resetting them...'.format(len(failed)))
+            for i in failed:
+                # the episode ends before the failing step, the reset environment keeps acting
+                # from its new state with its steps masked out
+                self.reset_rollout(i, generated_goal)
+                o_new[i], ag_new[i] = self.initial_o[i], self.initial_ag[i]
+                for idx in range(len(self.info_keys)):
+                    info_values[idx][i, t] = 0
+                episode['myv'][i, t] = cur_valid[i] = 0
+                recovered[i] = True
+                if lengths[i] == -1:
+                    lengths[i] = t
+
+            # with recover_envs, NaN observations were reset above like the other failures
+            if not self.recover_envs and np.isnan(o_new).any():
+                self.logger.warn('NaN caught during rollout generation.')
+                self.n_env_failures += 1
+                return None
 
             for i in range(len(cur_valid)):
                 if cur_done[i]:
@@ -179,25 +277,11 @@ class RolloutWorker:
 
         # success: success at the last step
         # once_success: once success
-        obs.append(o.copy())
-        achieved_goals.append(ag.copy())
-        self.initial_o[:] = o
+        self.initial_o[:] = episode['o'][:, -1]
 
-        successful = np.array(successes)[-1, :].copy()
-
-        episode = dict(
-            o=obs,
-            z=zs,
-            u=acts,
-            g=goals,
-            ag=achieved_goals,
-
-            myr=rewards,
-            myd=dones,
-            myv=valids,
-        )
-        for key, value in zip(self.info_keys, info_values):
-            episode['info_{}'.format(key)] = value
+        # a recovered environment is not counted as a success, its last step belongs to the
+        # episode it started after its reset
+        successful = np.where(recovered, 0., success)
 
         # stats
         assert successful.shape == (self.rollout_batch_size,)
@@ -211,9 +295,9 @@ class RolloutWorker:
         self.n_episodes += self.rollout_batch_size
 
         if self.render == 'rgb_array' or self.render == 'human':
-            return imgs, convert_episode_to_batch_major(episode)
+            return imgs, episode
 
-        return convert_episode_to_batch_major(episode)
+        return episode
 
     def clear_history(self):
         """Clears all histories that are used for statistics
@@ -248,6 +332,7 @@ class RolloutWorker:
         if self.compute_Q:
             logs += [('mean_Q', np.mean(self.Q_history))]
         logs += [('episode', self.n_episodes)]
+        logs += [('env_failures', self.n_env_failures)]
 
         if prefix is not '' and not prefix.endswith('/'):
             return [(prefix + '/' + key, val) for key, val in logs]
@@ -257,5 +342,7 @@ class RolloutWorker:
     def seed(self, seed):
         """Seeds each environment with a distinct seed derived from the passed in global seed.
         """
+        if self.vec_env is not None:
+            self.vec_env.seed([seed + 1000 * idx for idx in range(self.rollout_batch_size)])
         for idx, env in enumerate(self.envs):
             env.seed(seed + 1000 * idx)
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+from baselines.her.actor_pool import ActorPool, SharedWeights
+
+
+def _weights(scale):
+    return dict(o_stats=[np.full(3, scale), np.ones(3)], g_stats=[np.zeros(2), np.ones(2)],
+                pi=[(np.full((7, 4), scale), np.zeros(4)), (np.full((4, 2), scale), np.ones(2))],
+                Q=[(np.zeros((9, 1)), np.zeros(1))])
+
+
+class _ActorPolicy:
+    def __init__(self):
+        self.weights = None
+
+    def set_weights(self, weights):
+        self.weights = weights
+
+
+class _Policy:
+    def __init__(self):
+        self.n_train_steps = 0
+        self.stored = []
+
+    def export_numpy_policy(self):
+        return _ActorPolicy()
+
+    def export_numpy_weights(self):
+        return _weights(float(self.n_train_steps))
+
+    def store_episode(self, episode):
+        self.stored.append(episode)
+
+
+class _Worker:
+    def __init__(self, policy, noise_eps, random_eps, fail=False):
+        self.policy = policy
+        self.noise_eps = noise_eps
+        self.fail = fail
+
+    def seed(self, seed):
+        pass
+
+    def generate_rollouts(self, random_action, z_s_onehot):
+        if self.fail:
+            raise ValueError('rollout failed')
+        scale = self.policy.weights['o_stats'][0][0]
+        return dict(u=np.full((2, 5, 2), scale), myr=np.ones((2, 5)), myv=np.ones((2, 5)),
+                    noise_eps=self.noise_eps, random_action=random_action)
+
+
+def test_shared_weights_roundtrip():
+    weights = SharedWeights(_weights(1.), version=3)
+    version, read = weights.read()
+    assert version == 3
+    np.testing.assert_allclose(read['pi'][1][0], np.ones((4, 2)))
+    assert read['Q'] == []
+    weights.write(_weights(2.), version=4)
+    version, read = weights.read()
+    assert version == 4 and read['o_stats'][0][0] == 2.
+
+
+def test_actor_pool():
+    policy = _Policy()
+    pool = ActorPool(policy, _Worker, lambda n: dict(z_s_onehot=None), n_actors=3, noise_eps=0.5, random_eps=0.5,
+                     queue_size=2, exploration_alpha=2.)
+    # the first actor explores the most
+    np.testing.assert_allclose([noise_eps for noise_eps, _ in pool.exploration], [0.5, 0.25, 0.125])
+
+    pool.set_random_action(True)
+    episodes = pool.store_episodes(min_rollouts=4)
+    assert len(episodes) >= 4 and len(policy.stored) == len(episodes)
+    pool.set_random_action(False)
+    policy.n_train_steps = 10
+    pool.publish()
+    for _ in range(20):
+        # rollouts generated after publish act with the new weights and no random actions
+        episode = pool.store_episodes()[-1]
+        if episode['u'][0, 0, 0] == 10. and not episode['random_action']:
+            break
+    else:
+        pytest.fail('the actors did not pick up the published weights')
+
+    logs = dict(pool.logs())
+    assert logs['actors/steps_per_second'] > 0
+    assert 'actors/actor_2/blocked_time' in logs
+    pool.close()
+    assert not any(p.is_alive() for p in pool.ps)
+
+
+def test_actor_pool_reraises_errors():
+    pool = ActorPool(_Policy(), lambda *args: _Worker(*args, fail=True), lambda n: dict(z_s_onehot=None),
+                     n_actors=1, noise_eps=0., random_eps=0.)
+    with pytest.raises(RuntimeError):
+        pool.store_episodes()
+    pool.close()
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from baselines.her.experiment.benchmark_training import make_policy
+
+
+def _run(train, **kwargs):
+    """Builds a small agent from a fixed seed in a fresh graph, without SAC sampling or spectral
+    normalization so that its updates are deterministic, and returns the result of train(policy)
+    and the values of all trainable variables afterwards.
+    """
+    tf.compat.v1.disable_eager_execution()
+    with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+        np.random.seed(0)
+        tf.compat.v1.set_random_seed(0)
+        params = dict(dimo=5, dimz=2, dimg=2, dimu=2, T=5, hidden=16, layers=2, batch_size=8, sac=0,
+                      spectral_normalization=0)
+        params.update(kwargs)
+        policy = make_policy(**params)
+        result = train(policy)
+        return result, sess.run(tf.compat.v1.trainable_variables())
+
+
+def _assert_allclose(a, b, **kwargs):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        np.testing.assert_allclose(x, y, **kwargs)
+
+
+def test_graph_optimizer_matches_mpi():
+    def train(policy):
+        return [policy.train(0) for _ in range(3)]
+
+    losses_mpi, variables_mpi = _run(train, optimizer_mode='mpi')
+    losses_graph, variables_graph = _run(train, optimizer_mode='graph')
+    _assert_allclose(losses_mpi, losses_graph, rtol=1e-5)
+    _assert_allclose(variables_mpi, variables_graph, rtol=1e-5, atol=1e-6)
+
+
+def _sample_cycle(policy, n_batches=4):
+    batches = [policy.sample_batch(ir=True, t=0) for _ in range(n_batches)]
+    sk_batches = [policy.sample_discriminator_batch(policy.batch_size) for _ in range(n_batches)]
+    return batches, sk_batches
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'dual_reg': 0}, {'dual_dist': 'l2'}, {'prioritized_replay': 1},
+                                    {'skill_type': 'discrete'}])
+def test_train_cycle_matches_sequential_updates(kwargs):
+    def train_sequential(policy):
+        batches, sk_batches = _sample_cycle(policy)
+        losses = []
+        for batch, sk_batch in zip(batches, sk_batches):
+            policy.stage_batch(ir=True, t=0, batch=batch)
+            losses.append(policy.train(0, stage=False))
+            policy.train_discriminators(sk_batch)
+        policy.update_target_net()
+        return np.array(losses)
+
+    def train_fused(policy):
+        return np.stack(policy.train_cycle(*_sample_cycle(policy)), axis=1)
+
+    losses_sequential, variables_sequential = _run(train_sequential, optimizer_mode='graph', **kwargs)
+    losses_fused, variables_fused = _run(train_fused, optimizer_mode='graph', **kwargs)
+    np.testing.assert_array_equal(losses_sequential, losses_fused)
+    _assert_allclose(variables_sequential, variables_fused, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize('sac', [0, 1])
+def test_exported_numpy_policy_matches_graph(sac):
+    def compare(policy):
+        # move the weights and the normalizer statistics away from their initial values
+        policy.train(0)
+        rng = np.random.RandomState(1)
+        policy.o_stats.update(rng.randn(100, policy.dimo) * 5. + 3.)
+        policy.g_stats.update(rng.randn(100, policy.dimg) * 2. - 1.)
+        policy.sync_normalizers()
+        o, z, g = rng.randn(6, policy.dimo) * 3., rng.randn(6, policy.dimz), rng.randn(6, policy.dimg)
+        numpy_policy = policy.export_numpy_policy()
+        if sac:
+            # Q_pi of SAC is evaluated at a sampled action
+            return [policy.get_actions(o, z, None, g)], [numpy_policy.get_actions(o, z, None, g)]
+        return (policy.get_actions(o, z, None, g, compute_Q=True),
+                numpy_policy.get_actions(o, z, None, g, compute_Q=True))
+
+    (expected, actual), _ = _run(compare, sac=sac)
+    _assert_allclose(expected, actual, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('optimizer_mode', ['mpi', 'graph'])
+def test_train_discriminators_matches_separate_calls(optimizer_mode):
+    def train_separately(policy):
+        losses = []
+        for _ in range(3):
+            batch = policy.sample_discriminator_batch(policy.batch_size)
+            losses.append((np.mean(policy.train_sk(*batch)), policy.train_sk_dist(*batch[:3], {})))
+        return np.array(losses)
+
+    def train_in_one_call(policy):
+        losses = []
+        for _ in range(3):
+            stats = policy.train_discriminators(policy.sample_discriminator_batch(policy.batch_size))
+            losses.append((stats['sk_loss'], stats['sk_dist_loss']))
+        return np.array(losses)
+
+    losses_separate, variables_separate = _run(train_separately, optimizer_mode=optimizer_mode)
+    losses_one_call, variables_one_call = _run(train_in_one_call, optimizer_mode=optimizer_mode)
+    np.testing.assert_allclose(losses_separate, losses_one_call, rtol=1e-6)
+    # the discriminator, its dual variable and its distance model
+    _assert_allclose(variables_separate, variables_one_call, rtol=1e-6, atol=1e-7)
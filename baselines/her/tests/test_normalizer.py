@@ -0,0 +1,36 @@
+import numpy as np
+import tensorflow as tf
+
+from baselines.her.normalizer import Normalizer, synchronize_normalizers
+
+
+def test_synchronized_stats_match_numpy():
+    tf.compat.v1.disable_eager_execution()
+    with tf.Graph().as_default(), tf.compat.v1.Session() as sess:
+        with tf.compat.v1.variable_scope('o_stats'):
+            o_stats = Normalizer(3, eps=1e-2, sess=sess)
+        with tf.compat.v1.variable_scope('g_stats'):
+            g_stats = Normalizer(2, eps=1e-2, sess=sess)
+        sess.run(tf.compat.v1.global_variables_initializer())
+
+        rng = np.random.RandomState(0)
+        o = [rng.randn(2, 50, 3) * [1., 10., 0.1] + [5., -3., 100.] for _ in range(4)]
+        g = [rng.randn(2, 50, 2) for _ in range(4)]
+        for i in range(4):
+            o_stats.update(o[i])
+            g_stats.update(g[i])
+            if i % 2 == 1:
+                synchronize_normalizers([o_stats, g_stats], sess)
+
+        for stats, v in [(o_stats, o), (g_stats, g)]:
+            # the graph starts from one zero sample
+            v = np.concatenate([np.zeros((1, stats.size))] + [x.reshape(-1, stats.size) for x in v])
+            mean, std, count = sess.run([stats.mean, stats.std, stats.count_tf])
+            np.testing.assert_allclose(mean, v.mean(axis=0), rtol=1e-5, atol=1e-5)
+            np.testing.assert_allclose(std, np.maximum(v.std(axis=0), 1e-2), rtol=1e-5, atol=1e-5)
+            assert count[0] == len(v)
+
+        # the synchronized moments can be read back from the graph
+        expected = o_stats.global_mean.copy()
+        o_stats.load_stats()
+        np.testing.assert_allclose(o_stats.global_mean, expected, rtol=1e-5, atol=1e-5)
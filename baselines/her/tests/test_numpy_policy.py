@@ -0,0 +1,74 @@
+import numpy as np
+
+from baselines.her.numpy_policy import NumpyPolicy
+
+
+def _make_weights(dims, rng):
+    return [(rng.randn(n_in, n_out).astype(np.float32), rng.randn(n_out).astype(np.float32))
+            for n_in, n_out in zip(dims[:-1], dims[1:])]
+
+
+def _make_policy(sac, dimo=3, dimz=2, dimg=2, dimu=2, hidden=4, layers=2):
+    rng = np.random.RandomState(0)
+    dim_input = dimo + dimz + dimg
+    if sac:
+        pi = _make_weights([dim_input] + [hidden] * (layers + 1), rng)
+        pi += _make_weights([hidden, dimu], rng) + _make_weights([hidden, dimu], rng)
+    else:
+        pi = _make_weights([dim_input] + [hidden] * layers + [dimu], rng)
+    weights = dict(
+        o_stats=(rng.randn(dimo), rng.rand(dimo) + 0.5), g_stats=(np.zeros(dimg), np.ones(dimg)),
+        pi=pi, Q=_make_weights([dim_input + dimu] + [hidden] * layers + [1], rng))
+    return NumpyPolicy(weights, dimo, dimz, dimg, dimu, max_u=2., clip_obs=200., norm_clip=5., sac=sac)
+
+
+def _forward(layers, x):
+    for i, (w, b) in enumerate(layers):
+        x = x @ w + b
+        if i < len(layers) - 1:
+            x = np.maximum(x, 0.)
+    return x
+
+
+def test_ddpg_actions_and_Q():
+    policy = _make_policy(sac=False)
+    rng = np.random.RandomState(1)
+    o, z, g = rng.randn(5, 3), rng.randn(5, 2), rng.randn(5, 2)
+    u, Q = policy.get_actions(o, z, None, g, compute_Q=True)
+
+    x = np.concatenate([np.clip((o - policy.o_mean) / policy.o_std, -5., 5.), z, g], axis=1)
+    expected_u = 2. * np.tanh(_forward(policy.pi_layers, x))
+    expected_Q = _forward(policy.Q_layers, np.concatenate([x, expected_u / 2.], axis=1))
+    np.testing.assert_allclose(u, expected_u, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(Q, expected_Q, rtol=1e-5, atol=1e-5)
+
+    # a single environment gets an unbatched action
+    assert policy.get_actions(o[:1], z[:1], None, g[:1]).shape == (2,)
+
+
+def test_sac_actions_use_mean():
+    policy = _make_policy(sac=True)
+    rng = np.random.RandomState(1)
+    o, z, g = rng.randn(5, 3), rng.randn(5, 2), rng.randn(5, 2)
+    u = policy.get_actions(o, z, None, g)
+
+    x = np.concatenate([np.clip((o - policy.o_mean) / policy.o_std, -5., 5.), z, g], axis=1)
+    net = _forward(policy.pi_layers[:-2], x)
+    mu = net @ policy.pi_layers[-2][0] + policy.pi_layers[-2][1]
+    np.testing.assert_allclose(u, 2. * np.tanh(mu), rtol=1e-5, atol=1e-5)
+
+    u = policy.get_actions(o, z, None, g, noise_eps=1., random_eps=1.)
+    assert np.all(np.abs(u) <= 2.)
+
+
+def test_set_weights():
+    policy = _make_policy(sac=False)
+    rng = np.random.RandomState(1)
+    o, z, g = rng.randn(5, 3), rng.randn(5, 2), rng.randn(5, 2)
+    u = policy.get_actions(o, z, None, g)
+
+    # negating the output layer of the actor negates its actions
+    (w, b) = policy.pi_layers[-1]
+    policy.set_weights(dict(o_stats=(policy.o_mean, policy.o_std), g_stats=(policy.g_mean, policy.g_std),
+                            pi=policy.pi_layers[:-1] + [(-w, -b)], Q=policy.Q_layers))
+    np.testing.assert_allclose(policy.get_actions(o, z, None, g), -u, rtol=1e-5, atol=1e-5)
@@ -0,0 +1,64 @@
+import pytest
+
+from baselines.her.pipeline import RolloutPipeline
+
+
+class _ActorPolicy:
+    def __init__(self):
+        self.weights = 0
+
+    def set_weights(self, weights):
+        self.weights = weights
+
+
+class _Policy:
+    def __init__(self):
+        self.n_train_steps = 0
+        self.stored = []
+
+    def export_numpy_policy(self):
+        return _ActorPolicy()
+
+    def export_numpy_weights(self):
+        return self.n_train_steps
+
+    def store_episode(self, episode):
+        self.stored.append(episode)
+
+
+class _Worker:
+    def __init__(self, fail=False):
+        self.policy = 'learner'
+        self.fail = fail
+
+    def generate_rollouts(self, random_action, n):
+        if self.fail:
+            raise ValueError('rollout failed')
+        return dict(n=n, random_action=random_action, weights=self.policy.weights)
+
+
+def test_pipeline_stays_bounded():
+    policy, worker = _Policy(), _Worker()
+    # the two first rollouts are warmup rollouts with random actions
+    pipeline = RolloutPipeline(policy, worker, lambda n: dict(random_action=n < 2, n=n), rollouts_ahead=2)
+    assert worker.policy is pipeline.actor_policy
+    for cycle in range(6):
+        pipeline.publish()
+        episode = pipeline.acquire()
+        assert episode['n'] == cycle and episode['random_action'] == (cycle < 2)
+        # rollouts act with a snapshot taken before their cycle
+        assert episode['weights'] <= 10 * cycle
+        assert len(policy.stored) - (cycle + 1) <= 2
+        policy.n_train_steps += 10
+    logs = dict(pipeline.logs())
+    assert logs['pipeline/policy_lag'] >= 0
+    pipeline.close()
+    assert not pipeline.thread.is_alive()
+    assert worker.policy == 'learner'
+
+
+def test_pipeline_reraises_errors():
+    pipeline = RolloutPipeline(_Policy(), _Worker(fail=True), lambda n: dict(random_action=False, n=n))
+    with pytest.raises(RuntimeError):
+        pipeline.acquire()
+    pipeline.close()
@@ -0,0 +1,41 @@
+import threading
+
+import pytest
+
+from baselines.her.prefetch import BatchPrefetcher
+
+
+class _Buffer:
+    current_size = 1
+
+
+class _Policy:
+    def __init__(self, fail=False):
+        self.buffer = _Buffer()
+        self.history_lock = threading.Lock()
+        self.staged = []
+        self.fail = fail
+
+    def stage_batch(self, ir, t):
+        if self.fail:
+            raise ValueError('sampling failed')
+        self.staged.append(t)
+
+
+def test_prefetcher_stays_bounded():
+    policy = _Policy()
+    prefetcher = BatchPrefetcher(policy, 3)
+    for t in range(10):
+        prefetcher.acquire(t)
+        prefetcher.release()
+        assert len(policy.staged) - (t + 1) <= 3
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    assert len(policy.staged) <= 13
+
+
+def test_prefetcher_reraises_errors():
+    prefetcher = BatchPrefetcher(_Policy(fail=True), 2)
+    with pytest.raises(RuntimeError):
+        prefetcher.acquire(0)
+    prefetcher.close()
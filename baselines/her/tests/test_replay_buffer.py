@@ -0,0 +1,303 @@
+import threading
+
+import numpy as np
+
+from baselines.her.her import make_sample_her_transitions
+from baselines.her.replay_buffer import ReplayBuffer, MemmapReplayBuffer, PackedReplayBuffer
+
+
+def _make_buffer(size_in_transitions=40, T=4, buffer_dtypes=None, constant_keys=(), sample_transitions=None,
+                 **kwargs):
+    buffer_shapes = {
+        'o': (T + 1, 3),
+        'ag': (T + 1, 2),
+        'g': (T, 2),
+        'z': (T, 2),
+        'u': (T, 1),
+        'myr': (T,),
+        'myd': (T,),
+        'myv': (T,),
+    }
+    return ReplayBuffer(buffer_shapes, size_in_transitions, T, sample_transitions, buffer_dtypes, constant_keys,
+                        **kwargs)
+
+
+def _make_episode(batch_size=2, T=4):
+    return {
+        'o': np.random.randn(batch_size, T + 1, 3),
+        'ag': np.random.randn(batch_size, T + 1, 2),
+        'g': np.random.randn(batch_size, T, 2),
+        'z': np.tile(np.eye(2)[:1], (batch_size, T, 1)),
+        'u': np.random.randn(batch_size, T, 1),
+        'myr': np.zeros((batch_size, T)),
+        'myd': np.zeros((batch_size, T)),
+        'myv': np.ones((batch_size, T)),
+        's': np.zeros((batch_size, 1)),
+    }
+
+
+def test_buffer_dtypes():
+    buffer = _make_buffer(buffer_dtypes={'z': np.uint8, 'myd': np.uint8, 'myv': np.uint8})
+
+    assert buffer.buffers['o'].dtype == np.float32
+    assert buffer.buffers['s'].dtype == np.float32
+    assert buffer.buffers['z'].dtype == np.uint8
+    assert buffer.buffers['myv'].dtype == np.uint8
+
+    episode = _make_episode()
+    buffer.store_episode(episode, None)
+    assert np.allclose(buffer.buffers['o'][:2], episode['o'])
+    assert np.array_equal(buffer.buffers['z'][:2], episode['z'])
+    assert buffer.get_transitions_stored() == 8
+
+
+def test_memmap_buffer_resume(tmp_path):
+    T = 4
+    buffer_shapes = {'o': (T + 1, 3), 'u': (T, 1), 'myv': (T,)}
+    episode = {'o': np.random.randn(2, T + 1, 3), 'u': np.random.randn(2, T, 1), 'myv': np.ones((2, T)),
+               's': np.zeros((2, 1))}
+
+    buffer = MemmapReplayBuffer(buffer_shapes, 40, T, None, {'myv': np.uint8}, storage_dir=str(tmp_path))
+    assert not buffer.resumed
+    buffer.store_episode(episode, None)
+    assert buffer.n_unflushed_stores == 1
+    buffer.flush()
+    assert buffer.n_unflushed_stores == 0
+    del buffer
+
+    buffer = MemmapReplayBuffer(buffer_shapes, 40, T, None, {'myv': np.uint8}, storage_dir=str(tmp_path))
+    assert buffer.resumed
+    assert buffer.get_current_episode_size() == 2
+    assert buffer.get_transitions_stored() == 2 * T
+    assert np.allclose(buffer.buffers['o'][:2], episode['o'])
+
+    # a buffer with a different layout starts from scratch
+    buffer = MemmapReplayBuffer(buffer_shapes, 80, T, None, {'myv': np.uint8}, storage_dir=str(tmp_path),
+                                flush_interval=2)
+    assert not buffer.resumed
+    assert buffer.get_current_episode_size() == 0
+    buffer.store_episode(episode, None)
+    assert buffer.n_unflushed_stores == 1
+    buffer.store_episode(episode, None)
+    assert buffer.n_unflushed_stores == 0
+
+
+def test_constant_keys():
+    buffer = _make_buffer(constant_keys=['z', 'g'])
+    assert buffer.buffers['z'].shape == (10, 2)
+
+    episode = _make_episode()
+    episode['g'][:] = episode['g'][:, :1]
+    buffer.store_episode(episode, None)
+
+    buffers = buffer.get_current_buffers()
+    assert buffers['z'].shape == (2, 4, 2)
+    assert np.array_equal(buffers['z'], episode['z'])
+    assert np.allclose(buffers['g'], episode['g'])
+    assert np.allclose(buffers['o_2'], episode['o'][:, 1:])
+
+
+def test_prioritized_sampling():
+    def sample_transitions(ddpg, ir, episode_batch, batch_size, sk_r_scale, t, idxs=None, keys=None):
+        episode_idxs, t_samples = idxs
+        transitions = {key: episode_batch[key][episode_idxs, t_samples] for key in episode_batch.keys() if key != 's'}
+        transitions['r'] = transitions['myr']
+        return transitions
+
+    T = 4
+    buffer = _make_buffer(T=T, constant_keys=['z', 'g'], sample_transitions=sample_transitions, prioritized=True)
+
+    episode = _make_episode(T=T)
+    episode['myv'][1, 2:] = 0
+    buffer.store_episode(episode, None)
+
+    transitions = buffer.sample(None, False, 64, 0, 0)
+    episode_idxs, t_samples = transitions['idxs'] // T, transitions['idxs'] % T
+    assert np.all(episode['myv'][episode_idxs, t_samples] == 1)
+    assert np.allclose(transitions['w'], 1.)
+
+    # a transition with a much larger TD error dominates the batch and is down-weighted
+    generations = buffer.generations[np.arange(2 * T) // T]
+    buffer.update_priorities(np.arange(2 * T), np.full(2 * T, 1e-3), generations)
+    buffer.update_priorities(np.array([T + 1]), np.array([100.]), generations[[T + 1]])
+    transitions = buffer.sample(None, False, 64, 0, 0)
+    assert np.mean(transitions['idxs'] == T + 1) > 0.9
+    assert np.all(transitions['w'][transitions['idxs'] == T + 1] < 1.)
+
+    # the padded steps and the episodes overwritten since they were sampled keep their priority
+    assert buffer.sum_tree[T + 2] == 0.
+    buffer.update_priorities(np.array([T + 3]), np.array([100.]), generations[[T + 3]])
+    assert buffer.sum_tree[T + 3] == 0.
+    priority = buffer.sum_tree[0]
+    buffer.update_priorities(np.array([0]), np.array([100.]), generations[[0]] - 2)
+    assert buffer.sum_tree[0] == priority
+
+
+def test_valid_length_index():
+    buffer = _make_buffer()
+    episode = _make_episode()
+    episode['myv'][0, 1:] = 0
+    episode['myv'][1, 3:] = 0
+    buffer.store_episode(episode, None)
+
+    assert np.array_equal(buffer.valid_lengths[:2], [1, 3])
+    episode_idxs, t_samples = buffer._sample_uniform_idxs(1000)
+    assert np.all(t_samples < buffer.valid_lengths[episode_idxs])
+    assert set(t_samples[episode_idxs == 1]) == {0, 1, 2}
+
+
+def test_drops_episodes_without_valid_steps():
+    buffer = _make_buffer()
+    episode = _make_episode()
+    episode['myv'][0] = 0
+    buffer.store_episode(episode, None)
+    assert buffer.get_current_episode_size() == 1
+    assert np.allclose(buffer.buffers['o'][0], episode['o'][1])
+
+    episode['myv'][1] = 0
+    buffer.store_episode(episode, None)
+    assert buffer.get_current_episode_size() == 1
+
+
+def test_her_sampler_gathers_requested_keys():
+    sample_transitions = make_sample_her_transitions('future', 4, None, [(0, 0.2), (10, 0.2)])
+    buffer = _make_buffer(constant_keys=['z', 'g'], sample_transitions=sample_transitions)
+    episode = _make_episode()
+    episode['info_is_success'] = np.zeros((2, 4, 1))
+    buffer.buffers['info_is_success'] = np.zeros((10, 4, 1), np.float32)
+    buffer.store_episode(episode, None)
+
+    transitions = buffer.sample(None, False, 32, 0, 0, keys=['o', 'o_2', 'myd', 's'])
+    assert 'info_is_success' not in transitions and 'myv' not in transitions
+    assert transitions['o'].shape == (32, 3)
+    assert transitions['o_2'].shape == (32, 3)
+    assert transitions['g'].shape == (32, 2)
+    assert transitions['s'].shape == (32,)
+
+    transitions = buffer.sample(None, False, 32, 0, 0)
+    assert transitions['info_is_success'].shape == (32, 1)
+
+
+def test_sk_r_cache_staleness():
+    class _Discriminator:
+        sk_version = 0
+        calls = 0
+        steps = 0
+
+        def run_sk(self, o, z, o2, u, record=True):
+            assert not record
+            self.calls += 1
+            self.steps += len(o)
+            return np.sum(o2 - o, axis=1, keepdims=True).astype(np.float32)
+
+    ddpg = _Discriminator()
+    sample_transitions = make_sample_her_transitions('future', 4, None, [(0, 0.2), (10, 0.2)])
+    buffer = _make_buffer(constant_keys=['z', 'g'], sample_transitions=sample_transitions, sk_r_cache_staleness=2)
+    episode = _make_episode()
+    episode['myv'][1, 2:] = 0
+    buffer.store_episode(episode, None)
+
+    transitions = buffer.sample(ddpg, True, 32, 1, 0, keys=['o', 'o_2', 's'])
+    # only the valid steps are recomputed
+    assert ddpg.calls == 1 and ddpg.steps == 6
+    expected = np.sum(episode['o'][:, 1:] - episode['o'][:, :-1], axis=2) * episode['myv']
+    assert np.allclose(buffer.sk_r_cache[:2], expected, atol=1e-5)
+    assert transitions['s'].shape == (32,)
+
+    ddpg.sk_version = 2
+    buffer.sample(ddpg, True, 32, 1, 0)
+    assert ddpg.calls == 1
+    ddpg.sk_version = 3
+    buffer.sample(ddpg, True, 32, 1, 0)
+    assert ddpg.calls == 2
+    assert np.all(buffer.sk_r_version[:2] == 3)
+
+    buffer.store_episode(_make_episode(), None)
+    buffer.sample(ddpg, True, 32, 1, 0)
+    assert ddpg.calls == 3
+    assert np.all(buffer.sk_r_version[:4] == 3)
+
+
+def test_fifo_and_reservoir_eviction():
+    buffer = _make_buffer(eviction='fifo')
+    for i in range(7):
+        episode = _make_episode()
+        episode['u'][:] = i
+        buffer.store_episode(episode, None)
+    # 10 slots, 14 episodes: the four oldest were replaced in order
+    assert buffer.get_current_episode_size() == 10
+    assert np.array_equal(buffer.buffers['u'][:, 0, 0], [5, 5, 6, 6, 2, 2, 3, 3, 4, 4])
+
+    buffer = _make_buffer(eviction='reservoir')
+    for _ in range(50):
+        buffer.store_episode(_make_episode(), None)
+    assert buffer.get_current_episode_size() == 10
+    assert buffer.n_episodes_seen == 100
+    assert buffer.get_transitions_stored() < 100 * 4
+
+
+def test_concurrent_store_and_sample():
+    def sample_transitions(ddpg, ir, episode_batch, batch_size, sk_r_scale, t, idxs=None, keys=None):
+        episode_idxs, t_samples = idxs
+        transitions = {key: episode_batch[key][episode_idxs, t_samples] for key in ['o', 'u', 'myr']}
+        transitions['r'] = transitions['myr']
+        return transitions
+
+    buffer = _make_buffer(size_in_transitions=400, sample_transitions=sample_transitions)
+    episode = _make_episode(batch_size=100)
+    episode['o'][:] = -1
+    episode['u'][:] = -1
+    buffer.store_episode(episode, None)
+    stop = threading.Event()
+
+    def write():
+        i = 0
+        while not stop.is_set():
+            episode = _make_episode(batch_size=5)
+            episode['o'][:] = i
+            episode['u'][:] = i
+            buffer.store_episode(episode, None)
+            i += 1
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(200):
+            transitions = buffer.sample(None, False, 64, 0, 0, keys=['o', 'u'])
+            # o and u come from the same, fully written episode
+            assert np.array_equal(transitions['o'][:, 0], transitions['u'][:, 0])
+    finally:
+        stop.set()
+        writer.join()
+
+
+def test_packed_buffer():
+    sample_transitions = make_sample_her_transitions('future', 4, None, [(0, 0.2), (10, 0.2)])
+    buffer_shapes = {'o': (5, 3), 'ag': (5, 2), 'g': (4, 2), 'z': (4, 2), 'u': (4, 1), 'myr': (4,), 'myd': (4,),
+                     'myv': (4,)}
+    buffer = PackedReplayBuffer(buffer_shapes, 20, 4, sample_transitions, constant_keys=['z', 'g'])
+    assert buffer.n_rows == 25
+
+    for i in range(6):
+        episode = _make_episode()
+        episode['o'][:] = i
+        episode['ag'][:] = i
+        episode['g'][:] = 0
+        episode['u'][:] = i
+        episode['myv'][1, 2:] = 0
+        buffer.store_episode(episode, None)
+        assert buffer.get_current_size() <= 20
+    # episodes of 4 and 2 valid steps take 5 and 3 rows, only the latest ones fit
+    assert buffer.get_current_episode_size() == 6
+    assert buffer.get_current_size() == 18
+    assert buffer.n_transitions_stored == 36
+
+    transitions = buffer.sample(None, False, 256, 0, 0)
+    assert transitions['o'].shape == (256, 3) and transitions['z'].shape == (256, 2)
+    # o, o_2 and u come from the same episode, and the relabelled goals too
+    assert np.all(transitions['o'] >= 3)
+    assert np.array_equal(transitions['o'], transitions['o_2'])
+    assert np.array_equal(transitions['o'][:, :1], transitions['u'])
+    assert np.array_equal(transitions['o'][:, :2], transitions['ag_2'])
+    relabelled = transitions['g'] != 0
+    assert np.array_equal(transitions['g'][relabelled], transitions['ag'][relabelled])
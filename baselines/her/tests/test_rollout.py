@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from gym import spaces
+
+MujocoException = pytest.importorskip('mujoco_py').MujocoException
+
+from baselines import logger
+from baselines.her.rollout import RolloutWorker
+
+
+class _FailingEnv:
+    """A goal environment that fails once, on the given step of an episode: environment 1
+    raises a MujocoException on step 3, environment 2 returns a NaN observation on step 5 and
+    environment 3 raises on its first step.
+    """
+    observation_space = spaces.Dict({
+        'observation': spaces.Box(-np.inf, np.inf, (3,)), 'achieved_goal': spaces.Box(-np.inf, np.inf, (2,)),
+        'desired_goal': spaces.Box(-np.inf, np.inf, (2,))})
+    action_space = spaces.Box(-1., 1., (2,))
+    fail_steps = {1: 3, 2: 5, 3: 1}
+
+    def __init__(self, always_fail=False):
+        self.env = self
+        self.goal = np.zeros(2)
+        self.idx = 0
+        self.n_failures = 0
+        self.always_fail = always_fail
+
+    def seed(self, seed):
+        self.idx = seed // 1000
+
+    def _obs(self):
+        return {'observation': np.array([self.t, *self.pos]), 'achieved_goal': self.pos.copy(),
+                'desired_goal': self.goal.copy()}
+
+    def reset(self):
+        self.t = 0
+        self.pos = np.zeros(2)
+        return self._obs()
+
+    def step(self, u):
+        self.t += 1
+        failing = (self.n_failures == 0 or self.always_fail) and self.fail_steps.get(self.idx) == self.t
+        self.n_failures += failing
+        if failing and self.idx != 2:
+            raise MujocoException('simulation is unstable')
+        self.pos = self.pos + u
+        ob = self._obs()
+        if failing:
+            ob['observation'][0] = np.nan
+        return ob, -1., False, {'is_success': 1.}
+
+
+class _Policy:
+    def get_actions(self, o, z, ag, g, **kwargs):
+        return np.full((o.shape[0], 2), 0.1)
+
+
+def _make_worker(parallel_envs, recover_envs, always_fail=False):
+    worker = RolloutWorker(lambda: _FailingEnv(always_fail), _Policy(), {'o': 3, 'g': 2, 'u': 2}, logger, T=8,
+                           rollout_batch_size=4, parallel_envs=parallel_envs, recover_envs=recover_envs,
+                           max_rollout_attempts=4)
+    worker.seed(0)
+    return worker
+
+
+@pytest.mark.parametrize('parallel_envs', [0, 2])
+def test_recovers_failing_envs(parallel_envs):
+    worker = _make_worker(parallel_envs, recover_envs=True)
+    episode = worker.generate_rollouts(z_s_onehot=np.eye(4))
+
+    # the episodes end before the failing steps, the other environments keep all their steps
+    assert np.array_equal(episode['myv'].sum(axis=1), [8, 2, 4, 0])
+    assert not np.isnan(episode['o']).any()
+    logs = dict(worker.logs())
+    assert logs['worker/env_failures'] == 3
+    assert logs['worker/success_rate'] == 0.25
+    if worker.vec_env is not None:
+        worker.vec_env.close()
+
+
+@pytest.mark.parametrize('parallel_envs', [0, 2])
+def test_restarts_all_envs(parallel_envs):
+    worker = _make_worker(parallel_envs, recover_envs=False)
+    z_s_onehot = np.eye(4)[::-1]
+    # each failure restarts all environments, the fourth attempt succeeds
+    episode = worker.generate_rollouts(z_s_onehot=z_s_onehot)
+    assert np.array_equal(episode['myv'].sum(axis=1), [8, 8, 8, 8])
+    assert np.array_equal(episode['z'][:, 0], z_s_onehot)
+    assert dict(worker.logs())['worker/env_failures'] == 3
+    if worker.vec_env is not None:
+        worker.vec_env.close()
+
+    worker = _make_worker(parallel_envs, recover_envs=False, always_fail=True)
+    with pytest.raises(RuntimeError):
+        worker.generate_rollouts(z_s_onehot=z_s_onehot)
+    if worker.vec_env is not None:
+        worker.vec_env.close()
@@ -138,6 +138,30 @@ def snn(input, layers_sizes, flatten=False, name="", sn=False, is_training=None)
     return input
 
 
+def snn_heads(input, layers_sizes, names):
+    """Equivalent to one snn call without spectral normalization per name, on the same input. The
+    first layers run as one matmul on the concatenated kernels and the later ones as one batched
+    matmul. The variables are named and created in the same order as by separate snn calls.
+    """
+    initializer = tf.compat.v1.keras.initializers.VarianceScaling(scale=1.0, mode="fan_avg", distribution="uniform")
+    sizes = [input.get_shape().as_list()[-1]] + list(layers_sizes)
+    params = []
+    for name in names:
+        params.append([])
+        for i, size in enumerate(layers_sizes):
+            with tf.compat.v1.variable_scope(f'{name}_fully_{i}'):
+                kernel = tf.compat.v1.get_variable('kernel', [sizes[i], size], tf.float32, initializer=initializer)
+                bias = tf.compat.v1.get_variable('bias', [size], tf.float32, initializer=tf.compat.v1.zeros_initializer())
+            params[-1].append((kernel, bias))
+
+    x = tf.matmul(input, tf.concat([p[0][0] for p in params], axis=1)) + tf.concat([p[0][1] for p in params], axis=0)
+    x = tf.stack(tf.split(x, len(names), axis=1))  # heads x batch x units
+    for i in range(1, len(layers_sizes)):
+        x = tf.nn.relu(x)
+        x = tf.matmul(x, tf.stack([p[i][0] for p in params])) + tf.stack([p[i][1] for p in params])[:, None]
+    return tf.unstack(x)
+
+
 def install_mpi_excepthook():
     import sys
     from mpi4py import MPI
@@ -1,3 +1,4 @@
+import contextlib
 import os
 import pathlib
 import sys
@@ -14,6 +15,8 @@ from baselines import logger
 from baselines.common import set_global_seeds
 from baselines.common.mpi_moments import mpi_moments
 import baselines.her.experiment.config as config
+from baselines.her.actor_pool import ActorPool
+from baselines.her.pipeline import RolloutPipeline
 from baselines.her.rollout import RolloutWorker
 from baselines.her.util import mpi_fork, snn
 
@@ -48,9 +51,8 @@ def sample_skill(num_skills, rollout_batch_size, use_skill_n=None, skill_type='d
             z_s.fill(use_skill_n)
 
         z_s_onehot = np.zeros([rollout_batch_size, num_skills])
-        z_s = np.array(z_s).reshape(rollout_batch_size, 1)
-        for i in range(rollout_batch_size):
-            z_s_onehot[i, z_s[i]] = 1
+        z_s_onehot[np.arange(rollout_batch_size), z_s] = 1
+        z_s = z_s.reshape(rollout_batch_size, 1)
         return z_s, z_s_onehot
     else:
         z_s = np.zeros((rollout_batch_size, 1))
@@ -225,7 +227,7 @@ def train(
         save_policies, num_cpu, collect_data, collect_video, goal_generation, num_skills, use_skill_n, batch_size,
         sk_r_scale,
         skill_type, plot_freq, plot_repeats, n_random_trajectories, sk_clip, et_clip, done_ground,
-        **kwargs
+        fused_cycle=False, sk_batch_from_critic=False, pipelined_rollouts=0, actor_pool=None, **kwargs
 ):
 
     rank = MPI.COMM_WORLD.Get_rank()
@@ -245,6 +247,25 @@ def train(
             layers=policy.layers,
         ), f)
 
+    if policy.buffer.get_current_episode_size() > 0:
+        logger.info('Replay buffer already holds {} transitions, skipping the warmup epochs'.format(
+            policy.buffer.get_current_size()))
+        train_start_epoch = 0
+
+    pipeline = None
+    # guards the histories of the rollout worker while the pipeline thread generates rollouts
+    rollout_lock = contextlib.nullcontext()
+    if pipelined_rollouts:
+        def rollout_kwargs(n):
+            # the n-th rollout belongs to the cycle n % n_cycles of epoch n // n_cycles
+            z_s, z_s_onehot = sample_skill(num_skills, rollout_worker.rollout_batch_size, use_skill_n, skill_type=skill_type)
+            generated_goal = np.zeros(rollout_worker.g.shape) if goal_generation == 'Zero' else False
+            return dict(generated_goal=generated_goal, z_s_onehot=z_s_onehot,
+                        random_action=n // n_cycles < train_start_epoch)
+
+        pipeline = RolloutPipeline(policy, rollout_worker, rollout_kwargs, rollouts_ahead=pipelined_rollouts)
+        rollout_lock = pipeline.lock
+
     logger.info("Training...")
     best_success_rate = -1
     t = 1
@@ -253,48 +274,62 @@ def train(
     for epoch in range(n_epochs):
         # train
         episodes = []
-        rollout_worker.clear_history()
+        with rollout_lock:
+            rollout_worker.clear_history()
+        if actor_pool is not None:
+            actor_pool.set_random_action(epoch < train_start_epoch)
         for cycle in range(n_cycles):
-            z_s, z_s_onehot = sample_skill(num_skills, rollout_worker.rollout_batch_size, use_skill_n, skill_type=skill_type)
-
-            if goal_generation == 'Zero':
-                generated_goal = np.zeros(rollout_worker.g.shape)
+            if pipeline is not None:
+                # the rollouts generated from now on act with the weights of the previous cycles,
+                # this cycle's rollout has already been stored
+                pipeline.publish()
+                episodes.append(pipeline.acquire())
+            elif actor_pool is not None:
+                # every rollout the actors have queued so far, at least one
+                actor_pool.publish()
+                episodes.extend(actor_pool.store_episodes())
             else:
-                generated_goal = False
+                z_s, z_s_onehot = sample_skill(num_skills, rollout_worker.rollout_batch_size, use_skill_n, skill_type=skill_type)
 
-            if train_start_epoch <= epoch:
-                episode = rollout_worker.generate_rollouts(generated_goal=generated_goal, z_s_onehot=z_s_onehot)
-            else:
-                episode = rollout_worker.generate_rollouts(generated_goal=generated_goal, z_s_onehot=z_s_onehot, random_action=True)
-            episodes.append(episode)
-            policy.store_episode(episode)
+                if goal_generation == 'Zero':
+                    generated_goal = np.zeros(rollout_worker.g.shape)
+                else:
+                    generated_goal = False
+
+                if train_start_epoch <= epoch:
+                    episode = rollout_worker.generate_rollouts(generated_goal=generated_goal, z_s_onehot=z_s_onehot)
+                else:
+                    episode = rollout_worker.generate_rollouts(generated_goal=generated_goal, z_s_onehot=z_s_onehot, random_action=True)
+                policy.store_episode(episode)
+                episodes.append(episode)
+
+            if fused_cycle and train_start_epoch <= epoch:
+                # sample all batches of the cycle up front and run every update in one graph call
+                t = epoch
+                batches = [policy.sample_batch(ir=True, t=t) for _ in range(n_batches)]
+                sk_batches = None
+                if sk_r_scale > 0:
+                    sk_batches = [policy.sample_discriminator_batch(batch_size, batch if sk_batch_from_critic else None)
+                                  for batch in batches]
+                policy.train_cycle(batches, sk_batches, update_target=policy.target_update_interval == 0)
+                continue
 
             for batch in range(n_batches):
                 t = epoch
+                critic_batch = None
                 if train_start_epoch <= epoch:
-                    policy.train(t)
+                    if sk_batch_from_critic:
+                        critic_batch = policy.sample_batch(ir=True, t=t)
+                        policy.stage_batch(ir=True, t=t, batch=critic_batch)
+                    policy.train(t, stage=critic_batch is None)
 
-                # train skill discriminator
+                # train skill discriminator and its distance model
                 if sk_r_scale > 0:
-                    o_s = policy.buffer.buffers['o'][0: policy.buffer.current_size]
-                    o2_s = policy.buffer.buffers['o'][0: policy.buffer.current_size][:, 1:, :]
-                    z_s = policy.buffer.buffers['z'][0: policy.buffer.current_size]
-                    u_s = policy.buffer.buffers['u'][0: policy.buffer.current_size]
-                    T = z_s.shape[-2]
-                    episode_idxs = np.random.randint(0, policy.buffer.current_size, batch_size)
-                    t_samples = np.random.randint(T, size=batch_size)
-                    o_s_batch = o_s[episode_idxs, t_samples]
-                    o2_s_batch = o2_s[episode_idxs, t_samples]
-                    z_s_batch = z_s[episode_idxs, t_samples]
-                    u_s_batch = u_s[episode_idxs, t_samples]
-                    if train_start_epoch <= epoch:
-                        policy.train_sk(o_s_batch, z_s_batch, o2_s_batch, u_s_batch)
-                    if policy.dual_dist != 'l2':
-                        add_dict = dict()
-                        policy.train_sk_dist(o_s_batch, z_s_batch, o2_s_batch, add_dict)
+                    sk_batch = policy.sample_discriminator_batch(batch_size, critic_batch)
+                    policy.train_discriminators(sk_batch, train_sk=train_start_epoch <= epoch)
                 # #
 
-            if train_start_epoch <= epoch:
+            if train_start_epoch <= epoch and policy.target_update_interval == 0:
                 policy.update_target_net()
 
         if collect_data and (rank == 0):
@@ -317,8 +352,16 @@ def train(
         for key, val in evaluator.logs('test'):
             logger.record_tabular(key, mpi_average(val))
         if n_cycles != 0:
-            for key, val in rollout_worker.logs('train'):
+            if actor_pool is not None:
+                train_logs = actor_pool.logs()
+            else:
+                with rollout_lock:
+                    train_logs = rollout_worker.logs('train')
+            for key, val in train_logs:
                 logger.record_tabular(key, mpi_average(val))
+            if pipeline is not None:
+                for key, val in pipeline.logs():
+                    logger.record_tabular(key, mpi_average(val))
             for key, val in policy.logs(is_policy_training=(train_start_epoch <= epoch)):
                 logger.record_tabular(key, mpi_average(val))
 
@@ -338,6 +381,9 @@ def train(
             policy_path = periodic_policy_path.format(epoch)
             logger.info('Saving periodic policy to {} ...'.format(policy_path))
             evaluator.save_policy(policy_path)
+        if policy_save_interval > 0 and epoch % policy_save_interval == 0:
+            # checkpoint the episodes of a disk-backed replay buffer with the policy
+            policy.buffer.flush()
 
         # make sure that different threads have different seeds
         local_uniform = np.random.uniform(size=(1,))
@@ -346,6 +392,13 @@ def train(
         if rank != 0:
             assert local_uniform[0] != root_uniform[0]
 
+    if pipeline is not None:
+        pipeline.close()
+    if actor_pool is not None:
+        actor_pool.close()
+    policy.stop_prefetch()
+    policy.buffer.flush()
+
 
 def launch(
         run_group, env_name, n_epochs, train_start_epoch, num_cpu, seed, replay_strategy, policy_save_interval, clip_return, binding, logging,
@@ -354,7 +407,10 @@ def launch(
         max_path_length, hidden, layers, rollout_batch_size, n_batches, polyak, spectral_normalization,
         dual_reg, dual_init_lambda, dual_lam_opt, dual_slack, dual_dist,
         inner, algo, random_eps, noise_eps, lr, sk_lam_lr, buffer_size, algo_name,
-        load_weight, override_params={}, save_policies=True,
+        load_weight, replay_buffer, replay_buffer_dir, prioritized_replay, sk_r_cache_staleness, prefetch_batches,
+        replay_eviction, optimizer_mode, fused_cycle, target_update_interval, jit_compile, sk_batch_from_critic,
+        normalizer_sync_interval, parallel_envs, pipelined_rollouts, actor_processes, recover_envs,
+        override_params={}, save_policies=True,
 ):
     tf.compat.v1.disable_eager_execution()
 
@@ -454,6 +510,32 @@ def launch(
     params['buffer_size'] = buffer_size
     params['algo_name'] = algo_name
     params['train_start_epoch'] = train_start_epoch
+    params['replay_buffer'] = replay_buffer
+    if replay_buffer == 'memmap':
+        if replay_buffer_dir is None:
+            if 'SLURM_JOB_ID' in os.environ:
+                # Keyed on the job instead of the restart so that a requeued job reopens the same buffer.
+                replay_buffer_dir = f'logs/{run_group}/buffer_sd{seed:03d}_s_{os.environ["SLURM_JOB_ID"]}.'
+                replay_buffer_dir += f'{os.environ.get("SLURM_PROCID", 0)}_{env_name}'
+            else:
+                replay_buffer_dir = os.path.join(logdir, 'buffer')
+        replay_buffer_dir = os.path.join(replay_buffer_dir, f'rank{rank}')
+    params['replay_buffer_dir'] = replay_buffer_dir
+    params['prioritized_replay'] = prioritized_replay
+    params['sk_r_cache_staleness'] = sk_r_cache_staleness
+    params['prefetch_batches'] = prefetch_batches
+    assert not (sk_batch_from_critic and prefetch_batches), 'sk_batch_from_critic needs the critic batches sampled in train()'
+    assert not (pipelined_rollouts and num_cpu > 1), 'pipelined_rollouts would make MPI calls from two threads'
+    assert not (actor_processes and (num_cpu > 1 or pipelined_rollouts)), \
+        'actor_processes replaces both the MPI replicas and the rollout pipeline'
+    # 'auto' resolves to the MpiAdam path with several MPI workers, as in DDPG
+    assert not (fused_cycle and (optimizer_mode == 'mpi' or MPI.COMM_WORLD.Get_size() > 1)), \
+        'fused_cycle requires optimizer_mode graph, i.e. a single MPI worker'
+    params['replay_eviction'] = replay_eviction
+    params['optimizer_mode'] = optimizer_mode
+    params['target_update_interval'] = target_update_interval
+    params['jit_compile'] = jit_compile
+    params['normalizer_sync_interval'] = normalizer_sync_interval
 
     if load_weight is not None:
         params['load_weight'] = load_weight
@@ -534,6 +616,10 @@ def launch(
     for name in ['T', 'rollout_batch_size', 'gamma', 'noise_eps', 'random_eps']:
         rollout_params[name] = params[name]
         eval_params[name] = params[name]
+    if not render:
+        rollout_params['parallel_envs'] = parallel_envs
+    eval_params['parallel_envs'] = parallel_envs
+    rollout_params['recover_envs'] = eval_params['recover_envs'] = recover_envs
 
 
     rollout_worker = RolloutWorker(make_env, policy, dims, logger, **rollout_params)
@@ -542,13 +628,34 @@ def launch(
     evaluator = RolloutWorker(make_env, policy, dims, logger, **eval_params)
     evaluator.seed(rank_seed)
 
-    video_evaluator = RolloutWorker(make_env, policy, dims, logger, **dict(eval_params, rollout_batch_size=1))
+    video_evaluator = RolloutWorker(make_env, policy, dims, logger, **dict(eval_params, rollout_batch_size=1, parallel_envs=0))
     video_evaluator.seed(rank_seed)
 
+    actor_pool = None
+    if actor_processes:
+        def make_actor_worker(actor_policy, noise_eps, random_eps):
+            # the actors are daemon processes, which cannot step their environments in subprocesses
+            return RolloutWorker(make_env, actor_policy, dims, logger, **dict(
+                rollout_params, noise_eps=noise_eps, random_eps=random_eps, parallel_envs=0))
+
+        def rollout_kwargs(n):
+            z_s, z_s_onehot = sample_skill(params['num_skills'], params['rollout_batch_size'], params['use_skill_n'],
+                                           skill_type=params['skill_type'])
+            generated_goal = (np.zeros((params['rollout_batch_size'], dims['g'])) if params['goal_generation'] == 'Zero'
+                              else False)
+            return dict(generated_goal=generated_goal, z_s_onehot=z_s_onehot)
+
+        actor_pool = ActorPool(policy, make_actor_worker, rollout_kwargs, actor_processes, noise_eps=params['noise_eps'],
+                               random_eps=params['random_eps'], seed=rank_seed)
+
     train(
         logdir=logdir, policy=policy, rollout_worker=rollout_worker, env_name=env_name,
         evaluator=evaluator, video_evaluator=video_evaluator, n_epochs=n_epochs, train_start_epoch=train_start_epoch, n_test_rollouts=params['n_test_rollouts'], n_cycles=params['n_cycles'], n_batches=params['n_batches'], policy_save_interval=policy_save_interval, save_policies=save_policies, num_cpu=num_cpu, collect_data=params['collect_data'], collect_video=params['collect_video'], goal_generation=params['goal_generation'], num_skills=params['num_skills'], use_skill_n=params['use_skill_n'], batch_size=params['_batch_size'], sk_r_scale=params['sk_r_scale'],
         skill_type=params['skill_type'], plot_freq=params['plot_freq'], plot_repeats=params['plot_repeats'], n_random_trajectories=params['n_random_trajectories'], sk_clip=params['sk_clip'], et_clip=params['et_clip'], done_ground=params['done_ground'],
+        fused_cycle=fused_cycle,
+        sk_batch_from_critic=sk_batch_from_critic,
+        pipelined_rollouts=pipelined_rollouts,
+        actor_pool=actor_pool,
     )
 
 
@@ -584,6 +691,7 @@ def launch(
 @click.option('--rollout_batch_size', type=int, default=2)
 @click.option('--n_batches', type=int, default=40)
 @click.option('--polyak', type=float, default=0.95)
+@click.option('--target_update_interval', type=int, default=0, help='update the target network every this many critic steps (0: once per cycle)')
 @click.option('--spectral_normalization', type=int, default=0)
 @click.option('--dual_reg', type=int, default=0)
 @click.option('--dual_init_lambda', type=float, default=1)
@@ -599,6 +707,21 @@ def launch(
 @click.option('--buffer_size', type=int, default=1000000)
 @click.option('--algo_name', type=str, default=None)  # Only for logging, not used
 @click.option('--load_weight', type=str, default=None)
+@click.option('--replay_buffer', type=click.Choice(['memory', 'memmap', 'packed']), default='memory', help='keep the replay buffer in RAM, in memory-mapped files, or in RAM with only the valid steps of each episode')
+@click.option('--replay_buffer_dir', type=str, default=None, help='storage directory of the memmap replay buffer, reopened on restart')
+@click.option('--prioritized_replay', type=int, default=0, help='sample critic batches proportionally to their TD error')
+@click.option('--replay_eviction', type=click.Choice(['random', 'fifo', 'reservoir']), default='random', help='which episodes are replaced once the replay buffer is full')
+@click.option('--optimizer_mode', type=click.Choice(['auto', 'graph', 'mpi']), default='auto', help='apply Adam updates inside the TF graph (single process) or in NumPy with MPI gradient averaging; auto picks graph when num_cpu is 1')
+@click.option('--jit_compile', type=int, default=0, help='compile the networks, losses and in-graph updates with XLA (not the fused_cycle loop)')
+@click.option('--normalizer_sync_interval', type=int, default=1, help='synchronize the observation/goal normalizers every this many stored episodes')
+@click.option('--pipelined_rollouts', type=int, default=0, help='if > 0, generate rollouts on a background thread during training, at most this many ahead of it (one MPI worker only)')
+@click.option('--actor_processes', type=int, default=0, help='if > 0, generate the training rollouts in this many actor processes with decreasing exploration, which feed the learner through a bounded queue (with num_cpu 1)')
+@click.option('--recover_envs', type=int, default=0, help='reset only the environments that fail during a rollout and mask their remaining steps, instead of restarting the rollouts of all environments')
+@click.option('--parallel_envs', type=int, default=0, help='number of subprocesses that step the environments of each rollout worker (0: step them in the main process)')
+@click.option('--prefetch_batches', type=int, default=0, help='number of minibatches sampled ahead of training on a background thread (0: sample synchronously)')
+@click.option('--fused_cycle', type=int, default=0, help='run the n_batches updates of each training cycle in one TF call (requires optimizer_mode graph)')
+@click.option('--sk_batch_from_critic', type=int, default=0, help='train the discriminator on the transitions of the critic batch instead of a separate uniform batch (not with prefetch_batches)')
+@click.option('--sk_r_cache_staleness', type=int, default=None, help='reuse cached intrinsic rewards until the discriminator has been updated this many times (default: no cache)')
 def main(**kwargs):
     launch(**kwargs)
 